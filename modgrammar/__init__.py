@@ -1,5 +1,13 @@
 import sys
 import re
+import bisect
+import collections
+try:
+    import copyreg
+except ImportError:
+    import copy_reg as copyreg
+import mmap
+import os
 import textwrap
 
 import modgrammar.util
@@ -22,10 +30,10 @@ __all__ = [
     "Terminal",
     "Literal", "Word", "Repetition", "ListRepetition", "Reference",
     "GRAMMAR", "G", "ANY", "EMPTY", "REF", "LITERAL", "L", "OR", "EXCEPT", "WORD", "REPEAT", "LIST_OF", "OPTIONAL",
-    "NOT_FOLLOWED_BY",
+    "NOT_FOLLOWED_BY", "ATOMIC",
     "ZERO_OR_MORE", "ONE_OR_MORE", "ANY_EXCEPT", "BOL", "EOL", "EOF",
     "REST_OF_LINE", "SPACE",
-    "generate_ebnf",
+    "generate_ebnf", "load_tree",
 ]
 
 grammar_whitespace = True
@@ -41,12 +49,23 @@ DEFAULT = _Singleton("DEFAULT") # singleton used for detecting default arguments
 
 PARSEERROR_FOUNDTXT_LEN = 16
 
+# (_gclass_reconstructor, _ginstance_reconstructor and the name/bases/cdict
+# form of _gcompact_reconstructor are only used by pickles made by older
+# versions)
+
 def _gclass_reconstructor(name, bases, cdict):
-    return GrammarClass(name, bases, cdict)
+    return util.cached_class(name, bases, cdict)
 
 
 def _ginstance_reconstructor(name, bases, cdict):
-    cls = GrammarClass(name, bases, cdict)
+    cls = util.cached_class(name, bases, cdict)
+    return cls.__new__(cls)
+
+
+def _gcompact_reconstructor(cls, name=None, bases=None, cdict=None):
+    if cls is None:
+        cls = util.cached_class(name, bases, cdict)
+    cls = util.compact_class(cls)
     return cls.__new__(cls)
 
 ###############################################################################
@@ -152,7 +171,7 @@ class ParseError(Exception):
         if self.line is not None:
             lc.append("line {0}".format(self.line + 1))
         if self.col is not None:
-            lc.append("column {9}".format(self.col + 1))
+            lc.append("column {0}".format(self.col + 1))
         if lc:
             return "[{0}] {1}".format(", ".join(lc), self.message)
         else:
@@ -185,19 +204,15 @@ class GrammarClass(type):
         cls.__class_init__(classdict)
 
     def __reduce__(cls):
-        # Note: __reduce__ on metaclasses does not currently work, so this is
-        # currently unused.  The hope is that someday it will actually work.
-        try:
-            lookup = sys.modules[cls.__module__].__dict__[cls.__name__]
-        except KeyError:
-            lookup = None
-        if lookup == cls:
-            return cls.__name__
-        cdict = dict(cls.__dict__)
-        for key in cls.__dict__.keys():
-            if key.startswith('__'):
-                del cdict[key]
-        return (_gclass_reconstructor, (cls.__name__, cls.__bases__, cdict))
+        # Note: pickle does not look for __reduce__ on metaclasses, so this is
+        # registered with copyreg instead (see below).  Classes which can be
+        # looked up by name are pickled that way, as usual, and anything else
+        # (such as the results of LITERAL, WORD, etc) is described structurally,
+        # and rebuilt by util.build_grammar when unpickled.
+        name = util.global_name(cls)
+        if name is not None:
+            return name
+        return (util.build_grammar, (util.grammar_graph(cls),))
 
     def __repr__(cls):
         return cls.__class_repr__()
@@ -250,41 +265,145 @@ class GrammarClass(type):
         return cls.grammar_hashdata() != other.grammar_hashdata()
 
 
+copyreg.pickle(GrammarClass, GrammarClass.__reduce__)
+
+
 class Text(object):
     """Text objects are used to hold the current working text being matched against the grammar.  They keep track of both the text contents and certain other useful state information such as whether we're at the beginning of a line or the end of a file, etc.
        Do not use this class directly.  This is only intended to be used internally by the modgrammar module.
+
+       Positions used while parsing are indexes into :attr:`string`, but the text which has not been consumed yet actually starts at :attr:`start` (text which has been skipped over is only discarded from the beginning of the buffer once there's enough of it to be worth the copy).  Text which is appended with *defer* set is collected separately, and only joined onto the buffer by :meth:`flush`.
+
+       If :attr:`fast_errors` is set, grammars only need to report where they failed to match, not what they expected (see :func:`modgrammar.util.error_result`).
+
+       If :attr:`track_lines` is set, we also keep an index of where all the newlines are, so :meth:`line_col` can work out line and column positions without having to scan through the text again.
+
+       :attr:`binary` is set by the first (non-empty) text appended: if it is a bytes-like object (:class:`bytes`, :class:`bytearray` or :class:`memoryview`), :attr:`string` is :class:`bytes`, and grammars match against it directly (see :func:`modgrammar.util.binary_regexp`).
     """
 
-    def __init__(self, string, bol=False, eof=False):
+    memo = None
+    binary = None
+    fast_errors = False
+    compact_threshold = 65536
+
+    def __init__(self, string, bol=False, eof=False, track_lines=False, line=0, col=0, tabs=1):
         self.string = ""
+        self.start = 0
+        self.chunks = []
+        self.pending = 0
+        self.track_lines = track_lines
+        self.tabs = tabs
+        # 'offset' is the total number of characters which have been discarded from
+        # the front of the buffer.  'newlines' and 'mark' use positions relative to
+        # the whole stream (i.e. buffer index + offset), so they don't need to be
+        # adjusted when that happens.
+        self.offset = 0
+        self.newlines = []
+        self.mark = (0, line, col)
         self.append(string, bol=bol, eof=eof)
 
-    def append(self, string, bol=None, eof=None):
+    def append(self, string, bol=None, eof=None, defer=False):
         if bol is not None:
-            if not self.string:
+            if self.start == len(self.string) and not self.chunks:
                 self.bol = bol
             elif bol:
-                self.string += "\n"
+                self.chunks.append(b"\n" if self.binary else "\n")
+                self.pending += 1
                 eof = bool(eof)
         if string:
-            self.string += string
+            binary = isinstance(string, util.binary_types)
+            if binary is not self.binary:
+                if self.binary is not None:
+                    raise TypeError("Can't mix bytes and text input in the same parse")
+                self.binary = binary
+                if binary:
+                    self.string = b""
+            if binary and type(string) is not bytes:
+                # Keep everything as one type, so joining and slicing work the
+                # same way (on every version of python).
+                if isinstance(string, memoryview):
+                    string = string.tobytes()
+                else:
+                    string = bytes(string)
+            self.chunks.append(string)
+            self.pending += len(string)
             eof = bool(eof)
         if eof is not None:
             self.eof = eof
+        if not defer:
+            self.flush()
+        return self
+
+    def flush(self):
+        if self.chunks:
+            old_len = len(self.string)
+            self.chunks.insert(0, self.string)
+            if self.binary:
+                self.string = string = b"".join(self.chunks)
+                newline = b"\n"
+            else:
+                self.string = string = "".join(self.chunks)
+                newline = "\n"
+            self.chunks = []
+            self.pending = 0
+            if self.track_lines:
+                newlines = self.newlines
+                offset = self.offset
+                pos = string.find(newline, old_len)
+                while pos >= 0:
+                    newlines.append(pos + offset)
+                    pos = string.find(newline, pos + 1)
         return self
 
     def skip(self, count):
         if count:
-            self.bol = (self.string[count - 1] == "\n")
-            self.string = self.string[count:]
+            self.start += count
+            self.bol = (self.string[self.start - 1] in ("\n", 10))
+            if self.start >= self.compact_threshold and self.start * 2 >= len(self.string):
+                if self.track_lines:
+                    # Make sure we won't need the text we're about to discard to work
+                    # out positions later.
+                    self.line_col(self.start, advance=True)
+                    del self.newlines[:bisect.bisect_left(self.newlines, self.offset + self.start)]
+                self.offset += self.start
+                self.string = self.string[self.start:]
+                self.start = 0
         return self
 
+    def line_col(self, pos, advance=False):
+        """
+        Return the *(line, col)* position of the buffer index *pos*, or *(None, None)* if we're not tracking lines.  If *advance* is set, remember the result, so that later calls (which must not be for any earlier positions) can start from there.
+        """
+        if not self.track_lines:
+            return (None, None)
+        offset = self.offset
+        mark_pos, line, col = self.mark
+        pos += offset
+        newlines = self.newlines
+        i = bisect.bisect_left(newlines, mark_pos)
+        j = bisect.bisect_left(newlines, pos, i)
+        if j > i:
+            line += j - i
+            col = 0
+            mark_pos = newlines[j - 1] + 1
+        col = util.advance_col(self.string, mark_pos - offset, pos - offset, col, self.tabs)
+        if advance:
+            self.mark = (pos, line, col)
+        return (line, col)
+
+    def remainder(self):
+        self.flush()
+        return self.string[self.start:]
+
+    def __len__(self):
+        return len(self.string) - self.start + self.pending
+
     def __str__(self):
-        return self.string
+        return self.remainder()
 
     def __repr__(self):
         cls = self.__class__
-        return "{0.__module__}.{0.__name__}({1.string!r}, bol={1.bol}, eof={1.eof})".format(cls, self)
+        return "{0.__module__}.{0.__name__}({1!r}, bol={2.bol}, eof={2.eof})".format(cls, self.remainder(), self)
 
 
 class GrammarParser(object):
@@ -301,17 +420,73 @@ class GrammarParser(object):
 
     .. attribute:: line
 
-       The number of lines we've successfully parsed since the beginning of parsing (or the last :meth:`reset`).  This is measured based on the number of line-end sequences we've seen thus far.
+       The number of lines we've successfully parsed since the beginning of parsing (or the last :meth:`reset`).  This is measured based on the number of line-end sequences we've seen thus far.  (This will be :const:`None` if the parser was created with ``positions=False``.)
 
     .. attribute:: col
 
-       The position of the current :attr:`line` we're at.
+       The position of the current :attr:`line` we're at.  (This will be :const:`None` if the parser was created with ``positions=False``.)
+
+    .. attribute:: memo
+
+       The packrat memo table used while parsing, or :const:`None` if memoization is not enabled.
+
+    .. attribute:: program
+
+       The compiled form of the grammar (see :meth:`Grammar.compile`) if the parser was created with ``compiled=True``, otherwise :const:`None`.
     """
 
-    def __init__(self, grammar, sessiondata, tabs):
+    def __init__(self, grammar, sessiondata, tabs, memoize=False, memo_entries=None, memo_bytes=None, compiled=False,
+                 positions=True, fast_errors=False, output='objects', index=False):
+        if positions not in (True, False, 'lazy'):
+            raise ValueError("Invalid value for 'positions' parameter: {0!r}".format(positions))
+        if output not in ('objects', 'compact', 'arena'):
+            raise ValueError("Invalid value for 'output' parameter: {0!r}".format(output))
+        if index not in (True, False, 'lazy'):
+            raise ValueError("Invalid value for 'index' parameter: {0!r}".format(index))
         self.grammar = grammar
         self.tabs = tabs
+        self.positions = positions
+        self.fast_errors = fast_errors
+        self.output = output
+        self.index = index
         self.sessiondata = sessiondata
+        if compiled:
+            self.program = grammar.compile()
+            self._grammar_parse = self.program.grammar_parse
+        else:
+            self.program = None
+            self._grammar_parse = grammar.grammar_parse
+        commit = grammar
+        # A grammar which is nothing but a committed repetition (for example,
+        # "class File(Grammar): grammar = REPEAT(Record, commit=True)") is
+        # parsed the same way as the repetition itself.
+        while (isinstance(commit, GrammarClass) and not getattr(commit, 'grammar_commit', False)
+               and commit.grammar_parse.__func__ is Grammar.grammar_parse.__func__
+               and not isinstance(commit.grammar, util.RepeatingTuple) and len(commit.grammar) == 1):
+            commit = commit.grammar[0]
+        if getattr(commit, 'grammar_commit', False):
+            # We're parsing a committed repetition, so we can parse (and return)
+            # each repetition separately, instead of holding onto everything until
+            # the whole repetition is done.  (For LIST_OF, the separators are
+            # collapsed out of the results for all but the first.)
+            first = tuple.__getitem__(commit.grammar, 0)
+            if issubclass(commit, ListRepetition):
+                rest = (commit.sep, first)
+            else:
+                rest = (tuple.__getitem__(commit.grammar, 1),)
+            self._commit = []
+            for g in ((first,), rest):
+                g = GRAMMAR(*g, whitespace=commit.grammar_whitespace, collapse=True, grammar_name="<COMMIT>",
+                            grammar_desc="<COMMIT>")
+                self._commit.append(g.compile().grammar_parse if compiled else g.grammar_parse)
+            self._commit_grammar = commit
+        else:
+            self._commit = None
+            self._commit_grammar = None
+        if memoize or memo_entries or memo_bytes:
+            self.memo = util.ParseMemo(memo_entries, memo_bytes)
+        else:
+            self.memo = None
         self.reset()
 
     def reset(self):
@@ -321,8 +496,7 @@ class GrammarParser(object):
         This will clear any remainder in the buffer and reset all (line, column, etc) counters to zero.
         """
         self.char = 0
-        self.line = 0
-        self.col = 0
+        self.text = None
         self.clear_remainder()
 
     def clear_remainder(self):
@@ -330,24 +504,49 @@ class GrammarParser(object):
         Clear any un-matched text left in the buffer.
         """
 
-        self.text = Text("", bol=True)
+        if self.text is None:
+            line, col = (0, 0)
+        else:
+            line, col = self.text.line_col(self.text.start)
+        self.text = Text("", bol=True, track_lines=bool(self.positions), line=line, col=col, tabs=self.tabs)
+        self.text.memo = self.memo
+        self.text.fast_errors = self.fast_errors
         self.state = (None, None)
+        self._commit_count = 0
+        if self.memo is not None:
+            self.memo.clear()
+
+    @property
+    def line(self):
+        return self.text.line_col(self.text.start, advance=True)[0]
+
+    @property
+    def col(self):
+        return self.text.line_col(self.text.start, advance=True)[1]
 
     def remainder(self):
         """
         Return the left over unmatched text in the buffer, if any.  (This method does not actually change the buffer, only report its current contents.  If you want to clear the buffer, use :meth:`clear_remainder`.)
         """
-        return self.text.string
+        return self.text.remainder()
 
-    def append(self, string, bol=None, eof=None):
-        self.text.append(string, bol=bol, eof=eof)
+    def append(self, string, bol=None, eof=None, defer=False):
+        self.text.append(string, bol=bol, eof=eof, defer=defer)
 
-    def _parse(self, pos, data, matchtype):
+    def _parse(self, pos, data, matchtype, output=None):
+        self.text.flush()
         parsestate, matches = self.state
         while True:
             if not parsestate:
                 matches = []
-                parsestate = self.grammar.grammar_parse(self.text, pos, data)
+                memo = self.memo
+                if memo is not None and memo.data is not data:
+                    memo.clear()
+                    memo.data = data
+                if self._commit is None:
+                    parsestate = self._grammar_parse(self.text, pos, data)
+                else:
+                    parsestate = self._commit[self._commit_count > 0](self.text, pos, data)
                 count, obj = next(parsestate)
             else:
                 count, obj = parsestate.send(self.text)
@@ -356,26 +555,40 @@ class GrammarParser(object):
                 if matches:
                     break
                     # No results.  We must have errored out.
-                if pos == len(self.text.string):
+                short = False
+                if self._commit_count:
+                    if not self.text.eof and obj[0] >= len(self.text.string):
+                        # We ran out of text before we could tell whether there's another
+                        # repetition coming, so wait for more and then try again.
+                        self.state = (None, None)
+                        return (None, None)
+                    # We've come to the end of the committed repetition we were working
+                    # through.  If it had enough repetitions, start on the next one.
+                    n = self._commit_count
+                    self._commit_count = 0
+                    if n >= self._commit_grammar.grammar_min:
+                        parsestate = None
+                        continue
+                    short = True
+                if pos == len(self.text.string) and not short:
                     # This happens when we've hit EOF but we want to do one more pass
                     # through in case anything wants to match the EOF itself.  If nothing
                     # does, we don't really expect anything else to match on an empty
                     # string, so ignore the error.
                     return (None, None)
                 errpos, expected = obj
-                if errpos == len(self.text.string) and self.grammar.grammar_whitespace:
+                if errpos == len(self.text.string) and not short and self._only_whitespace(self.text.string, pos):
                     # If we hit EOF and this grammar is whitespace-consuming, check to
                     # see whether we had only whitespace before the EOF.  If so, treat
                     # this like the pos == len(self.text.string) case above.
-                    whitespace_re = self.grammar.grammar_whitespace
-                    if whitespace_re is True:
-                        whitespace_re = util._whitespace_re
-                    m = whitespace_re.match(self.text.string, pos)
-                    if m and m.end() == len(self.text.string):
-                        return (None, None)
-                char = self.char + errpos
-                line, col = util.calc_line_col(self.text.string, errpos, self.line, self.col, self.tabs)
-                raise ParseError(self.grammar, self.text.string, errpos, char, line=line, col=col, expected=expected)
+                    return (None, None)
+                if expected is None:
+                    errpos, expected = self._diagnose(pos, errpos, data)
+                start = self.text.start
+                char = self.char + errpos - start
+                line, col = self.text.line_col(errpos)
+                raise ParseError(self.grammar, self.text.remainder(), errpos - start, char, line=line, col=col,
+                                 expected=expected)
             if count is None:
                 # We need more input
                 self.state = (parsestate, matches)
@@ -398,29 +611,79 @@ class GrammarParser(object):
         elif matchtype == 'all':
             objs = [x[1] for x in matches]
             count = max(x[0] for x in matches)
-            pp_objs = []
-            for obj in objs:
-                result = obj.grammar_postprocess(None, data)
-                if len(result) == 1:
-                    result = result[0]
-                pp_objs.append(result)
-            return (count, pp_objs)
+            return (count, [self._result(obj, data, output) for obj in objs])
         else:
             raise ValueError("Invalid value for 'matchtype' parameter: {0!r}".format(matchtype))
-
-        result = obj.grammar_postprocess(None, data)
+        if self._commit is not None:
+            self._commit_count += 1
+            if self._commit_count >= self._commit_grammar.grammar_max:
+                self._commit_count = 0
+
+        return (count, self._result(obj, data, output))
+
+    def _result(self, obj, data, output=None):
+        # Only now that we know which match won do we create the actual result
+        # objects for it.
+        if output is None:
+            output = self.output
+        if output == 'events':
+            text = self.text
+            return util.iter_events(obj, text.string, self.char - text.start)
+        if output == 'arena':
+            tree, roots = arena.build_tree(obj, self.text.string)
+            result = tuple(tree.node(i) for i in roots)
+        else:
+            obj = util.build_result(obj, self.text.string, output == 'compact')
+            result = obj.grammar_postprocess(None, data)
+            if self.index:
+                for r in result:
+                    if r is not None:
+                        r._tree_index = util.TreeIndex(r, build=(self.index is True))
         if len(result) == 1:
             result = result[0]
-        return (count, result)
-
-    def _parse_string(self, string, bol, eof, data, matchtype):
-        self.append(string, bol=bol, eof=eof)
-        pos = 0
+        return result
+
+    def _only_whitespace(self, string, pos):
+        # Is everything from pos to the end of string whitespace which this
+        # grammar would skip over?
+        whitespace_re = self.grammar.grammar_whitespace
+        if not whitespace_re:
+            return False
+        if whitespace_re is True:
+            whitespace_re = util._whitespace_re
+        if self.text.binary:
+            whitespace_re = util.binary_regexp(whitespace_re)
+        m = whitespace_re.match(string, pos)
+        return bool(m) and m.end() == len(string)
+
+    def _diagnose(self, pos, errpos, data):
+        # We were only keeping track of where the parse failed, not what was
+        # expected there.  Now that we know it did fail, parse the same text again
+        # to find out.
+        text = self.text
+        diag_text = Text(text.string, bol=text.bol, eof=text.eof)
+        diag_text.start = text.start
+        for count, obj in self._grammar_parse(diag_text, pos, data):
+            if count is False:
+                return obj
+            if count is None:
+                break
+        return (errpos, set())
+
+    def _parse_string(self, string, bol, eof, data, matchtype, defer=False, output=None):
+        self.append(string, bol=bol, eof=eof, defer=defer)
+        text = self.text
+        if defer and self.state[0] is not None and text.pending < len(text.string) - text.start:
+            # We're in the middle of an incomplete match.  Rather than re-joining
+            # the whole (possibly large) buffer for every new piece of text, wait
+            # until we've got at least as much new text as we had before.
+            return
         if data is None:
             data = self.sessiondata
 
         while True:
-            count, obj = self._parse(pos, data, matchtype)
+            pos = text.start
+            count, obj = self._parse(pos, data, matchtype, output)
             if count is None:
                 # Partial match
                 break
@@ -431,7 +694,7 @@ class GrammarParser(object):
                 # We matched a zero-length string.  If we keep looping, we'll just loop
                 # infinitely doing the same thing.  Best to stop now.
                 break
-            if not self.text.eof and pos == len(self.text.string):
+            if not text.eof and text.start == len(text.string):
                 # We've done all we can for now.
                 # Note: if we're at EOF, we loop one more time in case something wants
                 # to match the EOF, and then we'll break on either the error-on-EOF
@@ -442,6 +705,8 @@ class GrammarParser(object):
         """
         Attempt to match *string* against the associated grammar.  If successful, returns a corresponding match object.  If there is an incomplete match (or it is impossible to determine yet whether the match is complete or not), save the current text in the match buffer and return :const:`None` to indicate more text is required.  If the text does not match any valid grammar construction, raise :exc:`ParseError`.
 
+        *string* can also be a bytes-like object (:class:`bytes`, :class:`bytearray` or :class:`memoryview`), in which case the text is matched as bytes without being decoded first, and the :attr:`~Grammar.string` of each result is a :class:`bytes` slice of the input.  Each character in the grammar's literals, :func:`WORD` character sets and regular expressions stands for the byte with the same value (as in latin-1), so grammars written for ASCII text work the same way on bytes.  (Bytes and text input can't be mixed in the same parse, until the parser is :meth:`reset`.)
+
         Optional parameters:
           *reset*
             Call :meth:`reset` before starting to parse the supplied text.
@@ -489,30 +754,221 @@ class GrammarParser(object):
         if reset:
             self.reset()
         for line in lines:
-            for result in self._parse_string(line, bol, False, data, matchtype):
+            for result in self._parse_string(line, bol, False, data, matchtype, defer=True):
                 yield result
             bol = None
+        if self.text.pending:
+            for result in self._parse_string("", None, False, data, matchtype):
+                yield result
         if eof:
             for result in self._parse_string("", None, True, data, matchtype):
                 yield result
 
-    def parse_file(self, file, bol=False, eof=True, reset=False, data=None, matchtype='first'):
+    def parse_events(self, lines, handlers=None, bol=False, eof=True, reset=False, data=None, matchtype='first'):
+        """
+        Match a list (or any iterable) of strings against the associated grammar, in the same way as :meth:`parse_lines`, but instead of creating result objects for each match, generate a stream of parse events (in document order), as each match is completed.
+
+        Each event is a tuple of *(event, grammar, start, end, string)*.  *event* is ``"enter"`` or ``"exit"`` at the beginning and end of each (non-terminal) element of the parse tree, or ``"terminal"`` for terminals (see :attr:`~Grammar.grammar_terminal`), whose contents are not reported separately.  *grammar* is the grammar class of the element (so its :attr:`~Grammar.grammar_tags` are available as ``grammar.grammar_tags``), and *start*/*end* are its position in the input (counting from the beginning of parsing, or the last :meth:`reset`).  For terminals, *string* is the text which was matched (for other events, it is :const:`None`).  The events follow the structure of the tree the default :meth:`~Grammar.grammar_postprocess` would produce (including collapsing of elements), but no result objects are created, so custom :meth:`~Grammar.grammar_postprocess` and :meth:`~Grammar.elem_init` methods are not run.
+
+        If *handlers* is not provided, this returns an iterator over the events.  Otherwise, *handlers* should be a dictionary mapping grammar classes and/or tag names to callables.  All of the events are then dispatched to the handlers, as ``handler(event, grammar, start, end, string)``, for each handler which is for the element's grammar class (or a superclass of it), or for one of its tags.
+
+        Only the current match is kept in memory, so (as long as the grammar matches the input in many smaller pieces rather than one big one) memory usage does not depend on the size of the input.  Other optional parameters are the same as for :meth:`parse_lines` (except that *eof* defaults to :const:`True`).
+        """
+        events = self._parse_events(lines, bol, eof, reset, data, matchtype)
+        if handlers is None:
+            return events
+        dispatch = {}
+        for event in events:
+            grammar = event[1]
+            funcs = dispatch.get(id(grammar))
+            if funcs is None:
+                funcs = []
+                for key, func in handlers.items():
+                    if isinstance(key, GrammarClass):
+                        if issubclass(grammar, key):
+                            funcs.append(func)
+                    elif key in grammar.grammar_tags:
+                        funcs.append(func)
+                dispatch[id(grammar)] = funcs
+            for func in funcs:
+                func(*event)
+
+    def _parse_events(self, lines, bol, eof, reset, data, matchtype):
+        if reset:
+            self.reset()
+        for line in lines:
+            for events in self._parse_string(line, bol, False, data, matchtype, defer=True, output='events'):
+                for event in events:
+                    yield event
+            bol = None
+        if self.text.pending:
+            for events in self._parse_string("", None, False, data, matchtype, output='events'):
+                for event in events:
+                    yield event
+        if eof:
+            for events in self._parse_string("", None, True, data, matchtype, output='events'):
+                for event in events:
+                    yield event
+
+    def matches(self, string, full=False, bol=True, eof=True, data=None):
+        """
+        Check whether *string* matches the associated grammar, without creating any result objects (or calling :meth:`~Grammar.grammar_postprocess` or :meth:`~Grammar.elem_init`), and without keeping track of what was expected where (as with the *fast_errors* parser option).  This is much faster than :meth:`parse_string` for applications which only need to validate their input.
+
+        Returns the length of the first match found at the beginning of *string*, or :const:`None` if it does not match.  If *full* is set, returns :const:`True` if the grammar can match the whole of *string* (ignoring any trailing whitespace, if the grammar is whitespace-consuming), or :const:`False` if not.
+
+        This does not use or change the parser's buffer (or :attr:`char`, :attr:`line`, etc), so it can be called at any time.  *bol* and *eof* are the same as for :meth:`parse_string` (except that *eof* defaults to :const:`True`).  If *eof* is :const:`False` and the match is incomplete, the string is treated as not matching.
+        """
+        if data is None:
+            data = self.sessiondata
+        text = Text(string, bol=bol, eof=eof)
+        text.fast_errors = True
+        if self.memo is not None:
+            text.memo = util.ParseMemo(self.memo.max_entries, self.memo.max_bytes)
+            text.memo.data = data
+        for count, obj in self._grammar_parse(text, 0, data):
+            if count is False or count is None:
+                break
+            if not full:
+                return count
+            if count == len(string) or self._only_whitespace(string, count):
+                return True
+        if full:
+            return False
+        return None
+
+    def parse_file(self, file, bol=False, eof=True, reset=False, data=None, matchtype='first', chunk_size=None):
         """
         *(generator method)*
 
         Open and process the contents of a file using the associated grammar.  This is basically the same as opening the specified file, and passing the resulting file object to :meth:`parse_lines`.
 
+        If *chunk_size* is provided, the file is read in blocks of (up to) that many characters at a time, instead of one line at a time.  The results are the same either way (including the handling of :class:`BOL`, etc), but for large inputs (and particularly for grammars which match many lines at once), reading larger blocks means a lot less overhead in resuming the parse for each new piece of text.
+
         Return values, exceptions, and optional parameters are all exactly the same as for :meth:`parse_string`.
 
         Note: Be careful using ``matchtype="all"`` with parse_lines/parse_file.  You must manually call :func:`~GrammarParser.skip` after each yielded match, or you will end up with an infinite loop!
         """
         if isinstance(file, str):
             with open(file, "r") as f:
-                for result in self.parse_lines(f, bol=bol, eof=eof, reset=reset, data=data, matchtype=matchtype):
+                for result in self.parse_file(f, bol=bol, eof=eof, reset=reset, data=data, matchtype=matchtype,
+                                              chunk_size=chunk_size):
                     yield result
+            return
+        lines = file
+        if chunk_size:
+            lines = util.read_chunks(file, chunk_size)
+        for result in self.parse_lines(lines, bol=bol, eof=eof, reset=reset, data=data, matchtype=matchtype):
+            yield result
+
+    def parse_mmap(self, path, encoding="utf-8", errors="strict", chunk_size=1048576, bol=False, eof=True, reset=False,
+                   data=None, matchtype='first'):
+        """
+        *(generator method)*
+
+        Process the contents of the file *path* using the associated grammar, in the same way as :meth:`parse_file`, but by memory-mapping the file instead of reading it.  The file is decoded (using *encoding* and *errors*, as for :meth:`bytes.decode`) one block of *chunk_size* bytes at a time, as the parser gets to it, so the file is never read into memory all at once (multi-byte characters which are split across blocks are handled correctly).  If *encoding* is :const:`None`, the file is not decoded at all, and is parsed as bytes (see :attr:`Text.binary`).  Unlike :meth:`parse_file`, no newline translation is done on the text.
+
+        This is mainly useful for very large files: as long as the grammar matches the file in many smaller pieces (for example, using ``REPEAT(..., commit=True)``), only the text for the current match is kept in the parse buffer, and with ``output="compact"`` or :meth:`parse_events`-style processing, results refer to positions in the text instead of holding their own copies of it.
+
+        Return values, exceptions, and other optional parameters are all exactly the same as for :meth:`parse_file`.
+        """
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                # mmap can't map an empty file
+                buf = b""
+            else:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if encoding is None:
+                    lines = (buf[pos:pos + chunk_size] for pos in range(0, len(buf), chunk_size))
+                else:
+                    lines = util.decode_chunks(buf, encoding, errors, chunk_size)
+                for result in self.parse_lines(lines, bol=bol, eof=eof, reset=reset, data=data, matchtype=matchtype):
+                    yield result
+            finally:
+                if buf:
+                    buf.close()
+
+    def parse_file_parallel(self, path, boundary="\n", workers=None, shard_size=None, encoding="utf-8", errors="strict",
+                            bol=True, data=None):
+        """
+        *(generator method)*
+
+        Parse the file *path* using several processes at once, for files which are made up of many separate records (each of which matches the associated grammar).  The file is split into pieces (of roughly *shard_size* bytes, by default enough to give each worker several pieces) just after matches of the regular expression *boundary* (which should match the end of a record, and never anything in the middle of one).  The pieces are then parsed in a :class:`concurrent.futures.ProcessPoolExecutor` (or, under python 2, a :class:`multiprocessing.Pool`) with *workers* processes (by default, one per CPU), and the results are yielded in the same order they appear in the file.
+
+        *encoding* and *errors* are used to decode each piece (as for :meth:`bytes.decode`), or if *encoding* is :const:`None`, the file is parsed as bytes (see :meth:`parse_string`).  *boundary* is matched against the raw bytes of the file, so it should only match whole characters in the file's encoding (which is always true for ASCII delimiters in UTF-8 files).  *bol* is whether the beginning of the file is considered the beginning of a line (later pieces start at the beginning of a line if the previous one ended with a newline).
+
+        Each worker process parses its pieces with a new parser, created with the same options as this one (this parser's own buffer and positions are not used or changed).  The grammar, its results, and *data* (which is used as the session data, if provided) must all be picklable.  If the file doesn't match the grammar, all of the results up to the error are yielded, and then :exc:`ParseError` is raised, with its :attr:`~ParseError.char`, :attr:`~ParseError.line` and :attr:`~ParseError.col` counted from the beginning of the file (its :attr:`~ParseError.expected` is not available, but its message still lists what was expected).
+        """
+        import multiprocessing
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError:
+            # (Python 2 doesn't have concurrent.futures)
+            ProcessPoolExecutor = None
+
+        if isinstance(boundary, (str, bytes)):
+            boundary = re.compile(boundary)
+        boundary = util.binary_regexp(boundary)
+        if workers is None:
+            workers = getattr(os, "cpu_count", multiprocessing.cpu_count)() or 1
+        if shard_size is None:
+            shard_size = max(os.path.getsize(path) // (workers * 4), 65536)
+        if data is None:
+            data = self.sessiondata
+        options = dict(compiled=(self.program is not None), positions=self.positions, fast_errors=self.fast_errors,
+                       output=self.output, index=self.index)
+        if self.memo is not None:
+            options.update(memoize=True, memo_entries=self.memo.max_entries, memo_bytes=self.memo.max_bytes)
+        shards = util.find_shards(path, boundary, shard_size)
+        bols = [bol]
+        if len(shards) > 1:
+            with open(path, "rb") as f:
+                for start, end in shards[1:]:
+                    f.seek(start - 1)
+                    bols.append(f.read(1) == b"\n")
+        jobs = [(self.grammar, data, self.tabs, options, path, start, end, encoding, errors, shard_bol)
+                for (start, end), shard_bol in zip(shards, bols)]
+        char = line = col = 0
+        if ProcessPoolExecutor is not None:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            submit = lambda job: executor.submit(util.parse_shard, job).result
         else:
-            for result in self.parse_lines(file, bol=bol, eof=eof, reset=reset, data=data, matchtype=matchtype):
-                yield result
+            executor = multiprocessing.Pool(workers)
+            submit = lambda job: executor.apply_async(util.parse_shard, (job,)).get
+        try:
+            # Only keep a couple of pieces per worker in progress at once, so that
+            # (if we're being consumed slowly) finished results don't pile up.
+            jobs.reverse()
+            pending = collections.deque()
+            while jobs or pending:
+                while jobs and len(pending) < workers * 2:
+                    pending.append(submit(jobs.pop()))
+                results, error, length, lines, end_col = pending.popleft()()
+                for result in results:
+                    yield result
+                if error is not None:
+                    buf, buf_pos, err_char, err_line, err_col, message, prefix = error
+                    if not self.positions:
+                        err_line = err_col = None
+                    elif err_line == 0:
+                        err_col = util.advance_col(prefix, 0, len(prefix), col, self.tabs)
+                        err_line = line
+                    else:
+                        err_line += line
+                    raise ParseError(self.grammar, buf, buf_pos, char + err_char, err_line, err_col, message=message)
+                char += length
+                if lines:
+                    line += lines
+                    col = end_col
+                else:
+                    # (This is only approximate if there are tabs involved)
+                    col += end_col
+        finally:
+            if ProcessPoolExecutor is not None:
+                executor.shutdown()
+            else:
+                executor.terminate()
+                executor.join()
 
     def skip(self, count):
         """
@@ -520,20 +976,25 @@ class GrammarParser(object):
         """
 
         if count:
-            if count > len(self.text.string):
+            text = self.text
+            text.flush()
+            if count > len(text.string) - text.start:
                 raise ValueError("Attempt to skip past end of available buffer.")
                 # The state may contain index values in it, which will become invalid if
             # we change the starting point, so we (unfortunately) need to nuke it.
             self.state = (None, None)
+            if self.memo is not None:
+                self.memo.clear()
             self.char += count
-            self.line, self.col = util.calc_line_col(self.text.string, count, self.line, self.col, self.tabs)
-            self.text.skip(count)
+            text.skip(count)
+            if self.positions is True:
+                text.line_col(text.start, advance=True)
 
     def remainder(self):
         """
         Return the remaining contents of the parse buffer.  After parsing, this will contain whatever portion of the original text was not used by the parser up to this point.
         """
-        return self.text.string
+        return self.text.remainder()
 
 ###############################################################################
 #                            Base (public) Classes                            #
@@ -544,6 +1005,9 @@ if sys.version_info[0] < 3:
 else:
     from modgrammar.grammar_py3 import Grammar
 
+from modgrammar import arena
+from modgrammar.arena import load_tree
+
 class AnonGrammar(Grammar):
     grammar_whitespace = None
 
@@ -592,17 +1056,42 @@ class Literal(Terminal):
             cls.grammar_name = "L({0!r})".format(cls.string)
         if "grammar_desc" not in attrs:
             cls.grammar_desc = repr(cls.string)
+        try:
+            cls.binary_string = cls.string.encode("latin-1")
+        except UnicodeError:
+            cls.binary_string = None
 
     @classmethod
     def grammar_parse(cls, text, index, sessiondata):
-        while (len(cls.string) + index > len(text.string)) and cls.string.startswith(text.string[index:]):
+        string = cls.string
+        if text.binary:
+            string = cls.binary_string
+            if string is None:
+                # Can't be represented as bytes, so can't match bytes either.
+                yield util.error_result(index, cls, text)
+        end = index + len(string)
+        # 'pos' is how far into the text we've already checked, so that if the
+        # literal is split across several chunks of input, we only need to look
+        # at the new text each time.
+        pos = index
+        while end > len(text.string):
+            avail = len(text.string)
+            if not text.string.startswith(string[pos - index:avail - index], pos):
+                break
+            pos = avail
             if text.eof:
                 break
                 # Partial match.  Try again when we have more text.
             text = yield (None, None)
-        if text.string.startswith(cls.string, index):
-            yield (len(cls.string), cls(cls.string))
-        yield util.error_result(index, cls)
+        if text.string.startswith(string[pos - index:], pos):
+            yield (len(string), (cls, index, end, ()))
+        yield util.error_result(index, cls, text)
+
+    @classmethod
+    def grammar_first(cls, visited):
+        if not cls.string:
+            return ([], True)
+        return ([re.escape(cls.string[0])], False)
 
     @classmethod
     def grammar_ebnf_rhs(cls, opts):
@@ -646,10 +1135,14 @@ class ANY(Terminal):
         while index == len(text.string):
             # The only case we can't match is if there's no input
             if text.eof:
-                yield util.error_result(index, cls)
+                yield util.error_result(index, cls, text)
             text = yield (None, None)
-        yield (1, cls(text.string, index, index + 1))
-        yield util.error_result(index, cls)
+        yield (1, (cls, index, index + 1, ()))
+        yield util.error_result(index, cls, text)
+
+    @classmethod
+    def grammar_first(cls, visited):
+        return (None, False)
 
 
 class EMPTY(Terminal):
@@ -660,8 +1153,12 @@ class EMPTY(Terminal):
     @classmethod
     def grammar_parse(cls, text, index, sessiondata):
         # This always matches, no matter where it is.
-        yield (0, cls(""))
-        yield util.error_result(index, cls)
+        yield (0, (cls, index, index, ()))
+        yield util.error_result(index, cls, text)
+
+    @classmethod
+    def grammar_first(cls, visited):
+        return ([], True)
 
     @classmethod
     def grammar_ebnf_lhs(cls, opts):
@@ -703,9 +1200,43 @@ class OR_Operator(Grammar):
 
     @classmethod
     def grammar_parse(cls, text, index, sessiondata):
+        grammar = cls.grammar
+        trie = cls.grammar_literal_trie(text.binary)
+        if trie is not None:
+            # All of our alternatives are plain literals, so we can check all of
+            # them in one pass instead of trying them one at a time.
+            next_alt = 0
+            while True:
+                matched, partial = trie.match(text.string, index, text.eof)
+                wait = False
+                for i in sorted(matched + partial):
+                    if i < next_alt:
+                        continue
+                    if i in partial:
+                        # Partial match.  Try again when we have more text.
+                        wait = True
+                        break
+                    g = grammar[i]
+                    next_alt = i + 1
+                    yield (len(g.string), (g, index, index + len(g.string), ()))
+                    # If we get backtracked into, more text may have arrived (or
+                    # we may be at EOF now), so the rest have to be checked again.
+                    break
+                else:
+                    break
+                if wait:
+                    text = yield (None, None)
+            yield util.error_result(index, None if text.fast_errors else set(grammar))
+            return
         best_error = None
-        for g in cls.grammar:
-            results = g.grammar_parse(text, index, sessiondata)
+        order, remaining = cls.grammar_alternatives(text, index)
+        for i in order:
+            if remaining <= 0 and best_error is not None and best_error[0] != index:
+                # The rest can only fail at index, which won't change our error.
+                break
+            remaining -= 1
+            g = grammar[i]
+            results = util.subparse(g, text, index, sessiondata)
             for count, obj in results:
                 while count is None:
                     if text.eof:
@@ -719,6 +1250,70 @@ class OR_Operator(Grammar):
                 yield (count, obj)
         yield util.error_result(*best_error)
 
+    @classmethod
+    def grammar_literal_trie(cls, binary=False):
+        """
+        If all of our alternatives are simple :func:`LITERAL` grammars, return a :class:`~modgrammar.util.LiteralTrie` of their strings (which :meth:`grammar_parse` uses to match them all at once).  Otherwise, return :const:`None`.  If *binary* is set, the trie is for matching bytes-mode text instead.
+        """
+        grammar = cls.grammar
+        cached = cls.__dict__.get('_literal_trie')
+        if cached is None or cached[0] is not grammar:
+            trie = binary_trie = None
+            if grammar and all(g.grammar_parse.__func__ is Literal.grammar_parse.__func__ for g in grammar):
+                trie = util.LiteralTrie([g.string for g in grammar])
+                if all(g.binary_string is not None for g in grammar):
+                    binary_trie = util.LiteralTrie([g.binary_string for g in grammar])
+            cached = (grammar, trie, binary_trie)
+            cls._literal_trie = cached
+        return cached[2 if binary else 1]
+
+    @classmethod
+    def grammar_alternatives(cls, text, index):
+        """
+        Work out which of our alternatives could possibly match at *index*, based on the next character of the text and the :meth:`~Grammar.grammar_first` sets of the alternatives.
+
+        Returns a tuple *(order, count)*, where *order* is a list of indexes into :attr:`grammar` and only the first *count* of them can possibly match.  The rest are guaranteed to fail at *index*, so they only need to be tried (to collect their error information) if nothing else has failed any further along.
+        """
+        grammar = cls.grammar
+        if index >= len(text.string):
+            return (range(len(grammar)), len(grammar))
+        dispatch = cls.__dict__.get('_dispatch')
+        if dispatch is None or dispatch[0] is not grammar:
+            tests = []
+            for g in grammar:
+                chars, nullable = util.first_set(g)
+                if chars is None or nullable:
+                    tests.append(None)
+                else:
+                    tests.append(re.compile("|".join(chars)).match)
+            dispatch = (grammar, tests, {})
+            cls._dispatch = dispatch
+        char = text.string[index]
+        if text.binary:
+            char = chr(char)
+        result = dispatch[2].get(char)
+        if result is None:
+            tests = dispatch[1]
+            order = [i for i, test in enumerate(tests) if test is None or test(char)]
+            count = len(order)
+            order.extend(i for i, test in enumerate(tests) if not (test is None or test(char)))
+            result = (order, count)
+            dispatch[2][char] = result
+        return result
+
+    @classmethod
+    def grammar_first(cls, visited):
+        chars = []
+        nullable = False
+        for g in cls.grammar:
+            sub_chars, sub_nullable = util.first_set(g, visited)
+            if sub_chars is None or chars is None:
+                chars = None
+            else:
+                chars.extend(sub_chars)
+            nullable = nullable or sub_nullable
+        return (chars, nullable)
+
     @classmethod
     def grammar_OR_merge(cls):
         return cls.grammar
@@ -766,7 +1361,7 @@ class NotFollowedBy(Grammar):
     def grammar_parse(cls, text, index, sessiondata):
         best_error = None
         g = cls.grammar[0]
-        results = g.grammar_parse(text, index, sessiondata)
+        results = util.subparse(g, text, index, sessiondata)
         count, obj = next(results)
         while count is None:
             if text.eof:
@@ -777,10 +1372,15 @@ class NotFollowedBy(Grammar):
         if count is not False:
             # The subgrammar matched.  That means we should consider this a parse
             # error.
-            yield util.error_result(index, cls)
+            yield util.error_result(index, cls, text)
         else:
             # Subgrammar did not match.  Return a (successful) None match.
-            yield (0, cls(''))
+            yield (0, (cls, index, index, ()))
+            yield util.error_result(index, cls, text)
+
+    @classmethod
+    def grammar_first(cls, visited):
+        return ([], True)
 
     @classmethod
     def grammar_details(cls, depth=-1, visited=None):
@@ -804,6 +1404,55 @@ class NotFollowedBy(Grammar):
         return None
 
 
+def ATOMIC(*grammar, **kwargs):
+    """
+    Match *grammar* as an "atomic group".  The first successful match of *grammar* is used, and if something after it fails to match, the parser will not backtrack into *grammar* to try to find another way to match it (the whole atomic group fails instead).  This can make parsing faster (and use less memory) when it's known that other ways of matching *grammar* could not lead to a successful parse anyway.
+
+    This element does not appear in the parse tree itself.  It is replaced by the result of *grammar* (the same as would be produced by ``GRAMMAR(*grammar)``).
+    """
+    cdict = util.make_classdict(Atomic, grammar, kwargs)
+    return GrammarClass("<ATOMIC>", (Atomic,), cdict)
+
+
+class Atomic(Grammar):
+    grammar_whitespace = False
+    grammar_collapse = True
+    grammar_possessive = True
+
+    @classmethod
+    def __class_init__(cls, attrs):
+        if not cls.grammar:
+            cls.grammar = (EMPTY,)
+        else:
+            cls.grammar = (GRAMMAR(cls.grammar),)
+        cls.grammar_min = cls.grammar_max = 1
+
+    @classmethod
+    def grammar_details(cls, depth=-1, visited=None):
+        if not visited:
+            visited = (cls,)
+        elif cls in visited:
+            # Circular reference.  Stop here.
+            return cls.grammar_name
+        else:
+            visited = visited + (cls,)
+        sub = cls.grammar[0]
+        if sub.grammar_name == "<GRAMMAR>":
+            details = ", ".join(g.grammar_details(depth, visited) for g in sub.grammar)
+        else:
+            details = sub.grammar_details(depth, visited)
+        return "ATOMIC({0})".format(details)
+
+    @classmethod
+    def grammar_ebnf_lhs(cls, opts):
+        names, nts = util.get_ebnf_names(cls.grammar, opts)
+        return (names[0], nts)
+
+    @classmethod
+    def grammar_ebnf_rhs(cls, opts):
+        return None
+
+
 def EXCEPT(grammar, exc_grammar, **kwargs):
     """
     Match *grammar*, but only if it does not also match *exception_grammar*.  (This is equivalent to the ``-`` (exception) operator in EBNF) :func:`EXCEPT` grammars can also be created by combining other grammars in python expressions using the except operator (``-``).
@@ -827,7 +1476,7 @@ class ExceptionGrammar(Grammar):
         best_error = None
         g = cls.grammar[0]
         exc = cls.grammar[1]
-        results = g.grammar_parse(text, index, sessiondata)
+        results = util.subparse(g, text, index, sessiondata)
         for count, obj in results:
             while count is None:
                 if text.eof:
@@ -841,6 +1490,8 @@ class ExceptionGrammar(Grammar):
                 # We found one, but now we need to check to make sure that the
             # exception-grammar does NOT match the same part of the text string.
             exc_text = Text(text.string[:index + count], bol=text.bol, eof=True)
+            exc_text.start = text.start
+            exc_text.fast_errors = text.fast_errors
             found = False
             for e_count, e_obj in exc.grammar_parse(exc_text, index, sessiondata):
                 if e_count is None:
@@ -859,10 +1510,14 @@ class ExceptionGrammar(Grammar):
         # position) return ourselves as the error object, so at least it will be
         # obvious there were extra conditions on the match that weren't fulfilled.
         if best_error[0] == index:
-            yield util.error_result(index, cls)
+            yield util.error_result(index, cls, text)
         else:
             yield util.error_result(*best_error)
 
+    @classmethod
+    def grammar_first(cls, visited):
+        return util.first_set(cls.grammar[0], visited)
+
     @classmethod
     def grammar_details(cls, depth=-1, visited=None):
         if not depth:
@@ -882,6 +1537,10 @@ class ExceptionGrammar(Grammar):
 def REPEAT(*grammar, **kwargs):
     """
     Match (by default) one-or-more repetitions of *grammar*, one right after another.  If the *min* or *max* keyword parameters are provided, the number of matches can be restricted to a particular range.
+
+    If the *possessive* keyword parameter is :const:`True`, the repetition will only ever produce the first match it finds (normally the longest one), and will not backtrack to try fewer repetitions (or other ways of matching each one) if something after it fails to match.  This also means it does not need to keep track of how to backtrack into each of the repetitions it has matched, which can save a lot of memory for very long repetitions.  (See also :func:`ATOMIC`.)
+
+    If the *commit* keyword parameter is :const:`True`, the repetition is possessive, and in addition, if it is the top-level grammar being parsed, the parser will return each repetition as a separate result as soon as it has been matched (discarding the text for it from the input buffer), instead of waiting for the whole repetition to finish.  This also applies if the top-level grammar is just a wrapper around the repetition, with nothing else in it (for example, ``class File(Grammar): grammar = REPEAT(Record, commit=True)``), in which case no result is produced for the wrapper itself.  Anywhere else, *commit* only makes the repetition possessive.  This allows very large inputs (for example, a file made up of many records) to be parsed with :meth:`GrammarParser.parse_file` or :meth:`GrammarParser.parse_lines` using a bounded amount of memory.  (For :func:`LIST_OF`, the separators are not included in the results.)
     """
     cdict = util.make_classdict(Repetition, grammar, kwargs)
     return GrammarClass("<REPEAT>", (Repetition,), cdict)
@@ -893,6 +1552,8 @@ class Repetition(Grammar):
     grammar_min = 1
     grammar_max = None
     grammar_whitespace = None
+    grammar_commit = False
+    grammar_hashattrs = Grammar.grammar_hashattrs + ('grammar_commit',)
 
     @classmethod
     def __class_init__(cls, attrs):
@@ -906,6 +1567,8 @@ class Repetition(Grammar):
         elif not cls.grammar_max:
             cls.grammar_max = sys.maxsize
         cls.grammar = util.RepeatingTuple(grammar, grammar, len=cls.grammar_max)
+        if cls.grammar_commit:
+            cls.grammar_possessive = True
 
     @classmethod
     def grammar_details(cls, depth=-1, visited=None):
@@ -921,6 +1584,10 @@ class Repetition(Grammar):
                 params += ", max={0}".format(cls.grammar_max)
         if cls.grammar_collapse:
             params += ", collapse=True"
+        if cls.grammar_commit:
+            params += ", commit=True"
+        elif cls.grammar_possessive:
+            params += ", possessive=True"
         return "REPEAT({0}{1})".format(cls.grammar[0].grammar_details(depth, visited), params)
 
     @classmethod
@@ -976,6 +1643,7 @@ def WORD(startchars, restchars=None, **kwargs):
 class Word(Terminal):
     startchars = ""
     restchars = None
+    restregexp = None
     grammar_count = None
     grammar_min = 1
     grammar_max = None
@@ -999,6 +1667,8 @@ class Word(Terminal):
         if cls.grammar_min < 1:
             regexp = "({0})?".format(regexp)
         cls.regexp = re.compile(regexp)
+        if restchars:
+            cls.restregexp = re.compile("[{0}]*".format(restchars))
         if "grammar_name" not in attrs:
             if cls.restchars is None:
                 argspec = repr(startchars)
@@ -1028,26 +1698,48 @@ class Word(Terminal):
     def grammar_parse(cls, text, index, sessiondata):
         greedy = cls.grammar_greedy
         returned = cls.grammar_min - 1
+        limit = index + cls.grammar_max if cls.grammar_max else None
+        end = index
+        regexp = cls.regexp
+        restregexp = cls.restregexp
+        if text.binary:
+            regexp = util.binary_regexp(regexp)
+            if restregexp is not None:
+                restregexp = util.binary_regexp(restregexp)
         while True:
             string = text.string
-            m = cls.regexp.match(string, index)
-            if not m:
-                yield util.error_result(index, cls)
-            end = m.end()
+            if end > index and restregexp is not None:
+                # We're continuing a match which ran up to the end of the text we had
+                # before, so just carry on from there instead of starting over.
+                end = restregexp.match(string, end, limit or len(string)).end()
+            else:
+                m = regexp.match(string, index)
+                if not m:
+                    if index == len(string) and not text.eof:
+                        # We can't tell whether there's a match here until we see the next
+                        # character.
+                        text = yield (None, None)
+                        continue
+                    yield util.error_result(index, cls, text)
+                end = m.end()
             matchlen = end - index
             if not greedy:
                 while returned < matchlen:
                     returned += 1
-                    yield (returned, cls(string, index, index + returned))
+                    yield (returned, (cls, index, index + returned, ()))
             if end < len(string) or matchlen == cls.grammar_max or text.eof:
                 break
                 # We need more text before we can be sure we"re at the end.
             text = yield (None, None)
         if greedy:
             while matchlen >= cls.grammar_min:
-                yield (matchlen, cls(string, index, index + matchlen))
+                yield (matchlen, (cls, index, index + matchlen, ()))
                 matchlen -= 1
-        yield util.error_result(index, cls)
+        yield util.error_result(index, cls, text)
+
+    @classmethod
+    def grammar_first(cls, visited):
+        return util.regex_first(cls.regexp)
 
     @classmethod
     def grammar_ebnf_lhs(cls, opts):
@@ -1122,7 +1814,12 @@ class Reference(Grammar):
 
     @classmethod
     def grammar_parse(cls, text, index, sessiondata):
-        state = cls.resolve(sessiondata).grammar_parse(text, index, sessiondata)
+        memo = text.memo
+        if memo is None:
+            g = cls.resolve(sessiondata)
+        else:
+            g = memo.resolve(cls, sessiondata)
+        state = util.subparse(g, text, index, sessiondata)
         text = yield next(state)
         while True:
             text = yield state.send(text)
@@ -1153,6 +1850,8 @@ def LIST_OF(*grammar, **kwargs):
     Match a list consisting of repetitions of *grammar* separated by *sep*.  As with other repetition grammars, the *min* and *max* keywords can also be used to restrict the number of matches to a certain range.
 
     Note: Although this is most commonly used with a literal separator (such as the default ``","``), actually any (arbitrarily-complex) subgrammar can be specified for *sep* if desired.
+
+    The *possessive* and *commit* keywords work the same way as for :func:`REPEAT`.
     """
     cdict = util.make_classdict(ListRepetition, grammar, kwargs)
     return GrammarClass("<LIST>", (ListRepetition,), cdict)
@@ -1183,6 +1882,10 @@ class ListRepetition(Repetition):
                 params += ", max={0}".format(cls.grammar_max)
         if cls.grammar_collapse:
             params += ", collapse=True"
+        if cls.grammar_commit:
+            params += ", commit=True"
+        elif cls.grammar_possessive:
+            params += ", possessive=True"
         return "LIST_OF({0}, sep={1}{2})".format(cls.grammar[0].grammar_details(depth, visited),
             cls.sep.grammar_details(depth, visited), params)
 
@@ -1245,12 +1948,16 @@ class BOL(Terminal):
 
     @classmethod
     def grammar_parse(cls, text, index, sessiondata):
-        if index:
-            if text.string[index - 1] in ("\n", "\r"):
-                yield (0, cls(""))
+        if index > text.start:
+            if text.string[index - 1] in ("\n", "\r", 10, 13):
+                yield (0, (cls, index, index, ()))
         elif text.bol:
-            yield (0, cls(""))
-        yield util.error_result(index, cls)
+            yield (0, (cls, index, index, ()))
+        yield util.error_result(index, cls, text)
+
+    @classmethod
+    def grammar_first(cls, visited):
+        return ([], True)
 
 
 class EOF(Terminal):
@@ -1259,8 +1966,12 @@ class EOF(Terminal):
     @classmethod
     def grammar_parse(cls, text, index, sessiondata):
         if text.eof and index == len(text.string):
-            yield (0, cls(""))
-        yield util.error_result(index, cls)
+            yield (0, (cls, index, index, ()))
+        yield util.error_result(index, cls, text)
+
+    @classmethod
+    def grammar_first(cls, visited):
+        return ([], True)
 
 
 class EOL(Terminal):
@@ -1272,6 +1983,7 @@ class EOL(Terminal):
 class SPACE(Word):
     grammar_desc = "whitespace"
     regexp = re.compile("[\s]+")
+    restregexp = re.compile("[\s]*")
 
     @classmethod
     def __class_init__(cls, attrs):
@@ -0,0 +1,679 @@
+"""
+A compact, array-based representation of parse trees, used when parsing with ``output="arena"``.
+
+Instead of creating a python object for every node of the parse tree, an :class:`ArenaTree` stores the whole tree as a handful of parallel arrays (one entry per node, in document order), plus a single copy of the source text.  The arrays support the buffer protocol, so they can be handed straight to vectorized code (for example, ``numpy.asarray(tree.start)``) to scan very large trees.
+
+For convenience, :class:`ArenaNode` objects provide a lightweight view of a single node, with the same query methods as normal result objects (:meth:`~modgrammar.Grammar.get`, :meth:`~modgrammar.Grammar.find_all`, :meth:`~modgrammar.Grammar.terminals`, etc).  These are only created when asked for, and are not kept by the tree.
+
+Arena trees have the same shape as the trees produced by the default :meth:`~modgrammar.Grammar.grammar_postprocess` (including collapsing of :attr:`~modgrammar.Grammar.grammar_collapse` grammars), but since no result objects are ever created, custom :meth:`~modgrammar.Grammar.grammar_postprocess` and :meth:`~modgrammar.Grammar.elem_init` methods are not called.
+"""
+
+import io
+import mmap
+import pickle
+from array import array
+
+import modgrammar
+from modgrammar import util
+
+try:
+    array('q')
+    _POS_TYPE = 'q'
+except ValueError:
+    _POS_TYPE = 'l'
+
+
+class ArenaTree(object):
+    """
+    A parse tree stored as parallel arrays.  Node 0 is the first top-level node, and each node's descendants directly follow it.
+
+    .. attribute:: source
+
+       The text which was parsed.  All node positions are indexes into this string.
+
+    .. attribute:: grammars
+
+       The list of grammar classes used by nodes in this tree.  (The *gid* of a node is an index into this list.)
+
+    .. attribute:: gid
+                   start
+                   end
+                   parent
+                   first_child
+                   next_sibling
+
+       Arrays with one entry for each node: the index of its grammar class in :attr:`grammars`, its start and end positions in :attr:`source`, and the indexes of its parent, its first child, and its next sibling (or -1 if there are none).  Placeholder nodes for :const:`None` elements (i.e. empty :func:`~modgrammar.OPTIONAL` matches) have a *gid* of -1.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.grammars = []
+        self.gids = {}
+        self.gid = array('i')
+        self.start = array(_POS_TYPE)
+        self.end = array(_POS_TYPE)
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+
+    def __len__(self):
+        return len(self.gid)
+
+    def node(self, index):
+        """
+        Return an :class:`ArenaNode` for the node at *index* (or :const:`None` for a placeholder node).
+        """
+        if self.gid[index] < 0:
+            return None
+        return ArenaNode(self, index)
+
+    def grammar_ids(self, func, arg):
+        # The set of gids of all of our grammars for which func(grammar, arg) is
+        # true.
+        return frozenset(i for i, g in enumerate(self.grammars) if func(g, arg))
+
+    def children(self, index):
+        """
+        Iterate over the indexes of the children of the node at *index*.
+        """
+        next_sibling = self.next_sibling
+        c = self.first_child[index]
+        while c >= 0:
+            yield c
+            c = next_sibling[c]
+
+    def add_node(self, grammar, start, end, parent, prev):
+        # Appends a node, and returns its index.  prev is the index of the
+        # previous sibling (or -1)
+        index = len(self.gid)
+        if grammar is None:
+            gid = -1
+        else:
+            gid = self.gids.get(id(grammar))
+            if gid is None:
+                gid = self.gids[id(grammar)] = len(self.grammars)
+                self.grammars.append(grammar)
+        self.gid.append(gid)
+        self.start.append(start)
+        self.end.append(end)
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        if prev >= 0:
+            self.next_sibling[prev] = index
+        elif parent >= 0:
+            self.first_child[parent] = index
+        return index
+
+
+class ArenaNode(object):
+    """
+    A view of a single node of an :class:`ArenaTree`.  This supports most of the same attributes and query methods as a normal result object (:attr:`string`, :attr:`elements`, :attr:`parent`, :meth:`get`, :meth:`find_all`, :meth:`find_tag_all`, :meth:`terminals`, etc).  The node's :attr:`__class__` is its grammar class, so :func:`isinstance` checks work the same way, too (though :func:`type` will still return :class:`ArenaNode`).
+    """
+
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def __class__(self):
+        # Makes isinstance() checks against grammar classes work the same as they
+        # do for normal result objects.
+        return self.tree.grammars[self.tree.gid[self.index]]
+
+    @property
+    def start(self):
+        return self.tree.start[self.index]
+
+    @property
+    def end(self):
+        return self.tree.end[self.index]
+
+    @property
+    def string(self):
+        tree = self.tree
+        return tree.source[tree.start[self.index]:tree.end[self.index]]
+
+    @property
+    def elements(self):
+        tree = self.tree
+        return tuple(tree.node(c) for c in tree.children(self.index))
+
+    @property
+    def parent(self):
+        p = self.tree.parent[self.index]
+        if p < 0:
+            return None
+        return ArenaNode(self.tree, p)
+
+    def get_all(self, *type_path):
+        return list(self._search(issubclass, False, type_path))
+
+    def get(self, *type_path):
+        return next(self._search(issubclass, False, type_path), None)
+
+    def find_all(self, *type_path):
+        return list(self._search(issubclass, True, type_path))
+
+    def find(self, *type_path):
+        return next(self._search(issubclass, True, type_path), None)
+
+    def find_tag_all(self, *tag_path):
+        return list(self._search(_has_tag, True, tag_path))
+
+    def find_tag(self, *tag_path):
+        return next(self._search(_has_tag, True, tag_path), None)
+
+    def _search(self, func, skip, args):
+        # Works the same way as Grammar._search, but checking grammar ids
+        # instead of objects.
+        tree = self.tree
+        gid = tree.gid
+        matchers = [tree.grammar_ids(func, a) for a in args]
+        last = len(matchers) - 1
+        stack = [(tree.children(self.index), 0)]
+        while stack:
+            children, depth = stack[-1]
+            c = next(children, None)
+            if c is None:
+                stack.pop()
+                continue
+            g = gid[c]
+            if g < 0:
+                continue
+            if g in matchers[depth]:
+                if depth < last:
+                    stack.append((tree.children(c), depth + 1))
+                else:
+                    yield ArenaNode(tree, c)
+            elif skip:
+                stack.append((tree.children(c), depth))
+
+    def iter_terminals(self):
+        tree = self.tree
+        gid = tree.gid
+        grammars = tree.grammars
+        stack = [self.index]
+        while stack:
+            i = stack.pop()
+            g = gid[i]
+            if g < 0:
+                continue
+            if grammars[g].grammar_terminal:
+                yield ArenaNode(tree, i)
+            else:
+                stack.extend(reversed(list(tree.children(i))))
+
+    def terminals(self):
+        return list(self.iter_terminals())
+
+    def iter_tokens(self):
+        for e in self.iter_terminals():
+            yield e.string
+
+    def dump_tree(self, fp, grammar=None):
+        dump_tree(self, fp, grammar)
+
+    def tokens(self):
+        return [e.string for e in self.iter_terminals()]
+
+    def __getitem__(self, index):
+        return self.elements[index]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __bool__(self):
+        return (self.tree.first_child[self.index] >= 0) or bool(self.__class__.grammar_terminal)
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if not isinstance(other, ArenaNode):
+            return NotImplemented
+        return self.tree is other.tree and self.index == other.index
+
+    def __ne__(self, other):
+        if not isinstance(other, ArenaNode):
+            return NotImplemented
+        return not (self.tree is other.tree and self.index == other.index)
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __str__(self):
+        string = self.string
+        if isinstance(string, bytes):
+            return string.decode("latin-1")
+        return string
+
+    def __repr__(self):
+        details = [repr(str(e) if e is not None else e) for e in self.elements]
+        if not details:
+            details = (repr(self.string),)
+        return "{0}<{1}>".format(self.__class__.grammar_name, ", ".join(details))
+
+
+def _has_tag(grammar, tag):
+    return tag in getattr(grammar, "grammar_tags", ())
+
+
+def build_tree(match, string):
+    """
+    Build an :class:`ArenaTree` from a match yielded by :meth:`~modgrammar.Grammar.grammar_parse` (see :func:`modgrammar.util.build_result`), following the same collapsing rules as :meth:`~modgrammar.Grammar.grammar_postprocess`.  Returns the tree, and a list of the indexes of the top-level nodes.
+    """
+    tree = ArenaTree(string)
+    roots = []
+    # Each stack entry is (match, parent index).  Entries are pushed in reverse
+    # order, so that nodes are added in document order.
+    stack = [(match, -1)]
+    last_child = {}
+    while stack:
+        m, parent = stack.pop()
+        prev = last_child.get(parent, -1)
+        pos = tree.end[prev] if prev >= 0 else (tree.start[parent] if parent >= 0 else 0)
+        if m is None:
+            grammar = None
+            start = end = pos
+            elems = ()
+        else:
+            grammar, start, end, elems, collapse = util.match_shape(m, string, pos)
+            if collapse:
+                for e in reversed(elems):
+                    stack.append((e, parent))
+                continue
+        index = tree.add_node(grammar, start, end, parent, prev)
+        last_child[parent] = index
+        if parent < 0:
+            roots.append(index)
+        for e in reversed(elems):
+            stack.append((e, index))
+    return tree, roots
+
+
+###############################################################################
+#                             Stored parse trees                              #
+###############################################################################
+
+# The format written by dump_tree is:
+#
+#   magic, flags (1 = the source is bytes),
+#   number of grammar classes, and for each one: either the (1-based) index of
+#     the class in grammar_classes(grammar), followed by its grammar_name (to
+#     check that the grammar given to load_tree matches), or 0, followed by
+#     the pickled class (for anything that couldn't be found that way),
+#   length of the source text (encoded as UTF-8, unless it's bytes), and the
+#     source itself,
+#   the root node.
+#
+# Each node is (gid + 1) << 1 | has_gap, the gap between the end of the
+# previous sibling (or the start of the parent) and the start of the node (if
+# has_gap is set), the length of the node, and the total size (in bytes) of
+# all of the node's children, followed by the children.  (Because we know how
+# big each subtree is, nodes can be skipped over without decoding them.)
+# Placeholders for None elements are just a single 0.  All numbers, including
+# lengths, are unsigned LEB128 varints.
+
+_MAGIC = b"MGTREE\x01\n"
+
+
+def _put_varint(out, n):
+    while n > 127:
+        out.append((n & 127) | 128)
+        n >>= 7
+    out.append(n)
+
+
+def _varint_len(n):
+    return (n.bit_length() + 6) // 7 or 1
+
+
+def _get_varint(buf, pos):
+    b = buf[pos]
+    if b < 128:
+        return b, pos + 1
+    result = b & 127
+    shift = 7
+    while True:
+        pos += 1
+        b = buf[pos]
+        result |= (b & 127) << shift
+        if b < 128:
+            return result, pos + 1
+        shift += 7
+
+
+def grammar_classes(grammar):
+    """
+    Return a list of all of the grammar classes which can be reached from *grammar* (including *grammar* itself, and the targets of any :func:`~modgrammar.REF` grammars which can be resolved without any *sessiondata*), in a fixed order.  This is used by :func:`dump_tree` and :func:`load_tree` to identify grammar classes by number.
+    """
+    found = []
+    seen = set()
+    stack = [grammar]
+    while stack:
+        g = stack.pop()
+        if g is None or id(g) in seen:
+            continue
+        seen.add(id(g))
+        found.append(g)
+        if issubclass(g, modgrammar.Reference):
+            try:
+                stack.append(g.resolve())
+            except modgrammar.ReferenceError:
+                pass
+        sub = g.grammar
+        if isinstance(sub, util.RepeatingTuple):
+            sub = tuple(tuple.__iter__(sub))
+        stack.extend(reversed(sub))
+    return found
+
+
+def _result_grammar(cls):
+    # The grammar class of a result object's class (which, for output="compact"
+    # results, is the base class of the object's actual class).
+    base = cls.__bases__[0] if cls.__bases__ else None
+    if base is not None and base.__dict__.get('_compact_class') is cls:
+        return base
+    return cls
+
+
+def dump_tree(node, fp, grammar=None):
+    """
+    Write the parse tree starting at *node* (a result object of any kind: normal, compact, an :class:`ArenaNode` or a :class:`StoredNode`) to the binary file object *fp* (or the file named *fp*), in a compact binary format which can be read back with :func:`load_tree`.  The source text is written only once, and each node just records which grammar class it is, and where it is in the source text (as variable-length numbers).  Grammar classes are stored as their position in :func:`grammar_classes` of *grammar* (which defaults to the class of *node*), so the same grammar has to be given to :func:`load_tree` to load the tree again.  (Classes which are not part of *grammar* are pickled instead, and :func:`load_tree` only loads those if its *allow_pickle* parameter is set.)
+
+    Only the structure of the tree is saved: as with ``output="arena"`` trees, any other attributes of the result objects (such as ones set by custom :meth:`~modgrammar.Grammar.elem_init` methods) are not.  Normal result objects don't know where they are in the source text, so their positions are worked out by finding each element's string in its parent's.
+    """
+    if isinstance(fp, (str, util.text_type)):
+        with open(fp, "wb") as f:
+            return dump_tree(node, f, grammar)
+    if grammar is None:
+        grammar = _result_grammar(node.__class__)
+    source = node.string
+    binary = not isinstance(source, util.text_type)
+    positioned = isinstance(node, ArenaNode) or _result_grammar(node.__class__) is not node.__class__
+    base = node.start if positioned else 0
+
+    gids = {}
+    grammars = []
+    codes = []
+    gaps = []
+    lengths = []
+    parents = []
+    ends = []
+    # The position each node's next child starts from
+    cursor = []
+    stack = [(node, -1)]
+    while stack:
+        e, parent = stack.pop()
+        i = len(codes)
+        parents.append(parent)
+        pos = cursor[parent] if parent >= 0 else 0
+        if e is None:
+            codes.append(0)
+            gaps.append(0)
+            lengths.append(0)
+            ends.append(pos)
+            cursor.append(pos)
+            continue
+        cls = _result_grammar(e.__class__)
+        gid = gids.get(id(cls))
+        if gid is None:
+            gid = gids[id(cls)] = len(grammars)
+            grammars.append(cls)
+        if positioned:
+            start = e.start - base
+            end = e.end - base
+        else:
+            string = e.string
+            start = source.find(string, pos, ends[parent] if parent >= 0 else len(source))
+            if start < 0:
+                raise ValueError("Unable to find {0!r} in the source text of its parent.".format(string))
+            end = start + len(string)
+        gap = start - pos
+        codes.append((gid + 1) << 1 | (gap != 0))
+        gaps.append(gap)
+        lengths.append(end - start)
+        ends.append(end)
+        cursor.append(start)
+        if parent >= 0:
+            cursor[parent] = end
+        stack.extend((c, i) for c in reversed(e.elements))
+
+    # Work out the size of every subtree, from the bottom up.
+    sizes = [0] * len(codes)
+    for i in range(len(codes) - 1, -1, -1):
+        code = codes[i]
+        if code:
+            total = _varint_len(code) + _varint_len(lengths[i]) + _varint_len(sizes[i]) + sizes[i]
+            if code & 1:
+                total += _varint_len(gaps[i])
+        else:
+            total = 1
+        if parents[i] >= 0:
+            sizes[parents[i]] += total
+
+    out = bytearray(_MAGIC)
+    _put_varint(out, 1 if binary else 0)
+    index = dict((id(g), i) for i, g in enumerate(grammar_classes(grammar)))
+    _put_varint(out, len(grammars))
+    for cls in grammars:
+        i = index.get(id(cls))
+        if i is None:
+            data = pickle.dumps(cls, pickle.HIGHEST_PROTOCOL)
+            _put_varint(out, 0)
+        else:
+            data = cls.grammar_name.encode("utf-8")
+            _put_varint(out, i + 1)
+        _put_varint(out, len(data))
+        out += data
+    if not binary:
+        source = source.encode("utf-8", "surrogatepass")
+    _put_varint(out, len(source))
+    fp.write(out)
+    fp.write(source)
+    out = bytearray()
+    for i, code in enumerate(codes):
+        _put_varint(out, code)
+        if code:
+            if code & 1:
+                _put_varint(out, gaps[i])
+            _put_varint(out, lengths[i])
+            _put_varint(out, sizes[i])
+    fp.write(out)
+
+
+def load_tree(fp, grammar, allow_pickle=False):
+    """
+    Read a parse tree written by :func:`dump_tree` from the binary file object *fp* (or the file named by the text string *fp*, or a bytes-like object), and return a :class:`StoredNode` for its root.  *grammar* must be the grammar the tree was dumped with.
+
+    Grammar classes which were not part of the grammar given to :func:`dump_tree` are stored pickled, and are only loaded if *allow_pickle* is set (otherwise :exc:`ValueError` is raised).  Unpickling data can run arbitrary code, so never set *allow_pickle* when loading a file that might not be trustworthy.
+
+    Files are memory-mapped (where possible), and nothing is decoded up front except for the list of grammar classes: each node is only read from the file when it's actually accessed (and the source text, the first time it's needed).  If *fp* is a file object, it is left positioned just after the tree (so several trees can be stored one after another in the same file).
+    """
+    pos = 0
+    # (The position in the file that buf starts at)
+    seek = None
+    if isinstance(fp, (bytes,) + util.binary_types):
+        # (Checked first, since under python 2, bytes are also str)
+        buf = fp
+    elif isinstance(fp, util.text_type):
+        with open(fp, "rb") as f:
+            return load_tree(f, grammar, allow_pickle)
+    else:
+        pos = fp.tell()
+        try:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            seek = 0
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            buf = fp.read()
+            seek = pos
+            pos = 0
+    if bytes is str:
+        # Under python 2, indexing bytes (or an mmap) gives characters, not
+        # numbers.
+        buf = bytearray(buf)
+    if bytes(buf[pos:pos + len(_MAGIC)]) != _MAGIC:
+        raise ValueError("Not a parse tree written by dump_tree.")
+    pos += len(_MAGIC)
+    flags, pos = _get_varint(buf, pos)
+    count, pos = _get_varint(buf, pos)
+    classes = None
+    grammars = []
+    for n in range(count):
+        i, pos = _get_varint(buf, pos)
+        size, pos = _get_varint(buf, pos)
+        data = bytes(buf[pos:pos + size])
+        pos += size
+        if i:
+            if classes is None:
+                classes = grammar_classes(grammar)
+            cls = classes[i - 1] if i <= len(classes) else None
+            if cls is None or cls.grammar_name.encode("utf-8") != data:
+                raise ValueError("The parse tree was not saved with the grammar {0!r}.".format(grammar))
+        elif allow_pickle:
+            cls = pickle.loads(data)
+        else:
+            raise ValueError("The parse tree contains pickled grammar classes (which are not part of {0!r}), and allow_pickle is not set.".format(grammar))
+        grammars.append(cls)
+    size, pos = _get_varint(buf, pos)
+    tree = StoredTree(buf, grammars, pos, pos + size, bool(flags & 1))
+    root = StoredNode(tree, pos + size, 0, None)
+    if seek is not None:
+        try:
+            fp.seek(seek + root.stop)
+        except (AttributeError, OSError, ValueError):
+            pass
+    return root
+
+
+class StoredTree(object):
+    """
+    A parse tree loaded by :func:`load_tree`, which reads its nodes (as :class:`StoredNode` objects) straight from the file's buffer when they are asked for.
+
+    .. attribute:: source
+
+       The text which was parsed.  (This is decoded the first time it's used.)
+
+    .. attribute:: grammars
+
+       The list of grammar classes used by nodes in this tree.
+    """
+
+    def __init__(self, buf, grammars, source_start, source_end, binary):
+        self.buf = buf
+        self.grammars = grammars
+        self.source_range = (source_start, source_end)
+        self.binary = binary
+        self._source = None
+
+    @property
+    def source(self):
+        source = self._source
+        if source is None:
+            start, end = self.source_range
+            source = bytes(self.buf[start:end])
+            if not self.binary:
+                source = source.decode("utf-8", "surrogatepass")
+            self._source = source
+        return source
+
+    def grammar_ids(self, func, arg):
+        return frozenset(i for i, g in enumerate(self.grammars) if func(g, arg))
+
+
+class StoredNode(ArenaNode):
+    """
+    A view of a single node of a :class:`StoredTree`, which works the same way as an :class:`ArenaNode`.  The node's record is decoded when the view is created, but its children are only read (and new views created for them) when they're asked for.
+    """
+
+    __slots__ = ('start', 'end', 'gid', 'body', 'stop', '_parent')
+
+    def __init__(self, tree, index, start, parent):
+        # index is the position of the node's record in the buffer, and start is
+        # the position its gap is relative to.
+        self.tree = tree
+        self.index = index
+        self._parent = parent
+        buf = tree.buf
+        code, pos = _get_varint(buf, index)
+        if code & 1:
+            gap, pos = _get_varint(buf, pos)
+            start += gap
+        length, pos = _get_varint(buf, pos)
+        size, pos = _get_varint(buf, pos)
+        self.gid = (code >> 1) - 1
+        self.start = start
+        self.end = start + length
+        self.body = pos
+        self.stop = pos + size
+
+    @property
+    def __class__(self):
+        return self.tree.grammars[self.gid]
+
+    @property
+    def string(self):
+        return self.tree.source[self.start:self.end]
+
+    @property
+    def elements(self):
+        return tuple(self._children())
+
+    @property
+    def parent(self):
+        return self._parent
+
+    def _children(self):
+        tree = self.tree
+        buf = tree.buf
+        pos = self.body
+        start = self.start
+        stop = self.stop
+        while pos < stop:
+            if not buf[pos]:
+                pos += 1
+                yield None
+                continue
+            child = StoredNode(tree, pos, start, self)
+            yield child
+            pos = child.stop
+            start = child.end
+
+    def _search(self, func, skip, args):
+        matchers = [self.tree.grammar_ids(func, a) for a in args]
+        last = len(matchers) - 1
+        stack = [(self._children(), 0)]
+        while stack:
+            children, depth = stack[-1]
+            for c in children:
+                if c is None:
+                    continue
+                if c.gid in matchers[depth]:
+                    if depth < last:
+                        stack.append((c._children(), depth + 1))
+                        break
+                    yield c
+                elif skip:
+                    stack.append((c._children(), depth))
+                    break
+            else:
+                stack.pop()
+
+    def iter_terminals(self):
+        grammars = self.tree.grammars
+        stack = [self]
+        while stack:
+            e = stack.pop()
+            if e is None:
+                continue
+            if grammars[e.gid].grammar_terminal:
+                yield e
+            else:
+                stack.extend(reversed(e.elements))
+
+    def __bool__(self):
+        return self.body < self.stop or bool(self.__class__.grammar_terminal)
+
+    __nonzero__ = __bool__
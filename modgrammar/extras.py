@@ -12,6 +12,8 @@ def RE(regexp, **kwargs):
     return GrammarClass("<RE>", (REGrammar,), cdict)
 
 _recaret_re = re.compile(r"(^|[^[])\^")
+_relookbehind_re = re.compile(r"\\[bBA]|\(\?<[=!]")
+_unescape_re = re.compile(r"\\(.)")
 
 class REGrammar(Terminal):
     regexp = None
@@ -24,6 +26,7 @@ class REGrammar(Terminal):
             cls.boltest = True
         else:
             cls.boltest = False
+        cls.lookbehind = bool(cls.regexp and _relookbehind_re.search(cls.regexp.pattern))
         if "grammar_name" not in attrs:
             if cls.regexp is not None:
                 cls.grammar_name = "RE({0!r})".format(cls.regexp.pattern)
@@ -32,24 +35,43 @@ class REGrammar(Terminal):
 
     @classmethod
     def grammar_parse(cls, text, index, sessiondata):
+        regexp = cls.regexp
+        if text.binary:
+            regexp = util.binary_regexp(regexp)
         while True:
             string = text.string
-            if index == 0 and cls.boltest and not text.bol:
-                # This will make sure that a "^" in the pattern can't match on the
-                # beginning of the text.
-                string = " " + string
-                index = 1
-            m = cls.regexp.match(string, index)
+            pos = index
+            if index == text.start and (cls.boltest or cls.lookbehind):
+                if cls.lookbehind or not (index and text.bol == (string[index - 1] in ("\n", 10))
+                                          and regexp.flags & re.MULTILINE):
+                    # Match against the text as if what comes before it had already
+                    # been discarded, so things like "^" and "\b" work on the
+                    # beginning of the text the same way no matter how much we've
+                    # parsed so far.
+                    string = string[index:]
+                    pos = 0
+                if pos == 0 and cls.boltest and not text.bol:
+                    # This will make sure that a "^" in the pattern can't match on the
+                    # beginning of the text.
+                    string = (b" " if text.binary else " ") + string
+                    pos = 1
+            m = regexp.match(string, pos)
             if not m:
                 break
             end = m.end()
             if end < len(string) or text.eof:
-                yield (end - index, cls(string[index:end]))
+                yield (end - pos, (cls, index, index + end - pos, ()))
                 break
             else:
                 # We need more text before we can be sure we"re at the end.
                 text = yield (None, None)
-        yield util.error_result(index, cls)
+        yield util.error_result(index, cls, text)
+
+    @classmethod
+    def grammar_first(cls, visited):
+        if cls.regexp is None:
+            return (None, True)
+        return util.regex_first(cls.regexp)
 
     @classmethod
     def grammar_ebnf_lhs(cls, opts):
@@ -77,7 +99,10 @@ class QuotedString(Terminal):
 
     def elem_init(self, sessiondata):
         contents = self.elements[1].string
-        self.value = re.sub(r"\\(.)", r"\1", contents)
+        if isinstance(contents, util.binary_types):
+            self.value = util.binary_regexp(_unescape_re).sub(br"\1", contents)
+        else:
+            self.value = _unescape_re.sub(r"\1", contents)
 
     def __repr__(self):
         return "{0.__class__.__name__}<{0.string}>".format(self)
@@ -1,5 +1,5 @@
 from modgrammar import GrammarClass, GrammarParser, InternalError, UnknownReferenceError
-from modgrammar import util
+from modgrammar import util, vm, arena
 
 class Grammar(object):
     """
@@ -15,11 +15,14 @@ class Grammar(object):
     grammar_terminal = False
     grammar_collapse = False
     grammar_greedy = True
+    grammar_possessive = False
     grammar_null_subtoken_ok = True
     grammar_whitespace = None
     grammar_error_override = False
+    _tree_index = None
     grammar_hashattrs = (
-        'grammar_name', 'grammar', 'grammar_min', 'grammar_max', 'grammar_collapse', 'grammar_greedy', 'grammar_whitespace')
+        'grammar_name', 'grammar', 'grammar_min', 'grammar_max', 'grammar_collapse', 'grammar_greedy', 'grammar_possessive',
+        'grammar_whitespace')
 
     @classmethod
     def __class_init__(cls, attrs):
@@ -27,18 +30,53 @@ class Grammar(object):
         cls.grammar_max = len(cls.grammar)
 
     @classmethod
-    def parser(cls, sessiondata=None, tabs=1):
+    def parser(cls, sessiondata=None, tabs=1, **options):
         """
         Return a :class:`GrammarParser` associated with this grammar.
 
         If provided, *sessiondata* can contain data which should be provided to the :meth:`elem_init` method of each result object created during parsing.
 
         The *tabs* parameter indicates the width of "tab stops" in the input (i.e. how far a "tab" character will advance the column position when encountered).  This is only used to correctly report column numbers in :exc:`ParseError`\ s.  If you don't care about that, or your input does not contain tabs, you can ignore this parameter.
+
+        Any additional keyword *options* are used to configure the parser:
+
+          *memoize*
+            If :const:`True`, keep a "packrat" memo table of the results of each sub-grammar at each position in the buffer, so that backtracking does not have to re-parse the same text over and over again.  This can dramatically speed up some grammars (which would otherwise take exponential time), at the cost of extra memory.
+          *memo_entries*, *memo_bytes*
+            Limit the size of the memo table to the given number of entries or (approximately) the given number of bytes of cached results.  When the limit is reached, the least-recently-used entries are discarded.  (Setting either of these also implies *memoize*.)
+          *compiled*
+            If :const:`True`, match using the compiled form of the grammar (see :meth:`compile`) instead of the standard engine.
+          *positions*
+            Controls how the parser's :attr:`~GrammarParser.line` and :attr:`~GrammarParser.col` (and those reported in :exc:`ParseError`\ s) are kept track of.  If :const:`True` (the default), they are updated as each match is made.  If ``"lazy"``, they are only worked out when actually asked for (or an error is raised).  If :const:`False`, positions are not tracked at all (and will be reported as :const:`None`), which saves a little time for applications which never need them.
+          *fast_errors*
+            If :const:`True`, only keep track of where the parse has failed while parsing, and not what was expected there.  This saves a lot of work during normal (successful) parsing.  If the parse does fail, the text is parsed again to work out the list of expected grammars for the :exc:`ParseError`, so errors are reported the same either way (they just take longer to report).
+          *output*
+            The kind of result objects to produce.  ``"objects"`` (the default) produces normal instances of the grammar classes.  ``"compact"`` produces instances of memory-saving versions of the grammar classes (see :func:`modgrammar.util.compact_class`), which do not keep a separate copy of the text each of them matched, and have *source*, *start* and *end* attributes giving the position of the match in the shared text buffer.
+            ``"arena"`` does not create result objects at all.  Instead, the parse tree is stored in a set of arrays (see :mod:`modgrammar.arena`), and :class:`~modgrammar.arena.ArenaNode` views are returned in place of result objects.
+          *index*
+            If :const:`True`, call :meth:`build_index` on each result as it is returned, so that :meth:`find_all` and similar queries on the result tree are answered from an index instead of searching the tree each time.  If ``"lazy"``, the index is only built when the first such query is made.  (This does not apply to ``"arena"`` output, which has its own arrays to search.)
+        """
+        return GrammarParser(cls, sessiondata, tabs, **options)
+
+    @classmethod
+    def recognize(cls, string, sessiondata=None, **options):
         """
-        return GrammarParser(cls, sessiondata, tabs)
+        Return :const:`True` if the whole of *string* matches this grammar, or :const:`False` if it does not.  No result objects are created, so this is much faster than actually parsing the text when all you need to know is whether it's valid.  (This is a shortcut for ``cls.parser(sessiondata, **options).matches(string, full=True)``.  See :meth:`GrammarParser.matches`.)
+        """
+        return GrammarParser(cls, sessiondata, 1, **options).matches(string, full=True)
+
+    @classmethod
+    def compile(cls):
+        """
+        Compile this grammar (and all of its sub-grammars) into a flat array of instructions, which can be executed by a single loop with an explicit backtracking stack instead of by a chain of nested python generators.
+
+        Returns a program object with a :meth:`grammar_parse` method which produces exactly the same results as this grammar's own :meth:`grammar_parse`, but with less per-character overhead, and without being limited by python's recursion limit on deeply nested input.  (Normally you will not need to call this directly.  Use ``parser(compiled=True)`` instead.)
+        """
+        return vm.Program(cls)
 
     # Yields:
-    #   Success:     (count, obj)
+    #   Success:     (count, obj), where obj is a (grammar, start, end, children)
+    #                match tuple (or an already-constructed grammar instance)
     #   Incomplete:  (None, None)
     #   Parse error: (False, error_tuple)
     @classmethod
@@ -53,6 +91,7 @@ class Grammar(object):
         grammar_min = cls.grammar_min
         grammar_max = cls.grammar_max
         greedy = cls.grammar_greedy
+        possessive = cls.grammar_possessive
         if cls.grammar_whitespace is True:
             whitespace_re = util._whitespace_re
         else:
@@ -63,6 +102,19 @@ class Grammar(object):
         best_error = None
         pos = index
         first_pos = None
+        skip = False
+
+        fused = util.fused_sequence(cls)
+        if fused is not None:
+            result = fused.match(text, index)
+            if result is not None:
+                yield result
+                if possessive:
+                    yield util.error_result(index, cls, text)
+                    return
+                # If we get asked for more, fall back to doing it the long way (the
+                # first result of which will be the one we just returned).
+                skip = True
 
         while True:
             # Forward ho!
@@ -70,16 +122,20 @@ class Grammar(object):
                 if not greedy and len(objs) >= grammar_min:
                     # If we're not "greedy", then try returning every match as soon as we
                     # get it (which will naturally return the shortest matches first)
-                    yield (pos - index, cls(text.string, index, pos, objs))
-                    # We need to copy objs for any further stuff, since it's now part of
-                    # the object we yielded above, which our caller may be keeping for
-                    # later, so if we modify it in-place we'll be screwing up the
-                    # 'entities' list of that object in the process.
-                    objs = list(objs)
+                    if skip:
+                        skip = False
+                    else:
+                        yield (pos - index, (cls, index, pos, tuple(objs)))
+                        if possessive:
+                            # Only the first match counts.
+                            del states[:]
+                            break
                 if len(objs) >= grammar_max:
                     break
                 prews_pos = pos
                 if whitespace_re:
+                    if text.binary:
+                        whitespace_re = util.binary_regexp(whitespace_re)
                     while True:
                         m = whitespace_re.match(text.string, pos)
                         if m:
@@ -89,7 +145,7 @@ class Grammar(object):
                         text = yield (None, None)
                 if first_pos is None:
                     first_pos = pos
-                s = grammar[len(objs)].grammar_parse(text, pos, sessiondata)
+                s = util.subparse(grammar[len(objs)], text, pos, sessiondata)
                 offset, obj = next(s)
                 while offset is None:
                     if text.eof:
@@ -102,7 +158,11 @@ class Grammar(object):
                     pos = prews_pos
                     break
                 objs.append(obj)
-                states.append((pos, s))
+                if not possessive or len(objs) < grammar_min:
+                    # (If we're possessive, we'll only ever backtrack into elements if
+                    # we haven't got enough of them yet, so otherwise there's no need
+                    # to keep their state around.)
+                    states.append((pos, s))
                 pos += offset
                 # Went as far as we can forward and it didn't work.  Backtrack until we
             # find something else to follow...
@@ -111,12 +171,13 @@ class Grammar(object):
                     # If we are greedy, then return matches only after we've gone as far
                     # forward as possible, while we're backtracking (returns the longest
                     # matches first)
-                    yield (pos - index, cls(text.string, index, pos, objs))
-                    # We need to copy objs for any further stuff, since it's now part of
-                    # the object we yielded above, which our caller may be keeping for
-                    # later, so if we modify it in-place we'll be screwing up the
-                    # 'entities' list of that object in the process.
-                    objs = list(objs)
+                    if skip:
+                        skip = False
+                    else:
+                        yield (pos - index, (cls, index, pos, tuple(objs)))
+                        if possessive:
+                            # Only the first match counts.
+                            del states[:]
                 if not states:
                     break
                 pos, s = states[-1]
@@ -143,7 +204,11 @@ class Grammar(object):
             # If our sub-grammars failed to match, but we've got
             # grammar_error_override set, return ourselves as the failed match
             # grammar instead.
-            yield util.error_result(index, cls)
+            yield util.error_result(index, cls, text)
+        elif best_error is None:
+            # We're possessive, and stopped after our first match without
+            # anything failing.
+            yield util.error_result(index, cls, text)
         elif ((len(cls.grammar) == 1)
               and (best_error[0] == first_pos)
               and (cls.grammar_desc != cls.grammar_name) ):
@@ -151,7 +216,7 @@ class Grammar(object):
             # grammar class, and it failed to match, and we have a custom
             # grammar_desc.  Return ourselves as the failed match grammar so the
             # ParseError will contain our grammar_desc instead.
-            yield util.error_result(index, cls)
+            yield util.error_result(index, cls, text)
         else:
             yield util.error_result(*best_error)
 
@@ -181,6 +246,20 @@ class Grammar(object):
         else:
             return (util.ebnf_specialseq(cls, opts), ())
 
+    @classmethod
+    def grammar_first(cls, visited):
+        """
+        Determines which characters the text matched by this grammar can start with.  This is used (for example) by :func:`OR` grammars to skip over alternatives which could not possibly match at a particular position.  This can be overridden by grammars which provide their own :meth:`grammar_parse` implementation to make them eligible for this optimization.
+
+        Returns a tuple *(chars, nullable)*, where *chars* is a list of regular expression fragments (each of which matches a single character) which together match every character this grammar could start with, or :const:`None` if this grammar could start with anything (or it can't be determined).  *nullable* should be :const:`True` if this grammar can (or might) match without consuming any characters at all.
+
+        *visited* is used for detecting circular references.  Sub-grammars should be looked up using :func:`modgrammar.util.first_set`, passing it along.
+        """
+
+        if cls.grammar_parse.__func__ is Grammar.grammar_parse.__func__:
+            return util.sequence_first(cls, visited)
+        return (None, True)
+
     @classmethod
     def grammar_details(cls, depth=-1, visited=None):
         """
@@ -300,29 +379,10 @@ class Grammar(object):
             return self.elements
 
     def grammar_postprocess(self, parent, sessiondata):
-        self.parent = parent
-        if hasattr(self, '_str_info'):
-            s, start, end = self._str_info
-            self.string = s[start:end]
-            #del self._str_info
-            if self.grammar_collapse:
-                elems = self.grammar_collapsed_elems(sessiondata)
-                pp_elems = []
-                for e in elems:
-                    if e is None:
-                        pp_elems.append(e)
-                    else:
-                        pp_elems.extend(e.grammar_postprocess(parent, sessiondata))
-                return tuple(pp_elems)
-            else:
-                elems = self.elements
-                pp_elems = []
-                for e in elems:
-                    pp_elems.extend(e.grammar_postprocess(self, sessiondata))
-                self.elements = tuple(pp_elems)
-                del self._str_info
-        self.elem_init(sessiondata)
-        return (self,)
+        # This works through the whole sub-tree with an explicit stack (only
+        # calling grammar_postprocess on sub-elements which override it), so that
+        # deeply nested results don't run into the recursion limit.
+        return util.postprocess_tree(self, parent, sessiondata)
 
     def elem_init(self, sessiondata):
         """
@@ -336,7 +396,7 @@ class Grammar(object):
 
         If more than one type parameter is provided, it will treat the types as a "path" to traverse: for all sub-elements matching the first type, retrieve all sub-elements of those matching the second type, and so on, until it reaches the last type in the list.  (It will thus return all elements of the parse tree which are of the final type, which can be reached by traversing the previous types in order.)
         """
-        return list(self._search_recursive(isinstance, False, type_path))
+        return list(self._search(isinstance, False, type_path))
 
     def get(self, *type_path):
         """
@@ -345,7 +405,7 @@ class Grammar(object):
         This is equivalent to ``.get_all(*type_path)[0]`` except that it is more efficient, and will return :const:`None` if there are no such objects (instead of raising :exc:`IndexError`).
         """
         try:
-            return next(self._search_recursive(isinstance, False, type_path))
+            return next(self._search(isinstance, False, type_path))
         except StopIteration:
             return None
 
@@ -355,7 +415,10 @@ class Grammar(object):
 
         Similar to :meth:`get_all`, if more than one type parameter is provided, it will treat the types as a "path" to traverse in order.  The difference from :meth:`get_all` is that, for each step in the path, the elements found do not have to be direct sub-elements, but can be anywhere in the sub-tree.
         """
-        return list(self._search_recursive(isinstance, True, type_path))
+        index = util.tree_index(self)
+        if index is not None and type_path:
+            return index.find_all(self, 'type', type_path)
+        return list(self._search(isinstance, True, type_path))
 
     def find(self, *type_path):
         """
@@ -363,8 +426,11 @@ class Grammar(object):
 
         This is equivalent to ``.find_all(*type_path)[0]`` except that it is more efficient, and will return :const:`None` if there are no such objects (instead of raising :exc:`IndexError`).
         """
+        index = util.tree_index(self)
+        if index is not None and type_path:
+            return next(iter(index.find_all(self, 'type', type_path, first=True)), None)
         try:
-            return next(self._search_recursive(isinstance, True, type_path))
+            return next(self._search(isinstance, True, type_path))
         except StopIteration:
             return None
 
@@ -374,8 +440,11 @@ class Grammar(object):
 
         This functions identically to :meth:`find_all`, except that the criteria for matching is based on tags, rather than object types.
         """
+        index = util.tree_index(self)
+        if index is not None and tag_path:
+            return index.find_all(self, 'tag', tag_path)
         func = lambda e, l: l in getattr(e, "grammar_tags", ())
-        return list(self._search_recursive(func, True, tag_path))
+        return list(self._search(func, True, tag_path))
 
     def find_tag(self, *tag_path):
         """
@@ -383,45 +452,79 @@ class Grammar(object):
 
         This is equivalent to ``.find_tag_all(*tag_path)[0]`` except that it is more efficient, and will return :const:`None` if there are no such objects (instead of raising :exc:`IndexError`).
         """
+        index = util.tree_index(self)
+        if index is not None and tag_path:
+            return next(iter(index.find_all(self, 'tag', tag_path, first=True)), None)
         func = lambda e, l: l in getattr(e, "grammar_tags", ())
         try:
-            return next(self._search_recursive(func, True, tag_path))
+            return next(self._search(func, True, tag_path))
         except StopIteration:
             return None
 
-    def _search_recursive(self, func, skip, args):
-        subargs = list(args)
-        a = subargs.pop(0)
-        for e in self.elements:
-            if func(e, a):
-                if subargs:
-                    for result in e._search_recursive(func, skip, subargs):
-                        yield result
-                else:
+    def build_index(self):
+        """
+        Build an index of all of the elements in the parse tree below this one (by type and by tag), which will then be used to speed up :meth:`find_all`, :meth:`find`, :meth:`find_tag_all` and :meth:`find_tag` calls on any element of the tree (see :class:`modgrammar.util.TreeIndex`).  (Parsers can also do this automatically for each result; see the *index* option to :meth:`parser`.)
+
+        The index reflects the tree as it is when it is built.  If the tree is changed afterwards, this method should be called again.
+        """
+        self._tree_index = util.TreeIndex(self, build=True)
+
+    def dump_tree(self, fp, grammar=None):
+        """
+        Save the parse tree starting at this element to the binary file object *fp* (or the file named *fp*) in a compact binary format, which can be loaded again (lazily) with :func:`load_tree`.  If *grammar* is given, it should be the grammar which was used to parse the text (it defaults to this element's class), and the same grammar must be passed to :func:`load_tree`.  See :func:`modgrammar.arena.dump_tree` for details.
+        """
+        arena.dump_tree(self, fp, grammar)
+
+    def _search(self, func, skip, args):
+        # Each stack entry is (iterator over elements, index into args)
+        last = len(args) - 1
+        stack = [(iter(self.elements), 0)]
+        while stack:
+            elems, depth = stack[-1]
+            for e in elems:
+                if func(e, args[depth]):
+                    if depth < last:
+                        stack.append((iter(e.elements), depth + 1))
+                        break
                     yield e
-            elif skip and e is not None:
-                for o in e._search_recursive(func, skip, args):
-                    yield o
+                elif skip and e is not None:
+                    stack.append((iter(e.elements), depth))
+                    break
+            else:
+                stack.pop()
 
-    def terminals(self):
+    def iter_terminals(self):
         """
-        Return an ordered list of all result objects in the parse tree which are terminals (that is, where :attr:`grammar_terminal` is :const:`True`).
+        Iterate over all result objects in the parse tree which are terminals (that is, where :attr:`grammar_terminal` is :const:`True`), in order.  This is the same as :meth:`terminals`, but produces the results as it goes instead of building a list of them.
         """
-        if self.grammar_terminal:
-            return [self]
-        results = []
-        for e in self.elements:
+        stack = [self]
+        while stack:
+            e = stack.pop()
             if e is None:
                 pass
+            elif e.grammar_terminal:
+                yield e
             else:
-                results.extend(e.terminals())
-        return results
+                stack.extend(reversed(e.elements))
+
+    def terminals(self):
+        """
+        Return an ordered list of all result objects in the parse tree which are terminals (that is, where :attr:`grammar_terminal` is :const:`True`).
+        """
+        return list(self.iter_terminals())
+
+    def iter_tokens(self):
+        """
+        Iterate over the strings of all of the :meth:`terminals` in the parse tree (the same as :meth:`tokens`, but without building a list).
+        """
+        for e in self.iter_terminals():
+            yield e.string
 
     def tokens(self):
         """
         Return the parsed string, broken down into its smallest grammatical components.  (Another way of looking at this is that it returns the string values of all of the :meth:`terminals`.)
         """
-        return [e.string for e in self.terminals()]
+        return [e.string for e in self.iter_terminals()]
 
     def __getitem__(self, index):
         return self.elements[index]
@@ -1,10 +1,45 @@
 import re
+import os
+import codecs
 import traceback
 import sys
+import bisect
+import importlib
+import weakref
+from collections import OrderedDict
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
 
 import modgrammar
 
 _whitespace_re = re.compile('\s+')
+# (Under python 2, str is already bytes, so it's treated as text as before)
+binary_types = (bytearray, memoryview) if bytes is str else (bytes, bytearray, memoryview)
+text_type = str if bytes is not str else unicode
+_binary_regexps = {}
+_never_re = re.compile(b'(?!)')
+
+def binary_regexp(regexp):
+    """
+    Return a (cached) version of the compiled regular expression *regexp* which can be used to match bytes-mode text (see :attr:`modgrammar.Text.binary`).  Each character in the pattern stands for the byte with the same value (i.e. the pattern is encoded as latin-1), so ASCII patterns work the same way on bytes as they do on text.  Patterns which can't be represented this way (or are already bytes patterns) are returned as-is if they are bytes patterns, or otherwise replaced by one which never matches anything.
+    """
+    result = _binary_regexps.get(regexp)
+    if result is None:
+        pattern = regexp.pattern
+        if not isinstance(pattern, str):
+            result = regexp
+        else:
+            try:
+                result = re.compile(pattern.encode('latin-1'), regexp.flags & ~re.UNICODE)
+            except (UnicodeError, re.error):
+                result = _never_re
+        _binary_regexps[regexp] = result
+    return result
+
 
 def update_best_error(current_best, err):
     if not current_best:
@@ -13,7 +48,7 @@ def update_best_error(current_best, err):
     bestpos = current_best[0]
     if errpos > bestpos:
         return err
-    if errpos == bestpos:
+    if errpos == bestpos and current_best[1] is not None and err[1] is not None:
         current_best[1].update(err[1])
     return current_best
 
@@ -24,17 +59,912 @@ def best_error_result(err_list):
         err = err_list[0]
     else:
         pos = max((x[0] for x in err_list))
-        nodes = set().union(*(x[1] for x in err_list if x[0] == pos))
+        nodes = set().union(*(x[1] for x in err_list if x[0] == pos and x[1] is not None))
         err = (pos, nodes)
     return (False, err)
 
 
-def error_result(index, node):
+def error_result(index, node, text=None):
+    """
+    Construct the result a :meth:`~modgrammar.Grammar.grammar_parse` implementation should yield when it fails to match at *index*.  *node* is the grammar (or set of grammars) which was expected there.
+
+    If *text* is provided and its :attr:`fast_errors` attribute is set, the parser is only interested in where errors happen, so no set of expected grammars is built (it will be :const:`None` instead).
+    """
+    if node is None or (text is not None and text.fast_errors):
+        return (False, (index, None))
     if not isinstance(node, set):
         node = set([node])
     return (False, (index, node))
 
 
+def build_result(match, string, compact=False):
+    """
+    Create the result objects for a successful match.
+
+    While parsing, :meth:`~modgrammar.Grammar.grammar_parse` implementations yield lightweight *(grammar, start, end, children)* tuples instead of actual grammar instances, since most matches are thrown away again when backtracking.  This turns such a tuple (and all of its children) into a tree of grammar instances, using *string* (the text buffer the positions refer to).  Results which are already grammar instances are left as they are, apart from any match tuples among their elements.
+
+    If *compact* is set, the instances are created from the :func:`compact_class` versions of the grammars.
+    """
+    classes = {}
+    positions = {}
+    root = [None]
+    stack = [(match, root, 0)]
+    while stack:
+        m, dest, i = stack.pop()
+        if type(m) is tuple:
+            grammar, start, end, children = m
+            elems = list(children)
+            if compact:
+                # (By identity, since grammar classes compare equal by structure.)
+                cls = classes.get(id(grammar))
+                if cls is None:
+                    cls = classes[id(grammar)] = compact_class(grammar)
+                grammar = cls
+                # Compact objects keep their positions, so make sure objects
+                # starting/ending in the same place share the same int objects.
+                start = positions.setdefault(start, start)
+                end = positions.setdefault(end, end)
+            obj = grammar(string, start, end, elems)
+        else:
+            obj = m
+            elems = getattr(obj, 'elements', None)
+            if not (elems and hasattr(obj, '_str_info')):
+                dest[i] = obj
+                continue
+            elems = list(elems)
+            obj.elements = elems
+        dest[i] = obj
+        for j, e in enumerate(elems):
+            if e is not None:
+                stack.append((e, elems, j))
+    return root[0]
+
+
+def _match_info(match, string, pos):
+    # Returns (grammar, start, end, children) for either a match tuple or a
+    # result object yielded by a custom grammar_parse method.
+    if type(match) is tuple:
+        return match
+    s, start, end = match._str_info
+    if end is None:
+        end = len(s)
+    if s is not string:
+        # The object was created from some other string, so its positions don't
+        # mean anything in ours.  The best we can do is assume it starts at pos.
+        start, end = pos, pos + end - start
+    return (type(match), start, end, match.elements)
+
+
+def match_shape(match, string, pos):
+    """
+    Work out what the default :meth:`~modgrammar.Grammar.grammar_postprocess` would make of a match yielded by :meth:`~modgrammar.Grammar.grammar_parse` (see :func:`build_result`), without creating any result objects.
+
+    Returns *(grammar, start, end, elements, collapse)*.  If *collapse* is set, the match is collapsed, and *elements* take its place in its parent's elements.  (*pos* is only used for result objects created from a different string than *string*, which are assumed to start at *pos*.)
+    """
+    grammar, start, end, elems = _match_info(match, string, pos)
+    if issubclass(grammar, modgrammar.ListRepetition):
+        # Collapse down the succ_grammar matches for successive items, the same
+        # way ListRepetition.grammar_postprocess does.
+        flat = []
+        for e in elems:
+            if not flat:
+                flat.append(e)
+            else:
+                flat.extend(_match_info(e, string, pos)[3])
+        elems = flat
+    if not grammar.grammar_collapse:
+        return (grammar, start, end, elems, False)
+    if not elems:
+        return (grammar, start, end, (None,), True)
+    kept = [e for e in elems if e is None or not getattr(_match_info(e, string, pos)[0], "grammar_collapse_skip", False)]
+    return (grammar, start, end, kept or elems, True)
+
+
+def read_chunks(file, chunk_size):
+    """
+    Iterate over the contents of the file object *file*, in blocks of (up to) *chunk_size* characters (or bytes, for binary files).
+    """
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def decode_chunks(buf, encoding, errors="strict", chunk_size=1048576):
+    """
+    Decode the bytes-like object *buf* one block of *chunk_size* bytes at a time, yielding each piece of decoded text.  (Characters which are split across blocks are decoded as part of the later one.)
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    for pos in range(0, len(buf), chunk_size):
+        text = decoder.decode(buf[pos:pos + chunk_size])
+        if text:
+            yield text
+    text = decoder.decode(b"", True)
+    if text:
+        yield text
+
+
+def iter_events(match, string, offset=0):
+    """
+    Generate the parse events for a match yielded by :meth:`~modgrammar.Grammar.grammar_parse` (see :meth:`~modgrammar.GrammarParser.parse_events`), in document order.  *offset* is added to all positions.
+    """
+    stack = [match]
+    pos = 0
+    while stack:
+        m = stack.pop()
+        if m is None:
+            continue
+        if type(m) is list:
+            # End of a non-terminal's elements
+            pos = m[3] - offset
+            yield tuple(m)
+            continue
+        grammar, start, end, elems, collapse = match_shape(m, string, pos)
+        if collapse:
+            stack.extend(reversed(elems))
+        elif grammar.grammar_terminal:
+            pos = end
+            yield ("terminal", grammar, start + offset, end + offset, string[start:end])
+        else:
+            pos = start
+            yield ("enter", grammar, start + offset, end + offset, None)
+            stack.append(["exit", grammar, start + offset, end + offset, None])
+            stack.extend(reversed(elems))
+
+
+class _CompactString(object):
+    # The "string" attribute of compact result objects, which is sliced out of
+    # the source text whenever it's asked for.  On the class itself, this
+    # still provides whatever the original class had (i.e. LITERAL's string).
+
+    def __init__(self, class_value):
+        self.class_value = class_value
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self.class_value
+        return obj.source[obj.start:obj.end]
+
+    def __set__(self, obj, value):
+        # The string is always the matched part of the source text, which is what
+        # grammar_postprocess sets it to anyway.
+        pass
+
+
+def _compact_init(self, string, start=0, end=None, parsed=()):
+    if end is None:
+        end = len(string)
+    self.source = string
+    self.start = start
+    self.end = end
+    self.elements = parsed
+
+
+def _compact_get_str_info(self):
+    # Result objects which haven't been through grammar_postprocess yet have
+    # their elements in a list (afterwards, it's a tuple).
+    if type(self.elements) is not list:
+        raise AttributeError('_str_info')
+    return (self.source, self.start, self.end)
+
+
+def _compact_set_str_info(self, value):
+    self.source, self.start, self.end = value
+    if self.end is None:
+        self.end = len(self.source)
+
+
+def _compact_del_str_info(self):
+    pass
+
+
+def _compact_len(self):
+    return self.end - self.start
+
+
+def _compact_postprocess(self, parent, sessiondata):
+    # The same as Grammar.grammar_postprocess, but without going through the
+    # _str_info/string attributes (which compact objects don't really have).
+    # Only used for classes which don't override grammar_postprocess.
+    return postprocess_tree(self, parent, sessiondata, compact=True)
+
+
+def _compact_reduce(self):
+    # (The grammar class is pickled once per stream, even if it was generated
+    # dynamically, see GrammarClass.__reduce__)
+    args = (self.__class__.__bases__[0],)
+    slots = {}
+    for name in _compact_slots:
+        try:
+            slots[name] = getattr(self, name)
+        except AttributeError:
+            pass
+    return (modgrammar._gcompact_reconstructor, args, (getattr(self, '__dict__', None) or None, slots))
+
+
+_compact_slots = ('source', 'start', 'end', 'elements', 'parent')
+
+
+def _default_postprocess():
+    postprocess = modgrammar.Grammar.grammar_postprocess
+    return getattr(postprocess, '__func__', postprocess)
+
+
+def postprocess_tree(obj, parent, sessiondata, compact=False):
+    """
+    Do the work of the default :meth:`~modgrammar.Grammar.grammar_postprocess` for *obj*, and all of its descendants, using an explicit stack instead of recursing into each sub-element (so deeply nested trees are not limited by python's recursion limit).  Sub-elements whose classes override :meth:`~modgrammar.Grammar.grammar_postprocess` still have their own method called.  If *compact* is set, *obj* is a :func:`compact_class` instance.  Returns the same thing :meth:`~modgrammar.Grammar.grammar_postprocess` does.
+    """
+    default = _default_postprocess()
+    results = []
+    # Each frame is (node, parent of its elements, iterator over its elements,
+    # processed elements, where to put the results, compact).
+    frames = []
+    todo = (obj, parent, results, compact)
+    while True:
+        if todo is not None:
+            node, node_parent, dest, compact = todo
+            todo = None
+            node.parent = node_parent
+            if compact:
+                pending = type(node.elements) is list
+            else:
+                pending = hasattr(node, '_str_info')
+                if pending:
+                    s, start, end = node._str_info
+                    node.string = s[start:end]
+            if not pending:
+                node.elem_init(sessiondata)
+                dest.append(node)
+            elif node.grammar_collapse:
+                elems = node.grammar_collapsed_elems(sessiondata)
+                frames.append((node, node_parent, iter(elems), [], dest, compact))
+            else:
+                frames.append((node, node, iter(node.elements), [], dest, compact))
+        if not frames:
+            break
+        node, elem_parent, elems, pp_elems, dest, compact = frames[-1]
+        for e in elems:
+            if e is None:
+                pp_elems.append(e)
+                continue
+            func = type(e).grammar_postprocess
+            func = getattr(func, '__func__', func)
+            if func is default:
+                todo = (e, elem_parent, pp_elems, False)
+                break
+            elif func is _compact_postprocess:
+                todo = (e, elem_parent, pp_elems, True)
+                break
+            pp_elems.extend(e.grammar_postprocess(elem_parent, sessiondata))
+        else:
+            frames.pop()
+            if node.grammar_collapse:
+                dest.extend(pp_elems)
+            else:
+                node.elements = tuple(pp_elems)
+                if not compact:
+                    del node._str_info
+                node.elem_init(sessiondata)
+                dest.append(node)
+    return tuple(results)
+
+
+def compact_class(cls):
+    """
+    Return the (cached) compact version of the grammar class *cls*, which is used to create result objects when parsing with ``output="compact"``.
+
+    This is a subclass of *cls* (so :func:`isinstance` checks, :meth:`~modgrammar.Grammar.elem_init` and any other custom methods work the same) which keeps :attr:`elements`, :attr:`parent` and the *source*, *start* and *end* of the match in slots, instead of a per-instance dictionary.  *source* is the text buffer the match was made in (which is shared by all of the objects in the tree), and *start*/*end* are positions in it.  The :attr:`string` attribute is sliced out of *source* whenever it's asked for, instead of every object keeping its own copy.  (Note that, unlike normal result objects, these are created without calling the grammar's ``__init__`` method.)
+    """
+    twin = cls.__dict__.get('_compact_class')
+    if twin is None:
+        cdict = {
+            '__slots__': _compact_slots,
+            '__module__': cls.__module__,
+            '__init__': _compact_init,
+            '__len__': _compact_len,
+            '__reduce__': _compact_reduce,
+            '_str_info': property(_compact_get_str_info, _compact_set_str_info, _compact_del_str_info),
+            'string': _CompactString(getattr(cls, 'string', None)),
+        }
+        postprocess = cls.grammar_postprocess
+        if getattr(postprocess, '__func__', postprocess) is _default_postprocess():
+            cdict['grammar_postprocess'] = _compact_postprocess
+        # Don't go through GrammarClass.__init__, which would re-run
+        # __class_init__ (the class is only used for results, not for parsing).
+        twin = modgrammar.GrammarClass.__new__(modgrammar.GrammarClass, cls.__name__, (cls,), cdict)
+        cls._compact_class = twin
+    return twin
+
+
+class TreeIndex(object):
+    """
+    An index of all of the result objects in a parse tree, by type and by tag, used to answer :meth:`~modgrammar.Grammar.find_all` (and :meth:`~modgrammar.Grammar.find`, :meth:`~modgrammar.Grammar.find_tag_all` and :meth:`~modgrammar.Grammar.find_tag`) queries without walking the tree.
+
+    Nodes are numbered in document order, so the descendants of each node are the ones numbered between it and the last node of its subtree, and a query is just a couple of binary searches into a list of the matching node numbers.  The index is built the first time it's needed (unless *build* is set, in which case it's built right away), and reflects the tree at that time.  If the tree is modified afterwards, call :meth:`~modgrammar.Grammar.build_index` again.
+    """
+
+    def __init__(self, root, build=False):
+        self.root = root
+        self.nodes = None
+        if build:
+            self.build()
+
+    def __reduce__(self):
+        # The index refers to nodes by id(), so don't pickle it.  Just make a new
+        # one (which will be built when it's needed) on the other end.
+        return (self.__class__, (self.root,))
+
+    def build(self):
+        nodes = []
+        last = []
+        order = {}
+        by_type = {}
+        by_tag = {}
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            if node.__class__ is int:
+                # End of this node's subtree
+                last[node] = len(nodes) - 1
+                continue
+            i = len(nodes)
+            nodes.append(node)
+            last.append(i)
+            order[id(node)] = i
+            # (Grammar classes compare equal by structure, so key them by identity.)
+            cls = node.__class__
+            entry = by_type.get(id(cls))
+            if entry is None:
+                entry = by_type[id(cls)] = (cls, [])
+            entry[1].append(i)
+            for tag in node.grammar_tags:
+                by_tag.setdefault(tag, []).append(i)
+            elements = node.elements
+            if elements:
+                stack.append(i)
+                stack.extend(reversed(elements))
+        self.nodes = nodes
+        self.last = last
+        self.order = order
+        self.by_type = by_type
+        self.by_tag = by_tag
+        self.type_cache = {}
+
+    def contains(self, node):
+        """
+        Return :const:`True` if *node* is part of the indexed tree.
+        """
+        if self.nodes is None:
+            self.build()
+        i = self.order.get(id(node))
+        return i is not None and self.nodes[i] is node
+
+    def positions(self, kind, key):
+        # The (sorted) node numbers of all nodes which are instances of the class
+        # key (or have the tag key).
+        if kind == 'tag':
+            return self.by_tag.get(key, ())
+        cached = self.type_cache.get(id(key))
+        if cached is not None and cached[0] is key:
+            return cached[1]
+        found = [l for cls, l in self.by_type.values() if issubclass(cls, key)]
+        if len(found) == 1:
+            result = found[0]
+        else:
+            result = sorted(i for l in found for i in l)
+        self.type_cache[id(key)] = (key, result)
+        return result
+
+    def find_all(self, node, kind, path, first=False):
+        """
+        Return the results of ``node.find_all(*path)`` (if *kind* is ``"type"``) or ``node.find_tag_all(*path)`` (if *kind* is ``"tag"``).  *node* must be part of the indexed tree.  If *first* is set, stop after the first result.
+        """
+        if self.nodes is None:
+            self.build()
+        last = self.last
+        found = [self.order[id(node)]]
+        final = len(path) - 1
+        for step, key in enumerate(path):
+            positions = self.positions(kind, key)
+            parents = found
+            found = []
+            for i in parents:
+                start = bisect.bisect_right(positions, i)
+                end = bisect.bisect_right(positions, last[i], start)
+                # Matches are not searched for further matches of the same thing,
+                # so skip over anything inside the last one we found.
+                inside = i
+                for p in positions[start:end]:
+                    if p > inside:
+                        found.append(p)
+                        if first and step == final:
+                            break
+                        inside = last[p]
+                if first and found and step == final:
+                    break
+        nodes = self.nodes
+        return [nodes[p] for p in found]
+
+
+def tree_index(node):
+    """
+    Return the :class:`TreeIndex` for the parse tree *node* is part of, or :const:`None` if the tree has not been indexed (or *node* was added to it after it was indexed).
+    """
+    root = node
+    parent = getattr(root, 'parent', None)
+    while parent is not None:
+        root = parent
+        parent = getattr(root, 'parent', None)
+    index = getattr(root, '_tree_index', None)
+    if index is None or not index.contains(node):
+        return None
+    return index
+
+
+def global_name(cls):
+    """
+    Return the name *cls* can be looked up by (relative to its module), or :const:`None` if it is not available under its own name (for example, grammar classes which were generated by :func:`~modgrammar.LITERAL`, :func:`~modgrammar.WORD`, etc).
+    """
+    name = getattr(cls, '__qualname__', cls.__name__)
+    obj = sys.modules.get(cls.__module__)
+    for part in name.split('.'):
+        obj = getattr(obj, part, None)
+    if obj is cls:
+        return name
+    return None
+
+
+class _NodeRef(int):
+    # In a grammar graph, a reference to another node (by index)
+    __slots__ = ()
+
+
+class _ModuleRef(str):
+    # In a grammar graph, a reference to a module (by name), such as the
+    # ref_base of a REF grammar.
+    __slots__ = ()
+
+
+_graph_registry = weakref.WeakValueDictionary()
+
+
+def grammar_graph(grammar):
+    """
+    Return a structural description of the grammar class *grammar*, and all of the dynamically generated grammar classes it refers to, which can be pickled (and turned back into a grammar with :func:`build_grammar`).  This is what is used when a grammar class which cannot be looked up by name is pickled.  The description is a tuple of *(name, bases, attrs)* nodes, one for *grammar* and one for each dynamically generated class it refers to, where *attrs* contains the contents of the class's dictionary (leaving out internal caches).  Other grammar classes are included directly (so they are pickled by name as usual), and each class appears only once, no matter how many times it is referred to, so shared sub-grammars and reference cycles are both preserved.
+    """
+    nodes = []
+    index = {}
+
+    def encode(value):
+        t = type(value)
+        if isinstance(value, modgrammar.GrammarClass):
+            if global_name(value) is not None:
+                return value
+            i = index.get(id(value))
+            if i is None:
+                i = index[id(value)] = len(nodes)
+                nodes.append(value)
+            return _NodeRef(i)
+        if t is tuple or t is list:
+            return t(encode(v) for v in value)
+        if t is RepeatingTuple:
+            return RepeatingTuple(*[encode(v) for v in tuple.__iter__(value)], len=value.len)
+        if t is dict:
+            return dict((k, encode(v)) for k, v in value.items())
+        if t is frozenset or t is set:
+            return t(encode(v) for v in value)
+        if t is type(sys):
+            return _ModuleRef(value.__name__)
+        return value
+
+    # (grammar itself always comes first, even if it could be looked up by name)
+    index[id(grammar)] = 0
+    nodes.append(grammar)
+    graph = []
+    # (nodes grows as we go, as new classes are found)
+    for cls in nodes:
+        attrs = dict((k, encode(v)) for k, v in cls.__dict__.items() if not k.startswith('_'))
+        attrs['__module__'] = cls.__module__
+        graph.append((cls.__name__, encode(cls.__bases__), attrs))
+    return tuple(graph)
+
+
+def _graph_refs(value):
+    # All of the _NodeRefs contained in an (encoded) graph value.
+    t = type(value)
+    if t is _NodeRef:
+        yield value
+    elif t is tuple or t is list or t is frozenset or t is set or t is RepeatingTuple:
+        for v in tuple.__iter__(value) if t is RepeatingTuple else value:
+            for r in _graph_refs(v):
+                yield r
+    elif t is dict:
+        for v in value.values():
+            for r in _graph_refs(v):
+                yield r
+
+
+def _graph_decode(value, classes):
+    t = type(value)
+    if t is _NodeRef:
+        return classes[value]
+    if t is tuple or t is list or t is frozenset or t is set:
+        return t(_graph_decode(v, classes) for v in value)
+    if t is RepeatingTuple:
+        return RepeatingTuple(*[_graph_decode(v, classes) for v in tuple.__iter__(value)], len=value.len)
+    if t is dict:
+        return dict((k, _graph_decode(v, classes)) for k, v in value.items())
+    if t is _ModuleRef:
+        module = sys.modules.get(value)
+        if module is None:
+            module = importlib.import_module(value)
+        return module
+    return value
+
+
+def _graph_key(value):
+    # A hashable key for a (decoded) graph value.  Grammar classes are
+    # identified by identity (every dynamic class in the key has already been
+    # looked up in the registry, so equal ones are the same object).
+    t = type(value)
+    if isinstance(value, (modgrammar.GrammarClass, type(sys))):
+        return (type, id(value))
+    if t is tuple or t is list or t is frozenset or t is set:
+        return (t, tuple(_graph_key(v) for v in value))
+    if t is RepeatingTuple:
+        return (t, tuple(_graph_key(v) for v in tuple.__iter__(value)), value.len)
+    if t is dict:
+        return (t, tuple(sorted((k, _graph_key(v)) for k, v in value.items())))
+    return (t, value)
+
+
+def build_grammar(graph):
+    """
+    Reconstruct a grammar from a description produced by :func:`grammar_graph`.  The classes are recreated exactly as they were described (without running :meth:`~modgrammar.Grammar.__class_init__` on them again, since that has already been done), and are shared through a registry, so if a structurally identical class has already been built (and is still in use), that same class object is used instead of a new one.  (Classes which are part of a reference cycle are always built anew.)
+    """
+    GrammarClass = modgrammar.GrammarClass
+    classes = [None] * len(graph)
+    state = [0] * len(graph)  # 0 = not seen, 1 = in progress, 2 = built
+    cyclic = []
+    # Build each node after the nodes it refers to, with an explicit stack
+    # (grammars can be nested quite deeply).
+    stack = [0]
+    while stack:
+        i = stack[-1]
+        if state[i] == 0:
+            state[i] = 1
+            stack.extend(r for r in _graph_refs(graph[i][1:]) if state[r] == 0)
+            continue
+        stack.pop()
+        if state[i] == 2:
+            continue
+        state[i] = 2
+        name, bases, attrs = graph[i]
+        bases = _graph_decode(bases, classes)
+        if None in bases:
+            raise ValueError("Invalid grammar graph: class {0!r} is its own base class".format(name))
+        # Anything referring to a class which is still in progress (i.e. part of
+        # a cycle) has to be filled in after that class has been created.
+        deferred = set(k for k, v in attrs.items() if any(classes[r] is None for r in _graph_refs(v)))
+        cdict = dict((k, _graph_decode(v, classes)) for k, v in attrs.items() if k not in deferred)
+        cdict['_hash_id'] = None
+        if deferred:
+            cls = type.__new__(GrammarClass, name, bases, cdict)
+            cyclic.append(i)
+        else:
+            key = (name, _graph_key(bases), _graph_key(cdict))
+            try:
+                cls = _graph_registry.get(key)
+            except TypeError:
+                # Something in the class isn't hashable, so it can't be shared
+                key = cls = None
+            if cls is None:
+                cls = type.__new__(GrammarClass, name, bases, cdict)
+                if key is not None:
+                    _graph_registry[key] = cls
+        classes[i] = cls
+    for i in cyclic:
+        cls = classes[i]
+        for k, v in graph[i][2].items():
+            if k not in cls.__dict__:
+                type.__setattr__(cls, k, _graph_decode(v, classes))
+    return classes[0]
+
+
+_class_cache = weakref.WeakValueDictionary()
+
+
+def cached_class(name, bases, cdict):
+    """
+    Return ``GrammarClass(name, bases, cdict)``, or the class an earlier call with the same arguments returned, if it is still in use.  (Pickles made by older versions of modgrammar include a copy of the class dictionary with every result object, so this keeps loading them from creating a new class for every single object.)
+    """
+    try:
+        key = (name, _graph_key(bases), _graph_key(cdict))
+        cls = _class_cache.get(key)
+    except TypeError:
+        return modgrammar.GrammarClass(name, bases, cdict)
+    if cls is None:
+        # (GrammarClass modifies the dictionary it's given)
+        cls = _class_cache[key] = modgrammar.GrammarClass(name, bases, dict(cdict))
+    return cls
+
+
+def subparse(grammar, text, index, sessiondata):
+    memo = text.memo
+    if memo is None or grammar.grammar_terminal:
+        return grammar.grammar_parse(text, index, sessiondata)
+    return memo.parse(grammar, text, index, sessiondata)
+
+
+def first_set(grammar, visited=None):
+    """
+    Return the (cached) result of *grammar*'s :meth:`~modgrammar.Grammar.grammar_first` method.  *visited* is used to detect circular references, which are (conservatively) treated as able to start with anything.
+    """
+    cached = grammar.__dict__.get('_first_set')
+    if cached is not None and cached[0] is grammar.grammar:
+        return cached[1]
+    if visited is None:
+        visited = set()
+    elif id(grammar) in visited:
+        return (None, True)
+    visited.add(id(grammar))
+    result = grammar.grammar_first(visited)
+    visited.discard(id(grammar))
+    grammar._first_set = (grammar.grammar, result)
+    return result
+
+
+def sequence_first(cls, visited):
+    whitespace = cls.grammar_whitespace
+    if whitespace is True:
+        chars = ['\\s']
+    elif whitespace:
+        # We don't know what a custom whitespace regexp might match.
+        return (None, True)
+    else:
+        chars = []
+    grammar = cls.grammar
+    count = len(grammar)
+    if isinstance(grammar, RepeatingTuple):
+        # Anything after the second element just repeats it, and if we get that
+        # far, we already know it's nullable.  (Don't range() over the whole
+        # thing: its length is usually sys.maxsize.)
+        count = min(count, 2)
+    for i in range(count):
+        # Past grammar_min, we could also stop before this element.
+        optional = (i >= cls.grammar_min)
+        sub_chars, nullable = first_set(grammar[i], visited)
+        if sub_chars is None:
+            return (None, nullable or optional)
+        chars.extend(sub_chars)
+        if not nullable:
+            return (chars, optional)
+    return (chars, True)
+
+
+_re_categories = {
+    sre_constants.CATEGORY_DIGIT: '\\d', sre_constants.CATEGORY_NOT_DIGIT: '\\D',
+    sre_constants.CATEGORY_SPACE: '\\s', sre_constants.CATEGORY_NOT_SPACE: '\\S',
+    sre_constants.CATEGORY_WORD: '\\w', sre_constants.CATEGORY_NOT_WORD: '\\W',
+}
+
+
+def _re_charset(items):
+    parts = []
+    for op, av in items:
+        if op is sre_constants.NEGATE:
+            parts.insert(0, '^')
+        elif op is sre_constants.LITERAL:
+            parts.append(re.escape(chr(av)))
+        elif op is sre_constants.RANGE:
+            parts.append('{0}-{1}'.format(re.escape(chr(av[0])), re.escape(chr(av[1]))))
+        elif op is sre_constants.CATEGORY and av in _re_categories:
+            parts.append(_re_categories[av])
+        else:
+            return None
+    return '[{0}]'.format(''.join(parts))
+
+
+def _re_first(items):
+    chars = []
+    for op, av in items:
+        nullable = False
+        if op is sre_constants.LITERAL:
+            sub_chars = [re.escape(chr(av))]
+        elif op is sre_constants.NOT_LITERAL:
+            sub_chars = ['[^{0}]'.format(re.escape(chr(av)))]
+        elif op is sre_constants.ANY:
+            sub_chars = None
+        elif op is sre_constants.IN:
+            sub_chars = _re_charset(av)
+            if sub_chars is not None:
+                sub_chars = [sub_chars]
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) or op is getattr(sre_constants, 'POSSESSIVE_REPEAT', None):
+            sub_chars, nullable = _re_first(av[2])
+            nullable = nullable or not av[0]
+        elif op is sre_constants.SUBPATTERN:
+            sub_chars, nullable = _re_first(av[-1])
+        elif op is getattr(sre_constants, 'ATOMIC_GROUP', None):
+            sub_chars, nullable = _re_first(av)
+        elif op is sre_constants.BRANCH:
+            sub_chars = []
+            for branch in av[1]:
+                b_chars, b_nullable = _re_first(branch)
+                if b_chars is None:
+                    sub_chars = None
+                    nullable = True
+                    break
+                sub_chars.extend(b_chars)
+                nullable = nullable or b_nullable
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            # Zero-width assertions
+            sub_chars, nullable = [], True
+        else:
+            sub_chars, nullable = None, True
+        if sub_chars is None:
+            return (None, nullable)
+        chars.extend(sub_chars)
+        if not nullable:
+            return (chars, False)
+    return (chars, True)
+
+
+def regex_first(regexp):
+    """
+    Work out the FIRST set (see :meth:`~modgrammar.Grammar.grammar_first`) of a compiled regular expression.
+    """
+    if not isinstance(regexp.pattern, str) or regexp.flags & (re.IGNORECASE | re.VERBOSE):
+        return (None, True)
+    try:
+        return _re_first(sre_parse.parse(regexp.pattern, regexp.flags))
+    except Exception:
+        return (None, True)
+
+
+class LiteralTrie(object):
+    """
+    A prefix tree of a list of literal strings, used to match all of them against a piece of text in a single pass.
+    """
+
+    def __init__(self, strings):
+        self.strings = strings
+        # Each node is a list: [children, indexes of strings ending here,
+        # indexes of strings continuing past here]
+        self.root = [{}, [], []]
+        for i, string in enumerate(strings):
+            node = self.root
+            for c in string:
+                node[2].append(i)
+                node = node[0].setdefault(c, [{}, [], []])
+            node[1].append(i)
+
+    def match(self, string, index, eof):
+        """
+        Returns a tuple *(matched, partial)*, where *matched* is a list of the indexes of all strings found at *index* in *string*, and *partial* is a list of the indexes of all strings which could still match once more text is available (always empty if *eof* is true).
+        """
+        node = self.root
+        matched = []
+        end = len(string)
+        while True:
+            matched.extend(node[1])
+            if index == end:
+                if eof:
+                    return (matched, [])
+                return (matched, node[2])
+            node = node[0].get(string[index])
+            if node is None:
+                return (matched, [])
+            index += 1
+
+
+_fused_max_elements = 30
+_re_backref_re = re.compile(r'\\[1-9]|\(\?\(|\(\?P=')
+
+
+def _fused_element(grammar):
+    # Returns (regexp, more_regexp, atomic) for terminals which can be fused into
+    # a single regular expression, or None.  more_regexp matches (zero-width, at
+    # the element's position) in the cases where grammar_parse would ask for more
+    # text before returning its first result.
+    import modgrammar
+    from modgrammar import extras
+    parse = grammar.grammar_parse.__func__
+    if parse is modgrammar.Literal.grammar_parse.__func__:
+        string = grammar.string
+        if not string:
+            return ('', None, False)
+        prefixes = ''.join('(?:' + re.escape(c) for c in string[:-1]) + ')?' * (len(string) - 1)
+        return (re.escape(string), prefixes + '\\Z', False)
+    if parse is modgrammar.Word.grammar_parse.__func__:
+        if not grammar.grammar_greedy or grammar.grammar_min > 1:
+            return None
+        regexp = grammar.regexp
+        if regexp.flags & ~re.UNICODE or regexp.groupindex:
+            return None
+        return ('(?:{0})'.format(regexp.pattern), '(?:{0})\\Z'.format(regexp.pattern), False)
+    if parse is extras.REGrammar.grammar_parse.__func__:
+        regexp = grammar.regexp
+        if regexp is None or grammar.boltest or grammar.lookbehind or regexp.groupindex or _re_backref_re.search(regexp.pattern):
+            return None
+        flags = regexp.flags & ~re.UNICODE
+        if flags not in (0, re.MULTILINE) or (not flags and '$' in regexp.pattern):
+            return None
+        return ('(?:{0})'.format(regexp.pattern), '(?:{0})\\Z'.format(regexp.pattern), True)
+    return None
+
+
+class FusedSequence(object):
+    """
+    A sequence of simple terminals (:func:`LITERAL`, :func:`WORD`, :func:`~modgrammar.extras.RE`, etc) compiled into a single regular expression, which can be used to find the first match of the sequence in one step.  (See :func:`fused_sequence`.)
+    """
+
+    def __init__(self, grammar, elements):
+        self.grammar = grammar
+        self.groups = [(g, 'g{0}'.format(i)) for i, g in enumerate(grammar.grammar)]
+        whitespace = '\\s*(?!\\s)' if grammar.grammar_whitespace else ''
+        # Elements are nested inside each other so that when one of the "need more
+        # text" branches matches, the match ends right there.
+        eof_re = '(?P<end>)'
+        more_re = '(?P<end>)'
+        for i in reversed(range(len(elements))):
+            regexp, more, atomic = elements[i]
+            if atomic:
+                regexp = '(?=(?P<a{0}>{1}))(?P=a{0})'.format(i, regexp)
+            regexp = '(?P<g{0}>{1})'.format(i, regexp)
+            eof_re = whitespace + regexp + eof_re
+            if more is not None:
+                more_re = '(?:(?={0})|{1}{2})'.format(more, regexp, more_re)
+            else:
+                more_re = regexp + more_re
+            if whitespace:
+                more_re = '(?:(?=\\s*\\Z)|{0}{1})'.format(whitespace, more_re)
+        self.eof_regexp = re.compile(eof_re, re.MULTILINE)
+        self.more_regexp = re.compile(more_re, re.MULTILINE)
+
+    def match(self, text, index):
+        """
+        Returns the first result (a *(count, obj)* tuple) the sequence would produce when parsing *text* at *index*, or :const:`None` if it can't be determined this way (because the sequence doesn't match, or more text would be needed first).
+        """
+        string = text.string
+        regexp = self.eof_regexp if text.eof else self.more_regexp
+        if text.binary:
+            regexp = binary_regexp(regexp)
+        m = regexp.match(string, index)
+        if m is None or m.start('end') < 0:
+            return None
+        objs = []
+        for g, group in self.groups:
+            start, end = m.span(group)
+            objs.append((g, start, end, ()))
+        return (end - index, (self.grammar, index, end, tuple(objs)))
+
+
+def fused_sequence(grammar):
+    """
+    If *grammar* is a simple fixed-length sequence made up entirely of terminals which can be represented as regular expressions (with the same backtracking behavior), return a (cached) :class:`FusedSequence` for it.  Otherwise, return :const:`None`.
+    """
+    cached = grammar.__dict__.get('_fused')
+    if cached is not None and cached[0] is grammar.grammar:
+        return cached[1]
+    fused = None
+    sub = grammar.grammar
+    whitespace = grammar.grammar_whitespace
+    if (not isinstance(sub, RepeatingTuple) and 1 < len(sub) <= _fused_max_elements
+        and grammar.grammar_min == grammar.grammar_max == len(sub)
+        and (whitespace is True or not whitespace)):
+        elements = [_fused_element(g) for g in sub]
+        if None not in elements:
+            try:
+                fused = FusedSequence(grammar, elements)
+            except (re.error, OverflowError, RuntimeError):
+                fused = None
+    grammar._fused = (grammar.grammar, fused)
+    return fused
+
+
 def regularize(grammar):
     if hasattr(grammar, 'grammar_parse'):
         return (grammar,)
@@ -72,7 +1002,7 @@ def add_grammar(one, two):
 
 classdict_map = dict(count='grammar_count', min='grammar_min', max='grammar_max', collapse='grammar_collapse',
     collapse_skip='grammar_collapse_skip', tags='grammar_tags', greedy='grammar_greedy',
-    whitespace='grammar_whitespace')
+    possessive='grammar_possessive', commit='grammar_commit', whitespace='grammar_whitespace')
 
 def make_classdict(base, grammar, kwargs, **defaults):
     cdict = {}
@@ -88,22 +1018,21 @@ def make_classdict(base, grammar, kwargs, **defaults):
     return cdict
 
 
-def calc_line_col(string, count, line=0, col=0, tabs=1):
-    pos = 0
-    while True:
-        p = string.find('\n', pos, count) + 1
-        if not p:
-            break
-        pos = p
-        line += 1
-        col = 0
-    if tabs != 1:
-        lastline = (" " * col) + string[pos:count]
-        lastline = lastline.expandtabs(tabs)
-        col = len(lastline)
-    else:
-        col += count - pos
-    return (line, col)
+def advance_col(string, start, end, col=0, tabs=1):
+    """
+    Return the column position reached by starting at column *col* and advancing over ``string[start:end]`` (which should not contain any newlines), with tab stops every *tabs* columns.
+    """
+    if tabs == 1:
+        return col + end - start
+    tab = '\t' if isinstance(string, str) else b'\t'
+    if tabs < 1:
+        return col + end - start - string.count(tab, start, end)
+    pos = string.find(tab, start, end)
+    while pos >= 0:
+        col = ((col + pos - start) // tabs + 1) * tabs
+        start = pos + 1
+        pos = string.find(tab, start, end)
+    return col + end - start
 
 
 def get_calling_module(stack=None):
@@ -141,6 +1070,9 @@ class RepeatingTuple(tuple):
     def __len__(self):
         return self.len
 
+    def __reduce__(self):
+        return (RepeatingTuple, (tuple.__getitem__(self, 0), tuple.__getitem__(self, 1), self.len))
+
 
 def get_ebnf_names(glist, opts):
     names = []
@@ -167,3 +1099,187 @@ def ebnf_specialseq(grammar, opts, name=None, details=None, desc=None):
         if not text:
             text = name or grammar.grammar_name
     return '? {0} ?'.format(text)
+
+
+class _MemoEntry(object):
+    __slots__ = ('grammar', 'state', 'results', 'waiting', 'done')
+
+    def __init__(self, grammar, state):
+        self.grammar = grammar
+        self.state = state
+        self.results = []
+        self.waiting = False
+        self.done = False
+
+
+class ParseMemo(object):
+    """
+    Packrat memo table used by :class:`~modgrammar.GrammarParser` when memoization is enabled.
+
+    Each entry records the sequence of results a grammar produced at a given buffer position, so that later attempts to match the same grammar at the same position (which happen a lot when backtracking) replay the recorded results instead of re-running the grammar.  Entries are evicted in least-recently-used order once *max_entries* entries or (approximately) *max_bytes* bytes of cached results are exceeded.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.refs = {}
+        self.size = 0
+        self.data = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.refs.clear()
+        self.size = 0
+
+    def resolve(self, ref, sessiondata):
+        try:
+            return self.refs[id(ref)][1]
+        except KeyError:
+            o = ref.resolve(sessiondata)
+            self.refs[id(ref)] = (ref, o)
+            return o
+
+    def parse(self, grammar, text, index, sessiondata):
+        entry = self.lookup(grammar, index)
+        if entry is None:
+            entry = self.store(grammar, index, grammar.grammar_parse(text, index, sessiondata))
+        return self._replay(entry, text)
+
+    def lookup(self, grammar, index, owner=None):
+        # Returns the entry for grammar at index (marking it as the most recently
+        # used one), or None.  owner identifies what runs the entry's parse state
+        # (None for a grammar_parse generator), and entries for different owners
+        # are kept separately.
+        key = (id(grammar), index, owner)
+        entry = self.entries.pop(key, None)
+        if entry is None or entry.grammar is not grammar:
+            return None
+        self.entries[key] = entry
+        return entry
+
+    def store(self, grammar, index, state, owner=None):
+        # Adds (and returns) a new entry for grammar at index, whose results will
+        # come from state.
+        entry = _MemoEntry(grammar, state)
+        entries = self.entries
+        entries[(id(grammar), index, owner)] = entry
+        if self.max_entries is not None and len(entries) > self.max_entries:
+            self._evict()
+        return entry
+
+    def record(self, entry, result):
+        # Adds result (the next thing produced by entry's parse state) to the
+        # results recorded for entry.
+        count, obj = result
+        if count is False:
+            # Callers merge error sets in-place (see update_best_error), so
+            # we keep our own copy and hand out fresh ones on every replay.
+            if obj[1] is not None:
+                obj = (obj[0], set(obj[1]))
+            entry.done = True
+        entry.results.append((count, obj))
+        self.size += sys.getsizeof(obj)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self._evict()
+
+    @staticmethod
+    def replayed(result):
+        # Returns a recorded result in the form it should be handed to a caller.
+        count, obj = result
+        if count is False and obj[1] is not None:
+            return (False, (obj[0], set(obj[1])))
+        return result
+
+    def _evict(self):
+        entries = self.entries
+        while entries and ((self.max_entries is not None and len(entries) > self.max_entries) or
+                           (self.max_bytes is not None and self.size > self.max_bytes)):
+            key, entry = entries.popitem(last=False)
+            self.size -= sum(sys.getsizeof(r[1]) for r in entry.results)
+
+    def _replay(self, entry, text):
+        results = entry.results
+        i = 0
+        while True:
+            if i < len(results):
+                result = results[i]
+            elif entry.done:
+                return
+            else:
+                if entry.waiting:
+                    result = entry.state.send(text)
+                else:
+                    result = next(entry.state)
+                while result[0] is None:
+                    entry.waiting = True
+                    text = yield (None, None)
+                    result = entry.state.send(text)
+                entry.waiting = False
+                self.record(entry, result)
+                result = results[i]
+            i += 1
+            yield self.replayed(result)
+
+
+def find_shards(path, boundary, shard_size):
+    """
+    Split the file *path* into pieces of (roughly) *shard_size* bytes, each of which ends just after a match of the compiled (bytes) regular expression *boundary* (or at the end of the file).  Returns a list of *(start, end)* byte offsets.
+    """
+    shards = []
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        start = 0
+        while start < size:
+            pos = start + shard_size
+            end = size
+            window = 65536
+            while pos < size:
+                f.seek(pos)
+                chunk = f.read(window)
+                m = boundary.search(chunk)
+                # A match which runs right up to the end of what we read might
+                # continue further, so only trust it if there's more after it (or
+                # there's nothing more to read).
+                if m and m.end() > 0 and (m.end() < len(chunk) or pos + len(chunk) >= size):
+                    end = pos + m.end()
+                    break
+                if pos + len(chunk) >= size:
+                    break
+                window *= 2
+            shards.append((start, end))
+            start = end
+    return shards
+
+
+def parse_shard(args):
+    """
+    Parse one piece of a file for :meth:`~modgrammar.GrammarParser.parse_file_parallel` (in a worker process).  Returns *(results, error, length, lines, col)*, where *error* is :const:`None` or a tuple describing the :exc:`~modgrammar.ParseError` (with positions relative to the start of the piece), and *length*, *lines* and *col* describe the piece's text (its length, the number of newlines in it, and the column position reached at its end, counting from the last newline, or from the start of the piece if there isn't one).
+    """
+    grammar, sessiondata, tabs, options, path, start, end, encoding, errors, bol = args
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start)
+    if encoding is not None:
+        text = text.decode(encoding, errors)
+    newline = "\n" if encoding is not None else b"\n"
+    last = text.rfind(newline) + 1
+    col = advance_col(text, last, len(text), 0, tabs)
+    results = []
+    error = None
+    p = grammar.parser(sessiondata, tabs, **options)
+    try:
+        for result in p.parse_lines([text], bol=bol, eof=True):
+            results.append(result)
+    except modgrammar.ParseError as e:
+        if e.line == 0 and e.col is not None:
+            # The column depends on where the previous piece left off, so send the
+            # text from the start of the piece to the error, to work it out again.
+            prefix = text[:e.char]
+        else:
+            prefix = None
+        error = (e.buffer, e.buffer_pos, e.char, e.line, e.col, e.message, prefix)
+    return (results, error, len(text), text.count(newline), col)
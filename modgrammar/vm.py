@@ -0,0 +1,417 @@
+"""
+An alternative matching engine for grammars, used by :meth:`Grammar.compile`.
+
+Instead of matching by chaining together one python generator per grammar (as :meth:`Grammar.grammar_parse` does), the grammar graph is lowered into a flat array of instructions which are all run from a single loop, using an explicit stack of frames for backtracking.  This avoids most of the per-character overhead of resuming nested generators, and means that the depth of the input text's nesting is no longer limited by python's recursion limit.
+
+Each instruction corresponds to a single grammar class.  Sequences (including :class:`Repetition` and :class:`ListRepetition`, which use the standard sequence-matching logic), :func:`OR`, :func:`NOT_FOLLOWED_BY`, :func:`EXCEPT` and :func:`REF` constructs are executed directly by the loop.  Terminals, and any grammars with custom :meth:`~Grammar.grammar_parse` definitions, are executed by calling their own :meth:`~Grammar.grammar_parse` method as a "native" instruction.  If the parser uses memoization, the memo table entries for the constructs executed by the loop are also recorded and replayed by frames on the same stack.
+
+The results produced are identical (including order, partial-input behavior, and error reporting) to those produced by the normal engine.
+"""
+
+import modgrammar
+from modgrammar import util
+
+OP_NATIVE = 0
+OP_SEQ = 1
+OP_OR = 2
+OP_NOT = 3
+OP_EXCEPT = 4
+OP_REF = 5
+# Not an instruction: frames which replay the results of a memo table entry
+OP_MEMO = 6
+
+# Frame phases
+_START = 0
+_FORWARD = 1
+_FORWARD_NEXT = 2
+_FORWARD_RESULT = 3
+_BACKTRACK = 4
+_BACKTRACK_NEXT = 5
+_BACKTRACK_RESULT = 6
+_TRY = 7
+_RESULT = 8
+_RESUME = 9
+_FAILED = 10
+
+
+def _opcode(grammar):
+    parse = grammar.grammar_parse.__func__
+    if parse is modgrammar.Grammar.grammar_parse.__func__:
+        if util.fused_sequence(grammar) is not None:
+            # A run of simple terminals, matched with a single regexp by
+            # Grammar.grammar_parse itself.
+            return OP_NATIVE
+        return OP_SEQ
+    if parse is modgrammar.OR_Operator.grammar_parse.__func__:
+        if grammar.grammar_literal_trie() is not None:
+            # Matched in a single pass by OR_Operator itself.
+            return OP_NATIVE
+        return OP_OR
+    if parse is modgrammar.NotFollowedBy.grammar_parse.__func__:
+        return OP_NOT
+    if parse is modgrammar.ExceptionGrammar.grammar_parse.__func__:
+        return OP_EXCEPT
+    if parse is modgrammar.Reference.grammar_parse.__func__:
+        return OP_REF
+    return OP_NATIVE
+
+
+class _Frame(object):
+    __slots__ = ('pc', 'op', 'grammar', 'index', 'phase', 'pos', 'prews_pos', 'first_pos', 'objs', 'states',
+                 'best_error', 'alt', 'order', 'count', 'child', 'gen', 'entry')
+
+    # Frames are the explicit-stack equivalent of the generators used by the
+    # normal engine.  'phase' records where in the corresponding grammar_parse
+    # logic we should pick up again the next time the frame is run.
+
+    def __init__(self, pc, op, grammar, index):
+        self.pc = pc
+        self.op = op
+        self.grammar = grammar
+        self.index = index
+        self.phase = _START
+        self.gen = None
+
+
+class Program(object):
+    """
+    A compiled grammar, as returned by :meth:`Grammar.compile`.
+
+    Program objects provide a :meth:`grammar_parse` method which behaves exactly the same as the :meth:`~Grammar.grammar_parse` method of the grammar they were compiled from, and can be used anywhere that one could.
+
+    Note that the program is a snapshot of the grammar at the time it was compiled.  If the grammar is later changed (for example, by calling :meth:`~Grammar.grammar_resolve_refs`), it will need to be compiled again.  (:func:`REF` constructs which are not resolved at compile time are resolved during parsing, as usual.)
+    """
+
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.code = []
+        self._pcs = {}
+        self.entry = self.lower(grammar)
+
+    def __len__(self):
+        return len(self.code)
+
+    def lower(self, grammar):
+        """
+        Return the instruction index for *grammar*, adding instructions for it (and any sub-grammars it needs) to the program if they are not already present.
+        """
+        pc = self._pcs.get(id(grammar))
+        if pc is not None:
+            return pc
+        code = self.code
+        todo = []
+
+        def alloc(g):
+            pc = self._pcs.get(id(g))
+            if pc is None:
+                pc = len(code)
+                self._pcs[id(g)] = pc
+                code.append(None)
+                todo.append((pc, g))
+            return pc
+
+        entry = alloc(grammar)
+        while todo:
+            pc, g = todo.pop()
+            op = _opcode(g)
+            if op == OP_SEQ:
+                sub = g.grammar
+                if isinstance(sub, util.RepeatingTuple):
+                    kids = util.RepeatingTuple(alloc(tuple.__getitem__(sub, 0)), alloc(tuple.__getitem__(sub, 1)),
+                        len=sub.len)
+                else:
+                    kids = tuple(alloc(x) for x in sub)
+                whitespace_re = g.grammar_whitespace
+                if whitespace_re is True:
+                    whitespace_re = util._whitespace_re
+                alias = (len(sub) == 1 and g.grammar_desc != g.grammar_name)
+                code[pc] = (op, g, kids, g.grammar_min, g.grammar_max, g.grammar_greedy, whitespace_re,
+                            g.grammar_error_override, alias, g.grammar_possessive)
+            elif op in (OP_OR, OP_NOT, OP_EXCEPT):
+                code[pc] = (op, g, tuple(alloc(x) for x in g.grammar))
+            else:
+                code[pc] = (op, g, ())
+        return entry
+
+    def _frame(self, pc, index, text, sessiondata, memoize=True):
+        # REF instructions are resolved as they are reached and replaced by a frame
+        # for whatever they refer to (Reference.grammar_parse just passes through
+        # everything its target yields, so this is equivalent).
+        ins = self.code[pc]
+        memo = text.memo
+        while ins[0] == OP_REF:
+            if memo is None:
+                grammar = ins[1].resolve(sessiondata)
+            else:
+                grammar = memo.resolve(ins[1], sessiondata)
+            pc = self.lower(grammar)
+            ins = self.code[pc]
+        if not memoize or memo is None or ins[0] == OP_NATIVE:
+            # (Native grammars use the memo table through util.subparse.)
+            return _Frame(pc, ins[0], ins[1], index)
+        # The memo entry holds the grammar's own frame, which is run on our stack
+        # whenever the results recorded so far have all been replayed.
+        entry = memo.lookup(ins[1], index, self)
+        if entry is None:
+            entry = memo.store(ins[1], index, _Frame(pc, ins[0], ins[1], index), self)
+        f = _Frame(pc, OP_MEMO, ins[1], index)
+        f.entry = entry
+        f.count = 0
+        return f
+
+    def grammar_parse(self, text, index, sessiondata):
+        """
+        Attempt to match the compiled grammar against *text*, starting at *index*.  This is a generator with exactly the same behavior as :meth:`Grammar.grammar_parse`.
+        """
+        code = self.code
+        memo = text.memo
+        InternalError = modgrammar.InternalError
+        update_best_error = util.update_best_error
+        error_result = util.error_result
+
+        root = self._frame(self.entry, index, text, sessiondata, memoize=False)
+        stack = [root]
+        # 'result' holds the result just produced by a child frame (if any) for
+        # the frame on the top of the stack to consume.
+        result = None
+        while True:
+            f = stack[-1]
+            op = f.op
+            phase = f.phase
+
+            if op == OP_NATIVE:
+                gen = f.gen
+                if gen is None:
+                    gen = f.gen = util.subparse(f.grammar, text, f.index, sessiondata)
+                result = next(gen)
+                while result[0] is None:
+                    if text.eof and len(stack) > 1:
+                        # Subgrammars should not be asking for more data after eof.
+                        raise InternalError("{0} requested more data when at EOF".format(f.grammar))
+                    text = yield (None, None)
+                    result = gen.send(text)
+
+            elif op == OP_SEQ:
+                ins = code[f.pc]
+                cls = f.grammar
+                kids, grammar_min, grammar_max, greedy, whitespace_re = ins[2:7]
+                possessive = ins[9]
+                index = f.index
+                if phase == _START:
+                    f.objs = []
+                    f.states = []
+                    f.best_error = None
+                    f.pos = index
+                    f.first_pos = None
+                    phase = _FORWARD
+                objs = f.objs
+                states = f.states
+                pos = f.pos
+                while True:
+                    if phase == _FORWARD:
+                        phase = _FORWARD_NEXT
+                        if not greedy and len(objs) >= grammar_min:
+                            # If we're not "greedy", then try returning every match as soon as
+                            # we get it (which will naturally return the shortest matches first)
+                            result = (pos - index, (cls, index, pos, tuple(objs)))
+                            if possessive:
+                                # Only the first match counts.
+                                del states[:]
+                                phase = _FAILED
+                            break
+                    elif phase == _FORWARD_NEXT:
+                        if len(objs) >= grammar_max:
+                            phase = _BACKTRACK
+                            continue
+                        f.prews_pos = pos
+                        if whitespace_re:
+                            if text.binary:
+                                whitespace_re = util.binary_regexp(whitespace_re)
+                            while True:
+                                m = whitespace_re.match(text.string, pos)
+                                if m:
+                                    pos = m.end()
+                                if pos < len(text.string) or text.eof:
+                                    break
+                                text = yield (None, None)
+                        if f.first_pos is None:
+                            f.first_pos = pos
+                        phase = _FORWARD_RESULT
+                        f.child = self._frame(kids[len(objs)], pos, text, sessiondata)
+                        result = None
+                        break
+                    elif phase == _FORWARD_RESULT:
+                        offset, obj = result
+                        if offset is False:
+                            f.best_error = update_best_error(f.best_error, obj)
+                            pos = f.prews_pos
+                            phase = _BACKTRACK
+                            continue
+                        objs.append(obj)
+                        if not possessive or len(objs) < grammar_min:
+                            # (see Grammar.grammar_parse)
+                            states.append((pos, f.child))
+                        pos += offset
+                        phase = _FORWARD
+                    elif phase == _BACKTRACK:
+                        phase = _BACKTRACK_NEXT
+                        if greedy and len(objs) >= grammar_min:
+                            # If we are greedy, then return matches only after we've gone as far
+                            # forward as possible, while we're backtracking (returns the longest
+                            # matches first)
+                            result = (pos - index, (cls, index, pos, tuple(objs)))
+                            if possessive:
+                                # Only the first match counts.
+                                del states[:]
+                                phase = _FAILED
+                            break
+                    elif phase == _BACKTRACK_NEXT:
+                        if not states:
+                            phase = _FAILED
+                            continue
+                        pos, f.child = states[-1]
+                        phase = _BACKTRACK_RESULT
+                        result = None
+                        break
+                    elif phase == _BACKTRACK_RESULT:
+                        offset, obj = result
+                        if offset is False:
+                            f.best_error = update_best_error(f.best_error, obj)
+                            states.pop()
+                            objs.pop()
+                            phase = _BACKTRACK
+                            continue
+                        objs[-1] = obj
+                        pos += offset
+                        phase = _FORWARD
+                    else:
+                        # We've run out of possibilities.
+                        best_error = f.best_error
+                        if ins[7]:
+                            # grammar_error_override: report ourselves as the failed grammar.
+                            result = error_result(index, cls, text)
+                        elif best_error is None:
+                            # We're possessive, and stopped after our first match.
+                            result = error_result(index, cls, text)
+                        elif ins[8] and best_error[0] == f.first_pos:
+                            # We're just an alias with a custom grammar_desc (see
+                            # Grammar.grammar_parse)
+                            result = error_result(index, cls, text)
+                        else:
+                            result = error_result(*best_error)
+                        break
+                f.pos = pos
+                f.phase = phase
+                if result is None:
+                    stack.append(f.child)
+                    continue
+
+            elif op == OP_OR:
+                if phase == _START:
+                    f.alt = 0
+                    f.best_error = None
+                    f.order, f.count = f.grammar.grammar_alternatives(text, f.index)
+                    phase = _TRY
+                elif phase == _RESULT:
+                    if result[0] is False:
+                        f.best_error = update_best_error(f.best_error, result[1])
+                        f.alt += 1
+                        phase = _TRY
+                    else:
+                        f.phase = _RESUME
+                elif phase == _RESUME:
+                    f.phase = _RESULT
+                    stack.append(f.child)
+                    result = None
+                    continue
+                if phase == _TRY:
+                    order = f.order
+                    if f.alt < len(order) and (f.alt < f.count or f.best_error is None
+                                               or f.best_error[0] == f.index):
+                        f.phase = _RESULT
+                        f.child = self._frame(code[f.pc][2][order[f.alt]], f.index, text, sessiondata)
+                        stack.append(f.child)
+                        result = None
+                        continue
+                    result = error_result(*f.best_error)
+
+            elif op == OP_NOT:
+                if phase == _START:
+                    f.phase = _RESULT
+                    f.child = self._frame(code[f.pc][2][0], f.index, text, sessiondata)
+                    stack.append(f.child)
+                    result = None
+                    continue
+                elif phase == _RESULT and result[0] is False:
+                    # Subgrammar did not match.  Return a (successful) None match.
+                    f.phase = _FAILED
+                    result = (0, (f.grammar, f.index, f.index, ()))
+                else:
+                    # Either the subgrammar matched (which means we should consider this
+                    # a parse error), or we're being asked for another match, and there
+                    # isn't one.
+                    result = error_result(f.index, f.grammar, text)
+
+            elif op == OP_EXCEPT:
+                if phase == _START:
+                    f.best_error = None
+                    f.child = self._frame(code[f.pc][2][0], f.index, text, sessiondata)
+                    phase = _RESUME
+                elif phase == _RESULT:
+                    count, obj = result
+                    if count is False:
+                        best_error = update_best_error(f.best_error, obj)
+                        # (see ExceptionGrammar.grammar_parse)
+                        if best_error[0] == f.index:
+                            result = error_result(f.index, f.grammar, text)
+                        else:
+                            result = error_result(*best_error)
+                    elif self._excepted(f, text, count, sessiondata):
+                        phase = _RESUME
+                    else:
+                        f.phase = _RESUME
+                if phase == _RESUME:
+                    f.phase = _RESULT
+                    stack.append(f.child)
+                    result = None
+                    continue
+
+            elif op == OP_MEMO:
+                entry = f.entry
+                if phase == _RESULT:
+                    memo.record(entry, result)
+                elif f.count == len(entry.results) and not entry.done:
+                    f.phase = _RESULT
+                    stack.append(entry.state)
+                    result = None
+                    continue
+                f.phase = _RESUME
+                result = memo.replayed(entry.results[f.count])
+                f.count += 1
+
+            # The frame on top of the stack has produced a result.  Pass it back to
+            # whoever was waiting for it.
+            stack.pop()
+            if stack:
+                continue
+            yield result
+            if result[0] is False:
+                return
+            stack.append(root)
+            result = None
+
+    def _excepted(self, f, text, count, sessiondata):
+        # Check to make sure that the exception-grammar does NOT match the same
+        # part of the text string.
+        index = f.index
+        exc_text = modgrammar.Text(text.string[:index + count], bol=text.bol, eof=True)
+        exc_text.start = text.start
+        exc_text.fast_errors = text.fast_errors
+        for e_count, e_obj in f.grammar.grammar[1].grammar_parse(exc_text, index, sessiondata):
+            if e_count is None:
+                # Subgrammars should not be asking for more data after eof.
+                raise modgrammar.InternalError("{0} requested more data when at EOF".format(f.grammar.grammar[0]))
+            if e_count is False:
+                return False
+            return True
+        return False
@@ -257,6 +257,72 @@ class TestRepeat1_NoWS(util.BasicGrammarTestCase):
         self.fail_partials = (('ABC', 'ABx'), ('ABC ',), ('ABC', ' ABC'), ('ABC', ' '))
 
 
+class TestRepeatPossessive(util.BasicGrammarTestCase):
+    def setUp(self):
+        self.grammar = REPEAT('ABC', min=2, max=5, possessive=True)
+        self.grammar_name = "<REPEAT>"
+        self.grammar_details = "REPEAT(L('ABC'), min=2, max=5, possessive=True)"
+        self.subgrammar_types = (Literal, Literal, Literal, Literal, Literal)
+        self.terminal = False
+        self.matches = ('ABCABCABCABCABC', 'ABC ABC ABC ABC ABC')
+        self.matches_with_remainder = ('ABCABCx', 'ABCABCABCABx', 'ABC ABCx', 'ABC ABC x')
+        self.fail_matches = ('ABCx',)
+        self.partials = (('ABC', 'ABC', 'x'), ('ABCABC', 'x'), ('AB', 'CA', 'BC', 'x'), ('ABCABC', 'ABCABC', 'ABC'))
+        self.fail_partials = (('ABC', 'ABx'),)
+
+    def test_possessive(self):
+        self.assertFalse(REPEAT('ABC').grammar_possessive)
+        self.assertNotEqual(REPEAT('ABC', possessive=True), REPEAT('ABC'))
+        for compiled in (False, True):
+            p = REPEAT('ABC', min=0, max=3, possessive=True).parser(compiled=compiled)
+            o = p.parse_string('ABCABCABCABC', matchtype='all')
+            self.assertEqual([x.string for x in o], ['ABCABCABC'])
+            p = REPEAT('ABC', min=0, max=3, greedy=False, possessive=True).parser(compiled=compiled)
+            o = p.parse_string('ABCABCABCABC', matchtype='all')
+            self.assertEqual([x.string for x in o], [''])
+            # Won't give up a repetition to let the next element match
+            g = GRAMMAR(REPEAT('A', possessive=True, whitespace=False), 'A', whitespace=False)
+            with self.assertRaises(ParseError) as cm:
+                g.parser(compiled=compiled).parse_string('AAA', eof=True)
+            self.assertEqual(cm.exception.buffer_pos, 3)
+            self.assertEqual([x.grammar_desc for x in cm.exception.expected], ["'A'"])
+            # ...but will backtrack into the repetitions to get enough of them
+            g = REPEAT(OR('AA', 'A'), min=3, possessive=True, whitespace=False)
+            o = g.parser(compiled=compiled).parse_string('AAAAB', eof=True)
+            self.assertEqual([x.string for x in o.elements], ['AA', 'A', 'A'])
+
+    def test_list_of(self):
+        g = LIST_OF('A', sep=',', possessive=True)
+        self.assertEqual(g.grammar_details(), "LIST_OF(L('A'), sep=L(','), possessive=True)")
+        o = g.parser().parse_string('A,A,Ax', eof=True)
+        self.assertEqual(o.string, 'A,A,A')
+
+
+class TestAtomic(util.TestCase):
+    def test_atomic(self):
+        g = ATOMIC(WORD('a-z'), 'c')
+        self.assertTrue(issubclass(g, modgrammar.Atomic))
+        self.assertEqual(g.grammar_details(), "ATOMIC(WORD('a-z'), L('c'))")
+        self.assertEqual(ATOMIC('A').grammar_details(), "ATOMIC(L('A'))")
+        for compiled in (False, True):
+            # Backtracking inside the group still works...
+            o = g.parser(compiled=compiled).parse_string('abc', eof=True)
+            self.assertEqual([x.string for x in o.elements], ['ab', 'c'])
+            # ...but not into it from outside
+            g2 = GRAMMAR(ATOMIC(WORD('a-z')), 'c', whitespace=False)
+            with self.assertRaises(ParseError) as cm:
+                g2.parser(compiled=compiled).parse_string('abc', eof=True)
+            self.assertEqual(cm.exception.buffer_pos, 3)
+            o = GRAMMAR(WORD('a-z'), 'c', whitespace=False).parser(compiled=compiled).parse_string('abc', eof=True)
+            self.assertEqual(o.string, 'abc')
+
+    def test_collapsed(self):
+        o = GRAMMAR('x', ATOMIC('a'), 'y').parser().parse_string('x a y', eof=True)
+        self.assertEqual([type(e) for e in o.elements], [type(o[0]), type(o[1]), type(o[2])])
+        self.assertEqual([e.string for e in o.elements], ['x', 'a', 'y'])
+        self.assertIsInstance(o[1], Literal)
+
+
 class TestOptional(util.BasicGrammarTestCase):
     def setUp(self):
         self.grammar = OPTIONAL('ABC')
@@ -0,0 +1,138 @@
+from __future__ import with_statement
+
+import sys
+
+import modgrammar.util
+
+from modgrammar import *
+from modgrammar.extras import *
+from tests import memo, util
+
+grammar_whitespace = True
+
+
+class Expr(Grammar):
+    grammar = (OR(G('(', REF('Expr'), ')'), WORD('0-9')), ZERO_OR_MORE(OR('+', '-'), REF('Expr')))
+
+
+class Ident(Grammar):
+    grammar = (WORD('a-z') - OR('if', 'then'))
+
+
+class Statement(Grammar):
+    grammar = (Ident, '=', LIST_OF(Integer, sep=','), OPTIONAL(';'), NOT_FOLLOWED_BY('!'))
+
+
+class Nested(Grammar):
+    grammar = (OR(G('[', REF('Nested'), ']', whitespace=False), 'x'),)
+
+
+class Alias(Grammar):
+    grammar = (WORD('0-9'),)
+    grammar_desc = 'a number'
+
+
+class Override(Grammar):
+    grammar = ('a', 'b')
+    grammar_error_override = True
+
+
+cases = [
+    (Expr, ['1', '1+2', '(1 + 2) - 3', '((1))+(2-3)', '(1', '1+', '+', '', ')']),
+    (Statement, ['abc = 1, 2, 3;', 'abc=1', 'if = 1', 'x = 1,2!', 'x = -1, 2 ;', 'x =', 'x = 1,']),
+    (REPEAT(WORD('a', max=2), greedy=False), ['aaaaa', 'a', '']),
+    (REPEAT(WORD('ab'), WORD('b'), min=2), ['abbabb', 'abab', 'bbbbb', 'a']),
+    (G(OPTIONAL('a'), 'ab'), ['ab', 'aab', 'b']),
+    (OR('aa', 'aaaa', 'a', 'aaa'), ['aaaa', 'b']),
+    (G(Alias, ';'), ['12;', 'x', '12']),
+    (G(Override, 'c'), ['abc', 'ax', 'abx']),
+    (G(QuotedString, EOL, BOL, REST_OF_LINE, EOL, EOF), ["'a\\'b'\nrest of it\n", "'x'\nfoo"]),
+    (G(ANY, ANY_EXCEPT('x'), SPACE, EMPTY, whitespace=False), ['ab  c', 'ax', 'a']),
+]
+
+
+def describe(results):
+    if results is None:
+        return None
+    return [(x.string, repr(x), [type(t).__name__ for t in x.terminals()]) if x is not None else None
+            for x in results]
+
+
+def run(parser, func):
+    try:
+        return ('ok', func(parser))
+    except ParseError as e:
+        return ('error', e.buffer_pos, e.char, e.line, e.col, sorted(g.grammar_desc for g in e.expected), e.message)
+
+
+class TestCompiled(util.TestCase):
+    def assertSameResults(self, grammar, func):
+        expected = run(grammar.parser(), func)
+        actual = run(grammar.parser(compiled=True), func)
+        self.assertEqual(expected, actual)
+
+    def test_matchtype_all(self):
+        for grammar, texts in cases:
+            for text in texts:
+                self.assertSameResults(grammar, lambda p: describe(p.parse_string(text, eof=True, matchtype='all')))
+
+    def test_first(self):
+        for grammar, texts in cases:
+            for text in texts:
+                self.assertSameResults(grammar, lambda p: describe([p.parse_string(text, eof=True)]) + [p.remainder()])
+
+    def test_incremental(self):
+        for grammar, texts in cases:
+            for text in texts:
+                self.assertSameResults(grammar, lambda p: describe(p.parse_lines(list(text), eof=True)))
+
+    def test_program(self):
+        program = Expr.compile()
+        self.assertEqual(program.grammar, Expr)
+        # Expr refers to itself via REF, which is only resolved at runtime.
+        self.assertTrue(len(program) > 1)
+        p = Expr.parser(compiled=True)
+        self.assertEqual(p.parse_string('1+2', eof=True).string, '1+2')
+        p = Expr.parser(compiled=True, memoize=True)
+        self.assertEqual(p.parse_string('(1+2)-3', eof=True).string, '(1+2)-3')
+
+    def test_deep_nesting(self):
+        depth = sys.getrecursionlimit() // 3
+        text = '[' * depth + 'x' + ']' * depth
+        with self.assertRaises(RuntimeError):
+            Nested.parser().parse_string(text, eof=True)
+        for memoize in (False, True):
+            p = Nested.parser(compiled=True, memoize=memoize)
+            o = p.parse_string(text, eof=True, matchtype='all')
+            self.assertEqual(len(o), 1)
+
+    def test_memoize(self):
+        for grammar, texts in cases:
+            for text in texts:
+                func = lambda p: describe(p.parse_string(text, eof=True, matchtype='all'))
+                self.assertEqual(run(grammar.parser(), func), run(grammar.parser(compiled=True, memoize=True), func))
+        del memo.calls[:]
+        o = memo.Backtracking.parser(compiled=True, memoize=True).parse_string('abc3')
+        self.assertEqual(o.string, 'abc3')
+        self.assertEqual(len(memo.calls), 1)
+
+    def test_memoize_lookups(self):
+        # Sequences and alternatives go through the memo table too, not just
+        # grammars which are run natively.
+        lookups = []
+        lookup = modgrammar.util.ParseMemo.lookup
+
+        def record(self, grammar, *args, **kwargs):
+            lookups.append(grammar)
+            return lookup(self, grammar, *args, **kwargs)
+
+        modgrammar.util.ParseMemo.lookup = record
+        try:
+            memo.Backtracking.parser(memoize=True).parse_string('abc3')
+            expected = sorted(map(repr, lookups))
+            del lookups[:]
+            memo.Backtracking.parser(compiled=True, memoize=True).parse_string('abc3')
+            actual = sorted(map(repr, lookups))
+        finally:
+            modgrammar.util.ParseMemo.lookup = lookup
+        self.assertEqual(expected, actual)
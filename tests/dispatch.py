@@ -0,0 +1,160 @@
+from __future__ import with_statement
+
+from modgrammar import *
+from modgrammar import util as mg_util
+from modgrammar.extras import RE
+from tests import util
+
+grammar_whitespace = False
+
+calls = []
+
+class Counted(Grammar):
+    grammar = (WORD('a-z'),)
+
+    @classmethod
+    def grammar_parse(cls, text, index, sessiondata):
+        calls.append(cls.grammar_name)
+        return Grammar.grammar_parse.__func__(cls, text, index, sessiondata)
+
+    @classmethod
+    def grammar_first(cls, visited):
+        return mg_util.sequence_first(cls, visited)
+
+
+class CountedA(Counted):
+    grammar = (L('a'), WORD('a-z', min=0))
+
+
+class CountedB(Counted):
+    grammar = (L('b'), WORD('a-z', min=0))
+
+
+class CountedAny(Counted):
+    grammar = (WORD('a-z'),)
+
+    @classmethod
+    def grammar_first(cls, visited):
+        return (None, False)
+
+
+class Dispatch(Grammar):
+    grammar = (OR(CountedA, CountedB, CountedAny),)
+
+
+class SeqGrammar(Grammar):
+    grammar_whitespace = True
+    grammar = (L('x'), L('y'))
+
+
+class ErrorGrammar(Grammar):
+    grammar = (OR(L('a'), L('b'), G(L('c'), L('d')), EMPTY), L(';'))
+
+
+class TestFirstSets(util.TestCase):
+    def test_first_sets(self):
+        self.assertEqual(mg_util.first_set(L('abc')), (['a'], False))
+        self.assertEqual(mg_util.first_set(L('')), ([], True))
+        self.assertEqual(mg_util.first_set(WORD('0-9')), (['[0-9]'], False))
+        self.assertEqual(mg_util.first_set(WORD('0-9', min=0))[1], True)
+        self.assertEqual(mg_util.first_set(G(OPTIONAL(L('-')), L('1'))), (['\\-', '1'], False))
+        self.assertEqual(mg_util.first_set(OR(L('a'), L('b'))), (['a', 'b'], False))
+        self.assertEqual(mg_util.first_set(SeqGrammar), (['\\s', 'x'], False))
+        self.assertEqual(mg_util.first_set(REPEAT(L('a'), min=0)), (['a'], True))
+        self.assertEqual(mg_util.first_set(LIST_OF(L('a'))), (['a'], False))
+        self.assertEqual(mg_util.first_set(RE('[ab]c*')), (['[ab]'], False))
+        self.assertEqual(mg_util.first_set(EXCEPT(WORD('a-z'), L('if'))), (['[a-z]'], False))
+        self.assertEqual(mg_util.first_set(G(NOT_FOLLOWED_BY(L('a')), L('b'))), (['b'], False))
+        self.assertEqual(mg_util.first_set(G(BOL, L('b'), EOF)), (['b'], False))
+        self.assertEqual(mg_util.first_set(ANY), (None, False))
+        self.assertEqual(mg_util.first_set(REF('Dispatch')), (None, True))
+        self.assertEqual(mg_util.first_set(Counted), (['[a-z]'], False))
+        self.assertEqual(mg_util.first_set(CountedAny), (None, False))
+
+    def test_circular(self):
+        class Loop(Grammar):
+            grammar = (OPTIONAL(L('a')), REF('Loop', module=None))
+        Loop.grammar_resolve_refs(refmap={'Loop': Loop})
+        self.assertEqual(mg_util.first_set(Loop), (None, True))
+
+
+class TestDispatch(util.TestCase):
+    def test_skips_alternatives(self):
+        del calls[:]
+        o = Dispatch.parser().parse_string('bcd', eof=True)
+        self.assertEqual(o.string, 'bcd')
+        self.assertEqual(calls, ['CountedB'])
+        del calls[:]
+        o = Dispatch.parser().parse_string('xyz', eof=True)
+        self.assertEqual(o.string, 'xyz')
+        self.assertEqual(calls, ['CountedAny'])
+
+    def test_partial_input(self):
+        del calls[:]
+        p = Dispatch.parser()
+        self.assertIsNone(p.parse_string(''))
+        o = p.parse_string('a', eof=True)
+        self.assertEqual(o.string, 'a')
+        self.assertEqual(calls, ['CountedA'])
+
+    def test_errors(self):
+        p = ErrorGrammar.parser()
+        with self.assertRaises(ParseError) as cm:
+            p.parse_string('x', eof=True)
+        self.assertEqual(cm.exception.buffer_pos, 0)
+        self.assertEqual(sorted(g.grammar_desc for g in cm.exception.expected), ["';'", "'a'", "'b'", "'c'", "(nothing)"])
+        p = ErrorGrammar.parser()
+        with self.assertRaises(ParseError) as cm:
+            p.parse_string('cx', eof=True)
+        self.assertEqual(cm.exception.buffer_pos, 1)
+        self.assertEqual(sorted(g.grammar_desc for g in cm.exception.expected), ["'d'"])
+        for compiled in (False, True):
+            p = ErrorGrammar.parser(compiled=compiled)
+            o = p.parse_string('b;', eof=True)
+            self.assertEqual(o.string, 'b;')
+
+
+class TestLiteralTrie(util.TestCase):
+    def test_trie(self):
+        trie = mg_util.LiteralTrie(['a', 'ab', 'abc', 'b', 'a'])
+        self.assertEqual(trie.match('abd', 0, False), ([0, 4, 1], []))
+        self.assertEqual(trie.match('ab', 0, False), ([0, 4, 1], [2]))
+        self.assertEqual(trie.match('ab', 0, True), ([0, 4, 1], []))
+        self.assertEqual(trie.match('xb', 1, False), ([3], []))
+
+    def test_literal_or(self):
+        grammar = OR(L('a'), L('abc'), L('ab'))
+        self.assertIsNotNone(grammar.grammar_literal_trie())
+        self.assertIsNone(OR(L('a'), WORD('b')).grammar_literal_trie())
+        matches = grammar.parser().parse_string('abc', eof=True, matchtype='all')
+        self.assertEqual([m.string for m in matches], ['a', 'abc', 'ab'])
+
+    def test_literal_or_partial(self):
+        p = OR(L('ab'), L('a')).parser()
+        self.assertIsNone(p.parse_string('a'))
+        o = p.parse_string('c')
+        self.assertEqual(o.string, 'a')
+        self.assertEqual(p.remainder(), 'c')
+        p = EOL.parser()
+        self.assertIsNone(p.parse_string('\r'))
+        o = p.parse_string('\n')
+        self.assertEqual(o.string, '\r\n')
+
+    def test_literal_or_backtrack_at_eof(self):
+        # 'lett' was only a partial match when 'let' was tried, but by the time
+        # we backtrack into the OR, we're at EOF and it can't match any more.
+        grammar = G(OR(L('let'), L('lett')), L('x'), whitespace=False)
+        p = grammar.parser()
+        self.assertIsNone(p.parse_string('let'))
+        with self.assertRaises(ParseError) as cm:
+            p.parse_string('y', eof=True)
+        self.assertEqual(cm.exception.buffer_pos, 3)
+        p = grammar.parser()
+        self.assertIsNone(p.parse_string('let'))
+        self.assertEqual(p.parse_string('tx', eof=True).string, 'lettx')
+
+    def test_literal_or_errors(self):
+        with self.assertRaises(ParseError) as cm:
+            G(L('x'), OR(L('ab'), L('ac'))).parser().parse_string('xad', eof=True)
+        self.assertEqual(cm.exception.buffer_pos, 1)
+        self.assertEqual(sorted(g.grammar_desc for g in cm.exception.expected), ["'ab'", "'ac'"])
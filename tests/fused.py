@@ -0,0 +1,77 @@
+from __future__ import with_statement
+
+from modgrammar import *
+from modgrammar import util as mg_util
+from modgrammar.extras import RE, QuotedString
+from tests import util
+
+grammar_whitespace = False
+
+
+class LogLine(Grammar):
+    grammar = (WORD('0-9'), L('-'), WORD('0-9'), SPACE, L('['), WORD('A-Z'), L(']'), SPACE, REST_OF_LINE, L('\n'))
+
+
+class Spaced(Grammar):
+    grammar_whitespace = True
+    grammar = (WORD('a-z'), L('='), WORD('0-9'))
+
+
+class Overlapping(Grammar):
+    grammar = (WORD('a-z'), WORD('a-z'))
+
+
+cases = [
+    (LogLine, ['12-34 [INFO] hello there\n', '12-34 [INFO] hello', '12-3x [INFO]\n', '1']),
+    (Spaced, ['abc = 123', 'abc=1 ', '  a =', 'a 1', '']),
+    (Overlapping, ['abc', 'a', 'ab1']),
+    (QuotedString, ["'abc'", "'a\\'bc' x", "'abc"]),
+    (G(RE('[a-c]+'), RE('c*x')), ['abcx', 'abcc', 'ax']),
+]
+
+
+def run(grammar, text, eof, matchtype):
+    p = grammar.parser()
+    try:
+        if matchtype == 'incremental':
+            results = [p.parse_string(c) for c in text]
+            results.append(p.parse_string('', eof=True))
+        elif matchtype == 'all':
+            results = p.parse_string(text, eof=eof, matchtype='all') or []
+        else:
+            results = [p.parse_string(text, eof=eof)]
+    except ParseError as e:
+        return ('error', e.buffer_pos, sorted(g.grammar_desc for g in e.expected))
+    return ([(repr(x), [(type(t).__name__, t.string) for t in x.terminals()]) if x is not None else None
+             for x in results], p.remainder())
+
+
+class TestFused(util.TestCase):
+    def test_fusable(self):
+        for grammar, texts in cases:
+            self.assertIsNotNone(mg_util.fused_sequence(grammar), grammar)
+        self.assertIsNone(mg_util.fused_sequence(G(WORD('a-z', greedy=False), L('x'))))
+        self.assertIsNone(mg_util.fused_sequence(G(WORD('a-z', min=2), L('x'))))
+        self.assertIsNone(mg_util.fused_sequence(G(RE('^a'), L('x'))))
+        self.assertIsNone(mg_util.fused_sequence(G(RE(r'(a)\1'), L('x'))))
+        self.assertIsNone(mg_util.fused_sequence(G(OPTIONAL(L('a')), L('x'))))
+        self.assertIsNone(mg_util.fused_sequence(REPEAT(L('a'))))
+
+    def test_same_results(self):
+        for grammar, texts in cases:
+            for text in texts:
+                for eof in (True, False):
+                    for matchtype in ('first', 'all', 'incremental'):
+                        fused = run(grammar, text, eof, matchtype)
+                        grammar._fused = (grammar.grammar, None)
+                        try:
+                            normal = run(grammar, text, eof, matchtype)
+                        finally:
+                            del grammar._fused
+                        self.assertEqual(fused, normal, (grammar, text, eof, matchtype))
+
+    def test_backtracking(self):
+        # The fused regexp only provides the first match.  Anything after that
+        # has to come from the normal engine.
+        o = G(Overlapping, L('c')).parser().parse_string('abc', eof=True)
+        self.assertEqual([e.string for e in o[0].elements], ['a', 'b'])
@@ -0,0 +1,82 @@
+from __future__ import with_statement
+
+from modgrammar import *
+from tests import util
+
+grammar_whitespace = False
+
+calls = []
+
+class Counted(Grammar):
+    grammar = (WORD('a-z'),)
+
+    @classmethod
+    def grammar_parse(cls, text, index, sessiondata):
+        calls.append(index)
+        return Grammar.grammar_parse.__func__(cls, text, index, sessiondata)
+
+
+class Backtracking(Grammar):
+    grammar = (OR(G(Counted, '1'), G(Counted, '2'), G(Counted, '3')),)
+
+
+class Nested(Grammar):
+    grammar = (OR(G('(', REF('Nested'), ')', '+'), G('(', REF('Nested'), ')', '-'), 'x'),)
+
+
+class TestMemoize(util.TestCase):
+    def test_memo_reuses_results(self):
+        del calls[:]
+        o = Backtracking.parser().parse_string('abc3')
+        self.assertEqual(o.string, 'abc3')
+        self.assertEqual(len(calls), 3)
+        del calls[:]
+        p = Backtracking.parser(memoize=True)
+        o = p.parse_string('abc3')
+        self.assertEqual(o.string, 'abc3')
+        self.assertEqual(len(calls), 1)
+
+    def test_memo_same_results(self):
+        text = '(' * 8 + 'x' + ')-' * 8
+        p1 = Nested.parser()
+        p2 = Nested.parser(memoize=True)
+        o1 = p1.parse_string(text)
+        o2 = p2.parse_string(text)
+        self.assertEqual(repr(o1), repr(o2))
+        self.assertEqual(o2.string, text)
+
+    def test_memo_errors(self):
+        p1 = Backtracking.parser()
+        p2 = Backtracking.parser(memoize=True)
+        with self.assertRaises(ParseError) as c1:
+            p1.parse_string('abc4')
+        with self.assertRaises(ParseError) as c2:
+            p2.parse_string('abc4')
+        self.assertEqual(c1.exception.buffer_pos, c2.exception.buffer_pos)
+        self.assertEqual(c1.exception.expected, c2.exception.expected)
+
+    def test_memo_partial(self):
+        p = Backtracking.parser(memoize=True)
+        self.assertIsNone(p.parse_string('ab'))
+        self.assertIsNone(p.parse_string('c'))
+        o = p.parse_string('2')
+        self.assertEqual(o.string, 'abc2')
+
+    def test_memo_cleared(self):
+        p = Backtracking.parser(memoize=True)
+        p.parse_string('abc3abc')
+        self.assertEqual(len(p.memo), 0)
+        p.parse_string('1', eof=True)
+        p.reset()
+        self.assertEqual(len(p.memo), 0)
+
+    def test_memo_bounded(self):
+        p = Nested.parser(memo_entries=4)
+        text = '(' * 8 + 'x' + ')-' * 8
+        o = p.parse_string(text)
+        self.assertEqual(o.string, text)
+        self.assertLessEqual(len(p.memo), 4)
+        p = Nested.parser(memo_bytes=1)
+        o = p.parse_string(text)
+        self.assertEqual(o.string, text)
+        self.assertLessEqual(len(p.memo), 1)
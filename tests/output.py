@@ -0,0 +1,452 @@
+from __future__ import with_statement
+
+import io
+import os
+import pickle
+import tempfile
+
+from modgrammar import *
+from modgrammar import arena
+from modgrammar import util as mg_util
+from modgrammar.extras import QuotedString
+from tests import util
+
+grammar_whitespace = False
+
+
+class Key(Grammar):
+    grammar = (WORD('a-z'),)
+    grammar_tags = ('key',)
+
+    def elem_init(self, sessiondata):
+        self.name = self.string.upper()
+
+
+class Value(Grammar):
+    grammar = (QuotedString | WORD('0-9'))
+    grammar_collapse = True
+
+
+class Pair(Grammar):
+    grammar = (Key, L('='), Value)
+
+
+class Pairs(Grammar):
+    grammar = (LIST_OF(Pair, sep=L(';')), OPTIONAL(L(';')))
+
+
+class KeyPair(Grammar):
+    grammar_whitespace = True
+    grammar = (Key, Key)
+
+
+class Nest(Grammar):
+    grammar = (L('('), REPEAT(REF('Item'), min=0), L(')'))
+    grammar_tags = ('nest',)
+
+
+class Item(Grammar):
+    grammar = (Nest | Key)
+    grammar_collapse = True
+
+
+# Two separate classes which compare equal (grammar classes compare by structure)
+Semi = L(';')
+OtherSemi = L(';')
+
+
+class Twins(Grammar):
+    grammar = (Semi, L('x'), OtherSemi)
+
+
+def describe(o):
+    # A (hopefully) complete picture of everything about a result tree which
+    # should be the same no matter how it's represented.
+    if o is None:
+        return None
+    return (o.__class__.grammar_name, o.string, len(o), bool(o), [describe(e) for e in o.elements])
+
+
+class TestCompact(util.TestCase):
+    text = "abc=12;de='x;y';f=3;"
+
+    def test_same_results(self):
+        normal = Pairs.parser().parse_string(self.text, eof=True)
+        compact = Pairs.parser(output='compact').parse_string(self.text, eof=True)
+        self.assertEqual(describe(compact), describe(normal))
+        self.assertEqual(repr(compact), repr(normal))
+        self.assertEqual(compact.tokens(), normal.tokens())
+        self.assertEqual([k.name for k in compact.find_all(Key)], ['ABC', 'DE', 'F'])
+        self.assertEqual([k.string for k in compact.find_tag_all('key')], ['abc', 'de', 'f'])
+        self.assertEqual(compact.find(QuotedString).value, 'x;y')
+
+    def test_compact_objects(self):
+        o = Pairs.parser(output='compact').parse_string(self.text, eof=True)
+        pair = o.find(Pair)
+        self.assertIsInstance(pair, Pair)
+        self.assertIs(type(pair), mg_util.compact_class(Pair))
+        self.assertIs(pair.parent.parent, o)
+        self.assertIs(pair[0].parent, pair)
+        self.assertEqual((pair.start, pair.end), (0, 6))
+        self.assertIs(pair.source, o.source)
+        self.assertEqual(o.source[o[0][2].start:o[0][2].end], 'de=\'x;y\'')
+        self.assertEqual(o[0][2].string, 'de=\'x;y\'')
+        self.assertFalse(hasattr(pair, '_str_info'))
+
+    def test_compact_class(self):
+        literal = L('abc')
+        twin = mg_util.compact_class(literal)
+        self.assertIs(mg_util.compact_class(literal), twin)
+        self.assertEqual(twin.string, 'abc')
+        self.assertEqual(twin.grammar_name, literal.grammar_name)
+
+    def test_equal_classes(self):
+        normal = Twins.parser().parse_string(';x;', eof=True)
+        compact = Twins.parser(output='compact').parse_string(';x;', eof=True)
+        self.assertEqual(describe(compact), describe(normal))
+        self.assertIs(type(compact[0]), mg_util.compact_class(Semi))
+        self.assertIs(type(compact[2]), mg_util.compact_class(OtherSemi))
+        for cls in (Semi, OtherSemi):
+            self.assertEqual([[e is x for x in normal] for e in normal.find_all(cls)],
+                             [[e is x for x in compact] for e in compact.find_all(cls)])
+
+    def test_pickle(self):
+        o = KeyPair.parser(output='compact').parse_string('ab cd', eof=True)
+        o2 = pickle.loads(pickle.dumps(o))
+        self.assertIs(type(o2), mg_util.compact_class(KeyPair))
+        self.assertEqual(describe(o2), describe(o))
+        self.assertEqual(o2[1].name, 'CD')
+        self.assertIs(o2[1].parent, o2)
+
+    def test_bad_output(self):
+        with self.assertRaises(ValueError):
+            Pairs.parser(output='bogus')
+
+
+class TestArena(util.TestCase):
+    texts = [
+        (Pairs, "abc=12;de='x;y';f=3;"),
+        (Pairs, "a=1"),
+        (G(OPTIONAL(L('-')), WORD('0-9'), REPEAT(L('x'), collapse=True, min=0)), '12'),
+        (G(OPTIONAL(L('-')), WORD('0-9'), REPEAT(L('x'), collapse=True, min=0)), '-12xx'),
+        (REPEAT(G(L('a'), OPTIONAL(L('b')), grammar_collapse=True)), 'aaba'),
+    ]
+
+    def test_same_results(self):
+        for grammar, text in self.texts:
+            normal = grammar.parser().parse_string(text, eof=True)
+            arena = grammar.parser(output='arena').parse_string(text, eof=True)
+            self.assertEqual(describe(arena), describe(normal), (grammar, text))
+            self.assertEqual(arena.tokens(), normal.tokens())
+
+    def test_queries(self):
+        o = Pairs.parser(output='arena').parse_string("abc=12;de='x;y';f=3;", eof=True)
+        self.assertIsInstance(o, Pairs)
+        self.assertEqual([k.string for k in o.find_all(Key)], ['abc', 'de', 'f'])
+        self.assertEqual([k.string for k in o.find_tag_all('key')], ['abc', 'de', 'f'])
+        self.assertEqual([w.string for w in o.find_all(Pair, Word)], ['abc', '12', 'de', 'f', '3'])
+        self.assertEqual(o.find(QuotedString).string, "'x;y'")
+        self.assertIsNone(o.get(Pair))
+        self.assertEqual(len(o[0].get_all(Pair)), 3)
+        pair = o.find(Pair)
+        self.assertEqual(pair.parent.parent, o)
+        self.assertEqual((pair.start, pair.end), (0, 6))
+        self.assertEqual(pair[0].parent, pair)
+
+    def test_arrays(self):
+        o = Pairs.parser(output='arena').parse_string("a=1;b=2", eof=True)
+        tree = o.tree
+        self.assertEqual(len(tree), len(tree.start))
+        self.assertEqual(tree.parent[0], -1)
+        for i in range(1, len(tree)):
+            # Every node comes after its parent, and is within its span
+            p = tree.parent[i]
+            self.assertTrue(0 <= p < i)
+            self.assertTrue(tree.start[p] <= tree.start[i] <= tree.end[i] <= tree.end[p])
+        keys = [i for i in range(len(tree)) if tree.grammars[tree.gid[i]] is Key]
+        self.assertEqual([tree.source[tree.start[i]:tree.end[i]] for i in keys], ['a', 'b'])
+
+    def test_matchtype_all(self):
+        results = G(WORD('a-z'), WORD('a-z')).parser(output='arena').parse_string('abc', eof=True, matchtype='all')
+        self.assertEqual([[e.string for e in r.elements] for r in results], [['ab', 'c'], ['a', 'bc'], ['a', 'b']])
+
+
+class TestStoredTree(util.TestCase):
+    def roundtrip(self, o, grammar):
+        f = io.BytesIO()
+        o.dump_tree(f)
+        return load_tree(f.getvalue(), grammar)
+
+    def test_same_results(self):
+        for grammar, text in TestArena.texts:
+            normal = grammar.parser().parse_string(text, eof=True)
+            for output in ('objects', 'compact', 'arena'):
+                o = grammar.parser(output=output).parse_string(text, eof=True)
+                stored = self.roundtrip(o, grammar)
+                self.assertIsInstance(stored, arena.StoredNode)
+                self.assertEqual(describe(stored), describe(normal), (grammar, text, output))
+                self.assertEqual(stored.tokens(), normal.tokens())
+                self.assertEqual(repr(stored), repr(normal))
+
+    def test_queries(self):
+        o = self.roundtrip(Pairs.parser().parse_string("abc=12;de='x;y';f=3;", eof=True), Pairs)
+        self.assertIsInstance(o, Pairs)
+        self.assertEqual([k.string for k in o.find_all(Key)], ['abc', 'de', 'f'])
+        self.assertEqual([k.string for k in o.find_tag_all('key')], ['abc', 'de', 'f'])
+        self.assertEqual([w.string for w in o.find_all(Pair, Word)], ['abc', '12', 'de', 'f', '3'])
+        self.assertEqual(o.find(QuotedString).string, "'x;y'")
+        self.assertIsNone(o.get(Pair))
+        pair = o.find(Pair)
+        self.assertEqual((pair.start, pair.end), (0, 6))
+        self.assertEqual(o.find_all(Pair)[1].string, "de='x;y'")
+        self.assertEqual((o.find_all(Pair)[1].start, o.find_all(Pair)[1].end), (7, 15))
+        self.assertEqual(pair.parent.parent, o)
+        self.assertEqual(pair[0].parent, pair)
+        self.assertEqual(o.find(Pair), pair)
+
+    def test_whitespace(self):
+        for output in ('objects', 'compact'):
+            o = self.roundtrip(KeyPair.parser(output=output).parse_string('ab  cd', eof=True), KeyPair)
+            self.assertEqual([(k.start, k.end) for k in o.elements], [(0, 2), (4, 6)])
+
+    def test_binary(self):
+        o = Pairs.parser().parse_string(b"a=1;b='x'", eof=True)
+        stored = self.roundtrip(o, Pairs)
+        self.assertEqual(stored.find(QuotedString).string, b"'x'")
+        self.assertEqual(stored.tokens(), o.tokens())
+
+    def test_file(self):
+        o1 = Pairs.parser().parse_string("a=1;b=2", eof=True)
+        o2 = Nest.parser().parse_string("(a(b)c)", eof=True)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with open(path, 'wb') as f:
+                o1.dump_tree(f)
+                o2.dump_tree(f)
+            with open(path, 'rb') as f:
+                s1 = load_tree(f, Pairs)
+                s2 = load_tree(f, Nest)
+                self.assertEqual(f.read(), b'')
+            self.assertEqual(describe(s1), describe(o1))
+            self.assertEqual(describe(s2), describe(o2))
+            # (File names have to be text strings, since bytes are data)
+            self.assertEqual(describe(load_tree(u'{0}'.format(path), Pairs)), describe(o1))
+        finally:
+            os.remove(path)
+
+    def test_grammar_table(self):
+        o = Pairs.parser().parse_string("a=1", eof=True)
+        f = io.BytesIO()
+        o.dump_tree(f)
+        with self.assertRaises(ValueError):
+            load_tree(f.getvalue(), Nest)
+        with self.assertRaises(ValueError):
+            load_tree(b'bogus', Pairs)
+        # Classes which aren't part of the given grammar are pickled, and are only
+        # loaded if that's explicitly allowed
+        f = io.BytesIO()
+        o.dump_tree(f, grammar=Key)
+        with self.assertRaises(ValueError):
+            load_tree(f.getvalue(), Key)
+        stored = load_tree(f.getvalue(), Key, allow_pickle=True)
+        self.assertEqual(describe(stored), describe(o))
+        self.assertIs(stored.__class__, Pairs)
+
+    def test_size(self):
+        text = ";".join("{0}={1}".format(chr(97 + i % 26) * 3, i) for i in range(200))
+        o = Pairs.parser().parse_string(text, eof=True)
+        f = io.BytesIO()
+        o.dump_tree(f)
+        self.assertLess(len(f.getvalue()) * 4, len(pickle.dumps(o, pickle.HIGHEST_PROTOCOL)))
+
+
+def object_events(o):
+    # The events parse_events should produce for a (normal) result object
+    # (with the text of each element in place of its position)
+    if o is None:
+        return []
+    if o.grammar_terminal:
+        return [('terminal', o.__class__.grammar_name, o.string)]
+    events = [('enter', o.__class__.grammar_name, o.string)]
+    for e in o.elements:
+        events.extend(object_events(e))
+    events.append(('exit', o.__class__.grammar_name, o.string))
+    return events
+
+
+class TestEvents(util.TestCase):
+    def events(self, grammar, lines):
+        text = ''.join(lines)
+        events = []
+        for event, g, start, end, string in grammar.parser().parse_events(lines):
+            if event == 'terminal':
+                self.assertEqual(string, text[start:end])
+            events.append((event, g.grammar_name, text[start:end]))
+        return events
+
+    def test_same_results(self):
+        for grammar, text in TestArena.texts:
+            normal = grammar.parser().parse_string(text, eof=True)
+            self.assertEqual(self.events(grammar, [text]), object_events(normal), (grammar, text))
+
+    def test_multiple_matches(self):
+        record = G(Pair, L(';'))
+        expected = []
+        for text in ("a=1;", "bc='x;y';", "d=2;"):
+            expected.extend(object_events(record.parser().parse_string(text, eof=True)))
+        self.assertEqual(self.events(record, ["a=1;b", "c='x;y';d", "=2;"]), expected)
+
+    def test_handlers(self):
+        seen = []
+        handlers = {
+            Pair: lambda event, grammar, start, end, string: seen.append((event, start, end)),
+            'key': lambda event, grammar, start, end, string: seen.append((event, grammar.grammar_name)),
+        }
+        result = Pairs.parser().parse_events(["ab=1;c", "d=2"], handlers=handlers)
+        self.assertIsNone(result)
+        self.assertEqual(seen, [
+            ('enter', 0, 4), ('enter', 'Key'), ('exit', 'Key'), ('exit', 0, 4),
+            ('enter', 5, 9), ('enter', 'Key'), ('exit', 'Key'), ('exit', 5, 9),
+        ])
+
+
+class TestIndex(util.TestCase):
+    text = "(ab(cd(e)f)(g)h)"
+    queries = [
+        ('type', (Nest,)), ('type', (Key,)), ('type', (Nest, Key)), ('type', (Nest, Nest)),
+        ('type', (Nest, Nest, Key)), ('type', (Grammar,)), ('type', ((Key, Nest),)), ('type', (Pair,)),
+        ('tag', ('key',)), ('tag', ('nest', 'key')), ('tag', ('nest', 'nest')), ('tag', ('bogus',)),
+    ]
+
+    def run_queries(self, o):
+        results = []
+        for node in [o] + o.find_all(Nest) + o.find_all(Key):
+            for kind, path in self.queries:
+                if kind == 'tag':
+                    found = node.find_tag_all(*path)
+                    first = node.find_tag(*path)
+                else:
+                    found = node.find_all(*path)
+                    first = node.find(*path)
+                self.assertIs(first, found[0] if found else None)
+                results.append([(e.__class__.grammar_name, e.string, id(e)) for e in found])
+        return results
+
+    def test_same_results(self):
+        for output in ('objects', 'compact'):
+            o = Nest.parser(output=output).parse_string(self.text, eof=True)
+            normal = self.run_queries(o)
+            self.assertEqual([k.string for k in o.find_all(Key)], ['ab', 'cd', 'e', 'f', 'g', 'h'])
+            self.assertEqual([k.string for k in o.find_all(Nest, Key)], ['cd', 'e', 'f', 'g'])
+            o.build_index()
+            self.assertIsNotNone(mg_util.tree_index(o[1][1]))
+            self.assertEqual(self.run_queries(o), normal)
+
+    def test_equal_classes(self):
+        o = Twins.parser().parse_string(';x;', eof=True)
+        normal = [(o.find_all(cls), o.find(cls)) for cls in (Semi, OtherSemi)]
+        self.assertEqual([(len(found), first is found[0]) for found, first in normal], [(1, True), (1, True)])
+        o.build_index()
+        self.assertEqual([(o.find_all(cls), o.find(cls)) for cls in (Semi, OtherSemi)], normal)
+        self.assertIs(o.find(Semi), o[0])
+        self.assertIs(o.find(OtherSemi), o[2])
+
+    def test_parser_option(self):
+        for index in (True, 'lazy'):
+            o = Nest.parser(index=index).parse_string(self.text, eof=True)
+            self.assertIsInstance(o._tree_index, mg_util.TreeIndex)
+            self.assertEqual(o._tree_index.nodes is None, index == 'lazy')
+            self.assertEqual([k.string for k in o.find_all(Nest, Key)], ['cd', 'e', 'f', 'g'])
+            self.assertIsNotNone(o._tree_index.nodes)
+        with self.assertRaises(ValueError):
+            Nest.parser(index='bogus')
+
+    def test_modified_tree(self):
+        o = Nest.parser(index=True).parse_string(self.text, eof=True)
+        other = Nest.parser().parse_string("(xy)", eof=True)
+        other.parent = o
+        # Not in the index, so it gets searched normally
+        self.assertIsNone(mg_util.tree_index(other))
+        self.assertEqual([k.string for k in other.find_all(Key)], ['xy'])
+
+    def test_pickle(self):
+        o = KeyPair.parser(index=True).parse_string('ab cd', eof=True)
+        o2 = pickle.loads(pickle.dumps(o))
+        self.assertIsNone(o2._tree_index.nodes)
+        self.assertEqual([k.string for k in o2.find_tag_all('key')], ['ab', 'cd'])
+
+
+class TestGrammarPickle(util.TestCase):
+    def roundtrip(self, grammar):
+        return pickle.loads(pickle.dumps(grammar, pickle.HIGHEST_PROTOCOL))
+
+    def test_named_classes(self):
+        self.assertIs(self.roundtrip(Pairs), Pairs)
+        self.assertIsNone(mg_util.global_name(L('a')))
+        self.assertEqual(mg_util.global_name(Pairs), 'Pairs')
+
+    def test_same_results(self):
+        grammars = [
+            (L('abc'), 'abc'),
+            (WORD('a-z', '0-9'), 'a12'),
+            (G(OPTIONAL(L('-')), WORD('0-9'), REPEAT(L('x') | L('y'), min=0)), '-12xyx'),
+            (LIST_OF(Pair, sep=L(';')), "a=1;b='c'"),
+            (G(REF('Item'), L('!')), '(ab(c))!'),
+            (G(Key, L('=') | L(':'), grammar_name='Assign', grammar_tags=('assign',)), 'ab:'),
+        ]
+        for grammar, text in grammars:
+            g2 = self.roundtrip(grammar)
+            self.assertIsNot(g2, grammar)
+            self.assertEqual(g2, grammar)
+            self.assertEqual(repr(g2), repr(grammar))
+            o = grammar.parser().parse_string(text, eof=True)
+            o2 = g2.parser().parse_string(text, eof=True)
+            self.assertEqual(describe(o2), describe(o), (grammar, text))
+
+    def test_shared_nodes(self):
+        word = WORD('a-z')
+        grammar = G(word, L('='), word)
+        graph = mg_util.grammar_graph(grammar)
+        self.assertEqual(len(graph), 3)
+        g2 = self.roundtrip(grammar)
+        self.assertIs(g2.grammar[0], g2.grammar[2])
+
+    def test_registry(self):
+        data = pickle.dumps(G(WORD('a-z'), L('=')))
+        g2 = pickle.loads(data)
+        self.assertIs(pickle.loads(data), g2)
+        # Structurally identical classes from separate pickles are shared, too
+        self.assertIs(self.roundtrip(WORD('a-z')), g2.grammar[0])
+
+    def test_cycle(self):
+        item = OR(L('x'), L('y'))
+        nest = G(L('('), REPEAT(item, min=0), L(')'))
+        item.grammar = (L('x'), nest)
+        g2 = self.roundtrip(nest)
+        self.assertIs(g2.grammar[1].grammar[0].grammar[1], g2)
+        o = nest.parser().parse_string('(x(x)())', eof=True)
+        o2 = g2.parser().parse_string('(x(x)())', eof=True)
+        self.assertEqual(describe(o2), describe(o))
+
+    def test_result_objects(self):
+        word = WORD('a-z')
+        grammar = REPEAT(G(word, L('='), word, L(';')))
+        for output in ('objects', 'compact'):
+            o = grammar.parser(output=output).parse_string('a=b;c=d;', eof=True)
+            o2 = self.roundtrip(o)
+            self.assertEqual(describe(o2), describe(o))
+            words = o2.find_all(Word)
+            self.assertEqual([w.string for w in words], ['a', 'b', 'c', 'd'])
+            self.assertEqual(len(set(type(w) for w in words)), 1)
+            self.assertEqual(len(set(type(e) for e in o2.elements)), 1)
+
+    def test_old_pickles(self):
+        # Older versions pickled a copy of the class dictionary with every object
+        import modgrammar
+        cls = L('ab')
+        cdict = dict((k, v) for k, v in cls.__dict__.items() if not k.startswith('__'))
+        o1 = modgrammar._ginstance_reconstructor(cls.__name__, cls.__bases__, cdict)
+        o2 = modgrammar._ginstance_reconstructor(cls.__name__, cls.__bases__, dict(cdict))
+        self.assertIs(type(o1), type(o2))
+        self.assertEqual(type(o1), cls)
@@ -1,6 +1,10 @@
 from __future__ import with_statement
 
+import os
+import sys
+
 from modgrammar import *
+from modgrammar import Text
 from tests import util
 
 #TODO:
@@ -66,3 +70,480 @@ class TestParseOpts(util.TestCase):
         p.reset()
         with self.assertRaises(ParseError):
             o = p.parse_string('aab', multi=True)
+
+
+class TestBuffer(util.TestCase):
+    def setUp(self):
+        self.old_threshold = Text.compact_threshold
+        Text.compact_threshold = 4
+
+    def tearDown(self):
+        Text.compact_threshold = self.old_threshold
+
+    def test_skip(self):
+        p = G(WORD('a-z'), L(';'), whitespace=False).parser()
+        o = p.parse_string('ab;c', multi=True)
+        self.assertEqual([x.string for x in o], ['ab;'])
+        self.assertEqual(p.text.start, 3)
+        self.assertEqual(p.remainder(), 'c')
+        o = p.parse_string('d;efg;h', multi=True)
+        self.assertEqual([x.string for x in o], ['cd;', 'efg;'])
+        self.assertEqual(p.text.start, 0)
+        self.assertEqual(p.remainder(), 'h')
+        self.assertEqual(p.char, 10)
+
+    def test_error_position(self):
+        p = G(WORD('a-z'), L(';\n'), whitespace=False).parser()
+        p.parse_string('ab;\ncd;\nx', multi=True)
+        with self.assertRaises(ParseError) as cm:
+            p.parse_string('!', eof=True)
+        e = cm.exception
+        self.assertEqual((e.buffer, e.buffer_pos, e.char, e.line, e.col), ('x!', 1, 9, 2, 1))
+
+    def test_bol(self):
+        grammar = OR(G(BOL, L('a'), OPTIONAL(L('\r')), whitespace=False), L('\n'))
+        p = grammar.parser()
+        o = p.parse_string('a\na\r', multi=True)
+        self.assertEqual([x.string for x in o], ['a', '\n', 'a\r'])
+        with self.assertRaises(ParseError):
+            p.parse_string('a', eof=True)
+
+    def test_regexp_context(self):
+        from modgrammar.extras import RE
+        grammar = OR(RE(r'^x'), RE(r'\bb'), L('a'), L('\n'))
+        o = grammar.parser().parse_string('ab\nx', multi=True, eof=True)
+        self.assertEqual([x.string for x in o], ['a', 'b', '\n', 'x'])
+        with self.assertRaises(ParseError):
+            grammar.parser().parse_string('ax', multi=True, eof=True)
+
+    def test_parse_lines(self):
+        grammar = G(L('{'), REPEAT(G(L('abc'), L(';'))), L('}'), whitespace=False)
+        lines = ['{abc;'] + ['abc;'] * 50 + ['}{', 'abc;}']
+        o = list(grammar.parser().parse_lines(lines, eof=True))
+        self.assertEqual([x.string for x in o], ['{' + 'abc;' * 51 + '}', '{abc;}'])
+        p = grammar.parser()
+        o = list(p.parse_lines(lines[:-1]))
+        self.assertEqual(len(o), 1)
+        self.assertEqual(p.remainder(), '{')
+
+    def test_split_tokens(self):
+        # Terminals which are split across many pieces of input should match the
+        # same way as if they'd been given all at once.
+        cases = [
+            (G(WORD('a-z'), L(';'), whitespace=False), 'abcdefgh;'),
+            (G(WORD('a', 'b-z', max=5), WORD('a-z'), L(';'), whitespace=False), 'abcdefgh;'),
+            (G(L('abcdefgh'), OPTIONAL(L(';')), whitespace=False), 'abcdefgh;'),
+            (G(L('abcdefgh'), OPTIONAL(L(';')), whitespace=False), 'abcdxfgh;'),
+            (G(SPACE, L(';'), whitespace=False), '      ;'),
+            (G(L('a'), L(';'), whitespace=True), 'a      ;'),
+        ]
+        for grammar, text in cases:
+            try:
+                expected = [e.string for e in grammar.parser().parse_string(text, eof=True).elements if e]
+            except ParseError as e:
+                expected = e.char
+            p = grammar.parser()
+            try:
+                for c in text[:-1]:
+                    self.assertIsNone(p.parse_string(c))
+                result = [e.string for e in p.parse_string(text[-1], eof=True).elements if e]
+            except ParseError as e:
+                result = e.char
+            self.assertEqual(result, expected, (grammar, text))
+
+    def test_parse_file_chunks(self):
+        import io
+        grammar = G(BOL, WORD('a-z'), L('='), REST_OF_LINE, EOL, whitespace=False)
+        text = u"abc=1\nde=\nfghij=23 4\n" * 20
+        expected = [x.string for x in grammar.parser().parse_file(io.StringIO(text), bol=True)]
+        self.assertEqual(len(expected), 60)
+        for chunk_size in (1, 3, 7, 1000):
+            o = grammar.parser().parse_file(io.StringIO(text), bol=True, chunk_size=chunk_size)
+            self.assertEqual([x.string for x in o], expected)
+        with self.assertRaises(ParseError) as cm:
+            list(grammar.parser().parse_file(io.StringIO(text + u"ab=\nx y\n"), bol=True, chunk_size=4))
+        self.assertEqual((cm.exception.line, cm.exception.col), (61, 1))
+        # Binary files work the same way (and stop at the end of the file)
+        data = text.encode('ascii')
+        o = grammar.parser().parse_file(io.BytesIO(data), bol=True, chunk_size=7)
+        self.assertEqual([x.string for x in o], [x.encode('ascii') for x in expected])
+
+    def test_parse_mmap(self):
+        import os
+        import tempfile
+        grammar = G(WORD('^=\n'), L('='), REST_OF_LINE, L('\n'), whitespace=False)
+        text = u"abc=1\n\u00e9\u00e8=\u20ac\nf\U0001f600=23 4\n" * 20
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(text.encode('utf-8'))
+            expected = [x.string for x in grammar.parser().parse_string(text, eof=True, multi=True)]
+            self.assertEqual(len(expected), 60)
+            for chunk_size in (1, 5, 1000):
+                o = grammar.parser(output='compact').parse_mmap(path, chunk_size=chunk_size)
+                self.assertEqual([x.string for x in o], expected)
+            with open(path, 'wb') as f:
+                f.write(u'\u00e9=x\n\u00e9x'.encode('latin-1'))
+            o = grammar.parser().parse_mmap(path, encoding='latin-1')
+            self.assertEqual(next(o).string, u'\u00e9=x\n')
+            with self.assertRaises(ParseError):
+                next(o)
+            o = grammar.parser().parse_mmap(path, encoding=None, chunk_size=2)
+            self.assertEqual(next(o).string, b'\xe9=x\n')
+            with self.assertRaises(ParseError):
+                next(o)
+            with open(path, 'wb') as f:
+                pass
+            self.assertEqual(list(grammar.parser().parse_mmap(path)), [])
+        finally:
+            os.remove(path)
+
+
+class TestPositions(util.TestCase):
+    def test_positions(self):
+        grammar = OR(WORD('a-z'), L('\n'), L('\t'))
+        for positions in (True, 'lazy'):
+            p = grammar.parser(tabs=4, positions=positions)
+            p.parse_string('ab\ncd\tef\n\tg', multi=True)
+            self.assertEqual((p.char, p.line, p.col), (10, 2, 4))
+            p.parse_string('h', multi=True, eof=True)
+            self.assertEqual((p.char, p.line, p.col), (12, 2, 6))
+            p.reset()
+            self.assertEqual((p.char, p.line, p.col), (0, 0, 0))
+        p = grammar.parser(positions=False)
+        p.parse_string('ab\ncd', multi=True)
+        self.assertEqual((p.char, p.line, p.col), (3, None, None))
+
+    def test_error_positions(self):
+        grammar = OR(WORD('a-z'), L('\n'), L('\t'))
+        for positions in (True, 'lazy'):
+            p = grammar.parser(tabs=8, positions=positions)
+            with self.assertRaises(ParseError) as cm:
+                p.parse_string('ab\n\tcd!', multi=True)
+            e = cm.exception
+            self.assertEqual((e.char, e.line, e.col), (6, 1, 10))
+            self.assertEqual(str(e), "[line 2, column 11] Expected '\\n' or '\\t' or WORD('a-z'): Found '!'")
+        p = grammar.parser(positions=False)
+        with self.assertRaises(ParseError) as cm:
+            p.parse_string('ab\n\tcd!', multi=True)
+        self.assertEqual(str(cm.exception), "[char 7] Expected '\\n' or '\\t' or WORD('a-z'): Found '!'")
+
+
+class TestFastErrors(util.TestCase):
+    grammars = [
+        (G(WORD('a-z'), OR(L('+'), L('-')), WORD('0-9')), ['abc*1', 'ab+x', 'ab+12']),
+        (OR(G(L('a'), L('b')), G(L('a'), WORD('0-9')), REPEAT(L('x'))), ['ac', 'xxy', 'a1']),
+        (G(L('('), LIST_OF(WORD('0-9'), sep=L(',')), L(')')), ['(1,2,', '(1,2x', '(1,22)']),
+    ]
+
+    def run_parse(self, grammar, text, **options):
+        p = grammar.parser(**options)
+        try:
+            o = p.parse_string(text, eof=True)
+        except ParseError as e:
+            return ('error', e.buffer_pos, sorted(g.grammar_desc for g in e.expected), str(e))
+        return (o.string, p.remainder())
+
+    def test_same_errors(self):
+        for grammar, texts in self.grammars:
+            for text in texts:
+                for options in ({}, {'compiled': True}, {'memoize': True}):
+                    normal = self.run_parse(grammar, text, **options)
+                    fast = self.run_parse(grammar, text, fast_errors=True, **options)
+                    self.assertEqual(fast, normal, (grammar, text, options))
+
+    def test_incremental(self):
+        grammar = G(WORD('a-z'), L(';'))
+        p = grammar.parser(fast_errors=True)
+        self.assertIsNone(p.parse_string('ab'))
+        with self.assertRaises(ParseError) as cm:
+            p.parse_string('c!')
+        self.assertEqual(cm.exception.buffer_pos, 3)
+        self.assertEqual([g.grammar_desc for g in cm.exception.expected], ["';'"])
+
+
+created = []
+
+class CountedWord(Grammar):
+    grammar = (WORD('a-z', greedy=False),)
+
+    def __init__(self, *args):
+        created.append(self)
+        Grammar.__init__(self, *args)
+
+
+class PrebuiltGrammar(Grammar):
+    grammar = (L('a'), L('b'))
+
+    @classmethod
+    def grammar_parse(cls, text, index, sessiondata):
+        # Custom grammar_parse implementations may still yield real instances
+        for count, obj in Grammar.grammar_parse.__func__(cls, text, index, sessiondata):
+            if count:
+                obj = cls(text.string, index, index + count, list(obj[3]))
+            yield (count, obj)
+
+
+class TestMatchRecords(util.TestCase):
+    def test_deferred_instances(self):
+        del created[:]
+        o = G(CountedWord, L(';')).parser().parse_string('abcdefgh;', eof=True)
+        self.assertEqual(o[0].string, 'abcdefgh')
+        # Only the winning match (out of 8 attempts) gets an instance
+        self.assertEqual(len(created), 1)
+
+    def test_prebuilt_instances(self):
+        o = G(PrebuiltGrammar, L('c')).parser().parse_string('abc', eof=True)
+        self.assertIsInstance(o[0], PrebuiltGrammar)
+        self.assertEqual([e.string for e in o[0].elements], ['a', 'b'])
+        self.assertIs(o[0].parent, o)
+        self.assertIs(o[0][1].parent, o[0])
+
+    def test_all_results_separate(self):
+        results = G(WORD('a-z'), WORD('a-z')).parser().parse_string('abc', eof=True, matchtype='all')
+        self.assertEqual([[e.string for e in r.elements] for r in results], [['ab', 'c'], ['a', 'bc'], ['a', 'b']])
+        # The last two matches share the same first element while parsing, but
+        # each result gets its own objects.
+        self.assertIsNot(results[1][0], results[2][0])
+        self.assertIs(results[2][0].parent, results[2])
+
+
+class TestMatches(util.TestCase):
+    def test_matches(self):
+        grammar = G(WORD('a-z'), L(';'))
+        for options in ({}, {'compiled': True}, {'memoize': True}):
+            p = grammar.parser(**options)
+            self.assertEqual(p.matches('ab;cd;'), 3)
+            self.assertIsNone(p.matches('ab'))
+            self.assertIsNone(p.matches('ab', eof=False))
+            self.assertIsNone(p.matches('1;'))
+            self.assertTrue(p.matches('ab;', full=True))
+            self.assertFalse(p.matches('ab;cd;', full=True))
+            self.assertFalse(p.matches('ab', full=True))
+
+    def test_full_backtracking(self):
+        # The first match isn't the whole string, but another one is
+        self.assertTrue(OR(L('a'), L('ab')).recognize('ab'))
+        self.assertFalse(OR(L('a'), L('ab')).recognize('abc'))
+        self.assertTrue(REPEAT(L('a'), greedy=False).recognize('aaa'))
+
+    def test_whitespace(self):
+        self.assertTrue(G(WORD('a-z'), L(';'), grammar_whitespace=True).recognize(' ab ; '))
+        self.assertFalse(G(WORD('a-z'), L(';'), grammar_whitespace=False).recognize('ab; '))
+
+    def test_no_objects(self):
+        del created[:]
+        p = G(CountedWord, L(';')).parser()
+        p.parse_string('ab')
+        self.assertEqual(p.matches('abc;'), 4)
+        self.assertEqual(created, [])
+        # The parser's own buffer is left alone
+        self.assertEqual(p.remainder(), 'ab')
+        o = p.parse_string(';')
+        self.assertEqual(o.string, 'ab;')
+
+
+init_order = []
+
+class Paren(Grammar):
+    grammar_whitespace = False
+    grammar = (L('('), OPTIONAL(REF('Paren')), L(')'))
+
+    def elem_init(self, sessiondata):
+        init_order.append(len(self.string))
+
+
+class Doubled(Grammar):
+    grammar = (WORD('a-z'),)
+
+    def grammar_postprocess(self, parent, sessiondata):
+        result = Grammar.grammar_postprocess(self, parent, sessiondata)
+        return result + result
+
+
+class TestDeepTrees(util.TestCase):
+    def test_deep_nesting(self):
+        depth = sys.getrecursionlimit() * 3
+        del init_order[:]
+        o = Paren.parser(compiled=True).parse_string('(' * depth + ')' * depth, eof=True)
+        # Innermost first
+        self.assertEqual(init_order, list(range(2, depth * 2 + 1, 2)))
+        self.assertEqual(len(o.terminals()), depth * 2)
+        self.assertEqual(list(o.iter_tokens()), ['('] * depth + [')'] * depth)
+        self.assertEqual(len(o.find(Paren, Paren, Paren)), depth * 2 - 6)
+        self.assertEqual(len(o.find_all(Paren)), 1)
+        inner = o
+        for i in range(depth - 1):
+            inner = inner[1]
+        self.assertEqual(inner.string, '()')
+        self.assertIs(inner.parent.parent.parent[1][1][1], inner)
+
+    def test_overridden_postprocess(self):
+        o = G(L('x'), Doubled, L('y'), grammar_whitespace=False).parser().parse_string('xaby', eof=True)
+        self.assertEqual([e.string for e in o.elements], ['x', 'ab', 'ab', 'y'])
+        self.assertIs(o[1].parent, o)
+        self.assertEqual(o.tokens(), ['x', 'ab', 'ab', 'y'])
+        self.assertEqual(list(o.iter_terminals()), o.terminals())
+
+
+class Record(Grammar):
+    grammar_whitespace = False
+    grammar = (WORD('a-z'), L(';'))
+
+
+class RecordFile(Grammar):
+    grammar = (REPEAT(Record, commit=True),)
+
+
+class TestCommit(util.TestCase):
+    def setUp(self):
+        self.old_threshold = Text.compact_threshold
+        Text.compact_threshold = 4
+
+    def tearDown(self):
+        Text.compact_threshold = self.old_threshold
+
+    def test_results(self):
+        for compiled in (False, True):
+            p = REPEAT(Record, commit=True).parser(compiled=compiled)
+            o = list(p.parse_lines(['ab;c', 'd;', 'e;f', ';'], eof=True))
+            self.assertEqual([x.string for x in o], ['ab;', 'cd;', 'e;', 'f;'])
+            self.assertTrue(all(isinstance(x, Record) for x in o))
+
+    def test_wrapper(self):
+        for compiled in (False, True):
+            p = RecordFile.parser(compiled=compiled)
+            o = list(p.parse_lines(['ab;c', 'd;', 'e;f', ';'], eof=True))
+            self.assertEqual([x.string for x in o], ['ab;', 'cd;', 'e;', 'f;'])
+            self.assertTrue(all(isinstance(x, Record) for x in o))
+
+    def test_list_of(self):
+        p = LIST_OF(WORD('a-z'), sep=L(','), commit=True, whitespace=False).parser()
+        o = list(p.parse_lines(['ab,c', 'd,', 'e,f'], eof=True))
+        self.assertEqual([x.string for x in o], ['ab', 'cd', 'e', 'f'])
+
+    def test_whitespace(self):
+        p = REPEAT(Record, commit=True, whitespace=True).parser()
+        o = list(p.parse_lines(['ab; c', 'd;  \n', 'e;f', ';  '], eof=True))
+        self.assertEqual([x.string for x in o], ['ab;', 'cd;', 'e;', 'f;'])
+
+    def test_errors(self):
+        p = REPEAT(Record, min=3, commit=True).parser()
+        with self.assertRaises(ParseError):
+            list(p.parse_lines(['ab;c', 'd;'], eof=True))
+        p = REPEAT(Record, commit=True).parser()
+        with self.assertRaises(ParseError) as cm:
+            list(p.parse_lines(['ab;c', 'd;x'], eof=True))
+        self.assertEqual(cm.exception.char, 7)
+
+    def test_possessive(self):
+        grammar = REPEAT(Record, commit=True)
+        self.assertTrue(grammar.grammar_possessive)
+        self.assertNotEqual(grammar, REPEAT(Record))
+        self.assertFalse(G(grammar, Record).parser().matches('ab;cd;', full=True))
+
+    def test_bounded_buffer(self):
+        p = REPEAT(Record, commit=True).parser()
+        longest = 0
+        count = 0
+        for x in p.parse_lines(['abc;'] * 1000, eof=True):
+            longest = max(longest, len(p.text.string))
+            count += 1
+        self.assertEqual(count, 1000)
+        self.assertTrue(longest < 20, longest)
+
+
+class TestBinary(util.TestCase):
+    def describe(self, grammar, text, **options):
+        p = grammar.parser(**options)
+        try:
+            results = p.parse_string(text, eof=True, multi=True)
+        except ParseError as e:
+            return ('error', e.char, e.line, e.col, sorted(g.grammar_desc for g in e.expected))
+        return [(str(x), [str(t) for t in x.terminals()]) for x in results]
+
+    def test_same_results(self):
+        from modgrammar.extras import RE
+        cases = [
+            (G(WORD('a-z'), L('='), WORD('0-9'), EOL, whitespace=False), ['ab=12\ncd=3\r\n', 'ab=x']),
+            (G(L('a'), L('b'), whitespace=True), ['a  b', 'a \tb  ', 'a c']),
+            (OR(L('ab'), L('a'), L('abc')), ['abc', 'ab', 'x']),
+            (OR(G(L('x'), L('y')), WORD('a-z')), ['xy', 'xz', '1']),
+            (G(BOL, L('x'), OPTIONAL(L('\r')), L('\n'), whitespace=False), ['x\nx\r\nx\n', 'xx']),
+            (G(RE('^a+'), RE(r'\bb'), whitespace=False), ['aab', 'aa b']),
+            (EXCEPT(WORD('a-z'), L('abc')), ['abc', 'abd']),
+            (G(SPACE, ANY_EXCEPT('\n'), whitespace=False), [' \t x ', 'x']),
+        ]
+        for grammar, texts in cases:
+            for text in texts:
+                for options in ({}, {'compiled': True}, {'output': 'compact'}):
+                    expected = self.describe(grammar, text, **options)
+                    result = self.describe(grammar, text.encode('latin-1'), **options)
+                    self.assertEqual(result, expected, (grammar, text, options))
+
+    def test_input_types(self):
+        grammar = G(WORD('a-z'), L('='), WORD('0-9'), L('\n'), whitespace=False)
+        p = grammar.parser()
+        o = p.parse_string(bytearray(b'ab=1\ncd=2'), multi=True)
+        self.assertEqual([x.string for x in o], [b'ab=1\n'])
+        o = p.parse_string(memoryview(b'3\n'), multi=True)
+        self.assertEqual([x.string for x in o], [b'cd=23\n'])
+        self.assertEqual(o[0][0].string, b'cd')
+        self.assertEqual(str(o[0][0]), 'cd')
+        with self.assertRaises(TypeError):
+            p.parse_string('ef=4\n')
+        with self.assertRaises(ParseError) as cm:
+            list(grammar.parser().parse_lines([b'ab=1\n', b'cd', b'=x\n'], eof=True))
+        e = cm.exception
+        self.assertEqual((e.buffer, e.line, e.col), (b'cd=x\n', 1, 3))
+        self.assertTrue(grammar.parser().matches(b'ab=1\n', full=True))
+
+    def test_non_latin1(self):
+        grammar = OR(L(u'\u20ac'), L('x'))
+        self.assertEqual(grammar.parser().parse_string(b'x', eof=True).string, b'x')
+        with self.assertRaises(ParseError):
+            grammar.parser().parse_string(b'\xe2\x82\xac', eof=True)
+
+    def test_quoted_string(self):
+        from modgrammar.extras import QuotedString
+        o = QuotedString.parser().parse_string(b"'a\\'b'", eof=True)
+        self.assertEqual(o.value, b"a'b")
+
+
+class Setting(Grammar):
+    grammar_whitespace = False
+    grammar = (WORD('a-z'), L('='), WORD('0-9'), L('\n'))
+
+
+class TestParallel(util.TestCase):
+    def setUp(self):
+        import tempfile
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def test_same_results(self):
+        self.write(b''.join(b'k' + b'x' * (i % 7) + b'=' + str(i).encode() + b'\n' for i in range(200)))
+        expected = [x.string for x in Setting.parser().parse_file(self.path)]
+        o = Setting.parser().parse_file_parallel(self.path, workers=2, shard_size=100)
+        self.assertEqual([x.string for x in o], expected)
+        o = Setting.parser().parse_file_parallel(self.path, workers=2, shard_size=100, encoding=None)
+        self.assertEqual([x.string for x in o], [x.encode() for x in expected])
+        self.write(b'ab;cd;' * 20 + b'ef;')
+        o = Record.parser().parse_file_parallel(self.path, boundary=';', workers=2, shard_size=10)
+        self.assertEqual([x.string for x in o], ['ab;', 'cd;'] * 20 + ['ef;'])
+
+    def test_error_position(self):
+        self.write(b'ab=1\n' * 50 + b'cd=2\ncd=x\n' + b'ab=1\n' * 50)
+        o = Setting.parser().parse_file_parallel(self.path, workers=2, shard_size=32)
+        with self.assertRaises(ParseError) as cm:
+            for x in o:
+                pass
+        e = cm.exception
+        self.assertEqual((e.char, e.line, e.col), (258, 51, 3))